@@ -1,15 +1,21 @@
+import json
 import os
 import shutil
 import subprocess
+import tarfile
 import time
 
 from memoized_property import memoized_property
-import requests
 
-from binder.settings import ROOT, REGISTRY_NAME
-from binder.utils import namespace_params, fill_template, fill_template_string, make_dir
+from binder.settings import ROOT, REGISTRY_NAME, NOTEBOOK_PORT
+from binder.utils import namespace_params, fill_template_string, make_dir
+from binder.buildcache import BuildCache
+from binder.buildcontext import BuildContext
+from binder.buildstate import BuildStateStore
 from binder.cluster import ClusterManager
+from binder.deps import DepsImages
 from binder.indices import AppIndex
+from binder.mirror import MirrorCache
 from binder.service import Service
 
 
@@ -27,21 +33,18 @@ class App(object):
 
     @staticmethod
     def get_app(name=None):
-        apps = App.index.find_apps()
         if not name:
-            return [App(a) for a in apps.values()]
-        app = apps.get(name)
+            return [App(a) for a in App.index.find_apps().values()]
+        app = App.index.get_app(name)
         if app:
-            return App(apps.get(name))
+            return App(app)
         return None
 
     @staticmethod
     def preload_all_apps():
         apps = App.get_app()
         cm = ClusterManager.get_instance()
-        cm.preload_image("binder-base")
-        for app in apps:
-            cm.preload_image(app.name)
+        cm.preload_images(["binder-base"] + [app.name for app in apps])
 
     @staticmethod
     def create(spec):
@@ -59,8 +62,10 @@ class App(object):
         self.dependencies = map(lambda d: d.lower(), self._json.get("dependencies", []))
         self.repo_url = self._json.get("repo")
 
-        # set once the repo is cloned
-        self.repo = None
+        # set once the repo's mirror is updated
+        self.fetch_report = None
+        # set once a build starts
+        self.build_id = None
 
         self.app_id = App._get_deployment_id()
 
@@ -82,124 +87,143 @@ class App(object):
         return namespace_params("app", {
             "name": self.name,
             "id": self.app_id,
-            "notebooks-image": REGISTRY_NAME + "/" + self.name,
-            "notebooks-port": 8888
+            "notebooks-image": BuildCache.get_instance().get_image(self.name) or REGISTRY_NAME + "/" + self.name,
+            "notebooks-port": NOTEBOOK_PORT
         })
 
-    def _fetch_repo(self):
+    def _stage(self, stage):
+        return BuildStateStore.get_instance().time_stage(self.build_id, stage)
+
+    def _resolve_commit(self):
         try:
-            repo_path = os.path.join(self.dir, "repo")
-            if requests.get(self.repo_url).status_code == 404:
-                raise Exception("repository does not exist")
-            cmd = ['git', 'clone', self.repo_url, repo_path]
-            if os.path.isdir(repo_path):
-                shutil.rmtree(repo_path)
-            subprocess.check_call(cmd)
-            self.repo = repo_path
-        except Exception as e:
+            # spec["commit"] pins the build to a commit, otherwise the default branch is built
+            commit, self.fetch_report = MirrorCache.get_instance().resolve(self.repo_url, self._json.get("commit"))
+            return commit
+        except MirrorCache.MirrorException as e:
             print("Could not fetch app repo: {}".format(e))
             raise App.BuildFailedException("could not fetch repository")
 
+    def _read_repo_file(self, commit, path):
+        return MirrorCache.get_instance().read_file(self.repo_url, commit, path)
+
     def _get_base_image_name(self):
         return REGISTRY_NAME + "/" + "binder-base"
 
     def _get_image_name(self):
         return REGISTRY_NAME + "/" + self.name
 
-    def _build_with_dockerfile(self, build_path):
+    def _render_suffix(self):
+        # the suffix image's Dockerfile is a template, filled with the app's spec
+        with open(os.path.join(ROOT, "images", "suffix", "Dockerfile"), "r") as suffix:
+            return fill_template_string(suffix.read(), self._json)
+
+    def _stream_build(self, commit, dockerfile, repo_prefix):
+        """
+        Builds the app image from a context holding the generated Dockerfile and the repository's
+        files (under repo_prefix), streamed from the repository's mirror
+        """
+        image_name = self._get_image_name().lower()
+        ignore_file = self._read_repo_file(commit, ".dockerignore")
+        ignore = BuildContext.parse_ignore_file(ignore_file) if ignore_file else []
+        context = BuildContext(image_name, ignore=ignore)
+        archive = MirrorCache.get_instance().archive(self.repo_url, commit)
+        try:
+            context.add_file("Dockerfile", dockerfile)
+            # when the repository is the context's root, the generated Dockerfile replaces its own
+            context.add_archive(archive.stdout, prefix=repo_prefix, exclude=None if repo_prefix else ["Dockerfile"])
+        except (BuildContext.ContextException, tarfile.TarError, IOError) as e:
+            archive.kill()
+            context.abort()
+            raise App.BuildFailedException("could not send the build context of {0}: {1}".format(self.name, e))
+        finally:
+            archive.stdout.close()
+            archive.wait()
+        # git reports a failed archive only once its output is over, and a truncated one would
+        # still build
+        if archive.returncode != 0:
+            context.abort()
+            raise App.BuildFailedException("could not archive commit {0} of {1} (git exited with {2})".format(
+                commit, self.name, archive.returncode))
+        if not context.build():
+            raise App.BuildFailedException("could not build app {0}".format(self.name))
+        return context.size
+
+    def _build_with_dockerfile(self, commit):
         # build the app image from the repository's Dockerfile
         print("Building the app image with Dockerfile...")
-        app_img_path = os.path.join(build_path, "app")
-        repo_path = os.path.join(app_img_path, "repo")
-        repo_df_path = os.path.join(app_img_path, os.path.join(repo_path, "Dockerfile"))
-        final_df_path = os.path.join(app_img_path, "Dockerfile")
-        with open(final_df_path, "w+") as final_df:
-            with open(repo_df_path, "r") as repo_df:
-
-                def filter_from(line):
-                    if line.startswith("FROM "):
-                        # TODO very crude base image check
-                        if not line.strip().endswith("/binder-base"):
-                            print("Dockerfile base image is not binder-base. Building may fail.")
-                        return False
-                    return True
-
-                lines = repo_df.readlines()
-                no_from = filter(lambda line: filter_from(line), lines)
-
-                # write the actual base image (with corrected registry)
-                final_lines = ["FROM {}".format(self._get_base_image_name())] + no_from
-
-                for line in final_lines:
-                    final_df.write(line)
-                final_df.write("\n")
-
-                final_df.write("USER main\n")
-                final_df.write("\n")
-            
-                # the dockerfile is building with the repository as its context
-                notebook_path = self._json["notebooks"] if "notebooks" in self._json else "."
-                final_df.write("ADD {0} $HOME/notebooks\n".format(notebook_path))
-                final_df.write("\n")
-
-                # write suffix lines to the app image
-                nb_img_path = os.path.join(build_path, "suffix")
-                with open(os.path.join(nb_img_path, "Dockerfile"), 'r') as nb_img:
-                    for line in nb_img.readlines():
-                        final_df.write(line)
-                    final_df.write("\n")
-
-        shutil.move(final_df_path, repo_df_path)
+        # the repository's Dockerfile installs its own dependencies
+        DepsImages.get_instance().release(self.name)
+        repo_df = self._read_repo_file(commit, "Dockerfile")
+        if repo_df is None:
+            raise App.BuildFailedException("app {0} has no Dockerfile".format(self.name))
+
+        def filter_from(line):
+            if line.startswith("FROM "):
+                # TODO very crude base image check
+                if not line.strip().endswith("/binder-base"):
+                    print("Dockerfile base image is not binder-base. Building may fail.")
+                return False
+            return True
+
+        no_from = filter(lambda line: filter_from(line), repo_df.splitlines(True))
+
+        # write the actual base image (with corrected registry)
+        final_lines = ["FROM {}\n".format(self._get_base_image_name())] + no_from
+        final_df = "".join(final_lines) + "\n"
+
+        final_df += "USER main\n"
+        final_df += "\n"
+
+        # the dockerfile is building with the repository as its context
+        notebook_path = self._json["notebooks"] if "notebooks" in self._json else "."
+        final_df += "ADD {0} $HOME/notebooks\n".format(notebook_path)
+        final_df += "\n"
+
+        # write suffix lines to the app image
+        final_df += self._render_suffix() + "\n"
 
         # build the app image
+        return self._stream_build(commit, final_df, "")
+
+    def _get_deps_image(self, commit):
+        """
+        Returns the image the app image should be built on: the deps image for the repository's
+        requirements.txt, or the base image if it has none
+        """
+        deps = DepsImages.get_instance()
+        # TODO do more modular dependency handling here
+        requirements = self._read_repo_file(commit, "requirements.txt") if "requirements.txt" in self.dependencies else None
+        if requirements is None:
+            deps.release(self.name)
+            return self._get_base_image_name()
         try:
-            image_name = self._get_image_name().lower()
-            subprocess.check_call(['docker', 'build', '-t', image_name, os.path.join(app_img_path, "repo")])
-        except subprocess.CalledProcessError as e:
-            raise App.BuildFailedException("could not build app {0}: {1}".format(self.name, e))
+            return deps.get_image(self.name, requirements, self._get_base_image_name())
+        except DepsImages.BuildFailedException as e:
+            raise App.BuildFailedException("could not build the dependencies of {0}: {1}".format(self.name, e))
 
-    def _build_without_dockerfile(self, build_path):
+    def _build_without_dockerfile(self, commit, deps_image):
         # construct the app image Dockerfile
-        app_img_path = os.path.join(build_path, "app")
-        repo_path = os.path.join(app_img_path, "repo")
         print("Building app image without Dockerfile...")
-        with open(os.path.join(app_img_path, "Dockerfile"), 'w+') as app:
-
-            app.write("FROM {}\n".format(self._get_base_image_name()))
-            app.write("\n")
-
-            for dependency in self.dependencies:
-                # TODO do more modular dependency handling here
-                if dependency == "requirements.txt":
-                    app.write("ADD {0} requirements.txt\n".format("repo/requirements.txt"))
-                    app.write("RUN pip install -r requirements.txt\n")
-                    app.write("RUN /home/main/anaconda/envs/python3/bin/pip install -r requirements.txt\n")
-                    app.write("\n")
-
-            # if any services have client code, insert that now
-            for service in self.services:
-                client = service.client if service.client else ""
-                app.write("# {} client\n".format(service.name))
-                app.write(client)
-                app.write("\n")
-
-            notebook_path = self._json["notebooks"] if "notebooks" in self._json else "repo"
-            app.write("ADD {0} $HOME/notebooks\n".format(notebook_path))
-            app.write("\n")
-
-            # write suffix lines to the app image
-            nb_img_path = os.path.join(build_path, "suffix")
-            with open(os.path.join(nb_img_path, "Dockerfile"), 'r') as nb_img:
-                for line in nb_img.readlines():
-                    app.write(line)
-                app.write("\n")
 
-        # build the app image
-        try:
-            image_name = self._get_image_name().lower()
-            subprocess.check_call(['docker', 'build', '-t', image_name, app_img_path])
-        except subprocess.CalledProcessError as e:
-            raise App.BuildFailedException("could not build app {0}: {1}".format(self.name, e))
+        app = "FROM {}\n".format(deps_image)
+        app += "\n"
+
+        # if any services have client code, insert that now
+        for service in self.services:
+            client = service.client if service.client else ""
+            app += "# {} client\n".format(service.name)
+            app += client
+            app += "\n"
+
+        notebook_path = self._json["notebooks"] if "notebooks" in self._json else "repo"
+        app += "ADD {0} $HOME/notebooks\n".format(notebook_path)
+        app += "\n"
+
+        # write suffix lines to the app image
+        app += self._render_suffix() + "\n"
+
+        # build the app image, with the repository under repo/
+        return self._stream_build(commit, app, "repo/")
 
     def _build_base_image(self):
         # make sure the base image is built
@@ -215,17 +239,6 @@ class App(object):
             print("Could not build the base image: {}".format(e))
             raise App.BuildFailedException("could not build the base image")
 
-    def _fill_templates(self, build_path):
-        print "Copying files and filling templates..."
-        images_path = os.path.join(ROOT, "images")
-        for img in os.listdir(images_path):
-            img_path = os.path.join(images_path, img)
-            bd_path = os.path.join(build_path, img)
-            shutil.copytree(img_path, bd_path)
-            for root, dirs, files in os.walk(bd_path):
-                for f in files:
-                    fill_template(os.path.join(root, f), self._json)
-
     def _push_image(self):
         try:
             image_name = self._get_image_name()
@@ -234,47 +247,96 @@ class App(object):
         except subprocess.CalledProcessError:
             raise App.BuildFailedException("Could not push {0} to the private registry".format(self.name))
 
+    def _get_pushed_image(self):
+        """
+        Returns the pushed app image by digest, or None if docker doesn't know its digest
+        """
+        image_name = self._get_image_name().lower()
+        try:
+            out = subprocess.check_output(["docker", "inspect", "--format", "{{json .RepoDigests}}", image_name])
+            digests = json.loads(out) or []
+        except (subprocess.CalledProcessError, ValueError) as e:
+            print("Could not get the digest of {0}: {1}".format(image_name, e))
+            return None
+        for digest in digests:
+            if digest.startswith(image_name + "@"):
+                return digest
+        return None
+
+    def _reuse_image(self, build_key):
+        """
+        Returns whether there's a cached image for build_key, which then becomes the app's image
+        """
+        cache = BuildCache.get_instance()
+        image = cache.lookup(self.name, build_key)
+        stats = cache.get_stats()
+        print("Build cache hit rate: {0}/{1}".format(stats["hits"], stats["lookups"]))
+        if not image:
+            return False
+        print("Inputs of {0} are unchanged, reusing {1}".format(self.name, image))
+        return True
+
     def _preload_image(self):
         print("Preloading app image onto all nodes...")
         cm = ClusterManager.get_instance().preload_image(self.name)
      
     def build(self, build_base=False, preload=False):
         try:
-            # clean up the old build and record the start of a new build
-            build_path = os.path.join(self.path, "build")
-            make_dir(build_path, clean=True)
-            App.index.update_build_state(self, App.BuildState.BUILDING)
-
-            # fetch the repo
-            self._fetch_repo()
+            # record the start of a new build. Every stage below is timed and recorded as part of this
+            # build (looking the build up by app afterwards could find a build started since by another
+            # process)
+            self.build_id = App.index.update_build_state(self, App.BuildState.BUILDING)
+
+            # an image built from the same inputs can be reused as is (unless the base image changes)
+            with self._stage("fetch") as stage:
+                commit = self._resolve_commit()
+                stage["bytes"] = self.fetch_report["bytes"]
+            with self._stage("cache"):
+                build_key = BuildCache.get_key(commit, self._json, self.services, os.path.join(ROOT, "images"))
+                reused = not build_base and self._reuse_image(build_key)
+            if reused:
+                if preload:
+                    with self._stage("preload"):
+                        self._preload_image()
+                App.index.update_build_state(self, App.BuildState.COMPLETED)
+                return
 
             # ensure that the service dependencies are all build
             print "Building service dependencies..."
-            for service in self.services:
-                built_service = service.build()
-                if not built_service:
-                    raise App.BuildFailedException("could not build service {}".format(service.full_name))
-
-            # copy new file and replace all template placeholders with parameters
-            self._fill_templates(build_path)
+            with self._stage("services"):
+                for service in self.services:
+                    built_service = service.build()
+                    if not built_service:
+                        raise App.BuildFailedException("could not build service {}".format(service.full_name))
 
             if build_base:
-                self._build_base_image()
+                with self._stage("base"):
+                    self._build_base_image()
 
-            app_img_path = os.path.join(build_path, "app")
-            make_dir(app_img_path)
-            shutil.copytree(self.repo, os.path.join(app_img_path, "repo"))
             if "dockerfile" in self.dependencies:
-                self._build_with_dockerfile(build_path)
+                with self._stage("image") as stage:
+                    stage["bytes"] = self._build_with_dockerfile(commit)
             else:
-                self._build_without_dockerfile(build_path)
+                # apps with the same requirements share an image with those requirements installed
+                with self._stage("deps"):
+                    deps_image = self._get_deps_image(commit)
+                with self._stage("image") as stage:
+                    stage["bytes"] = self._build_without_dockerfile(commit, deps_image)
 
             # push the app image to the private registry
-            self._push_image()
+            with self._stage("push"):
+                self._push_image()
+                image = self._get_pushed_image()
+                if image:
+                    BuildCache.get_instance().store(self.name, build_key, image)
+                else:
+                    # an older digest of the app would otherwise be launched instead of this build
+                    BuildCache.get_instance().forget(self.name)
 
             # if preload is set, send the app image to all nodes
             if preload:
-                self._preload_image()
+                with self._stage("preload"):
+                    self._preload_image()
 
         except App.BuildFailedException as e:
             App.index.update_build_state(self, App.BuildState.FAILED)
@@ -284,19 +346,17 @@ class App(object):
         print("Successfully built app {0}".format(self.name))
         App.index.update_build_state(self, App.BuildState.COMPLETED)
 
-    def deploy(self, mode):
-        # every service must be deployable in single-node mode, so this is valid even if there
-        # aren't any services
-        if not mode:
-            mode = "single-node"
-
+    def _write_deployment(self, mode):
+        """
+        Fills the deployment templates for this app and all its services. Returns the directory
+        containing the deployment files, or None if any service could not be deployed
+        """
         success = True
 
-        # clean up the old deployment
-        deploy_path = os.path.join(self.path, "deploy")
-        if os.path.isdir(deploy_path):
-            shutil.rmtree(deploy_path)
-        os.mkdir(deploy_path)
+        # every deployment gets its own directory, since an app can be deployed many times at once
+        deploy_path = os.path.join(self.path, "deploy", self.app_id)
+        make_dir(os.path.join(self.path, "deploy"))
+        make_dir(deploy_path, clean=True)
 
         services = self.services
         app_params = self.get_app_params()
@@ -312,12 +372,12 @@ class App(object):
 
         # insert the notebooks container into the pod.json template
         with open(os.path.join(deploy_path, "notebook.json"), 'w+') as nb_file:
-            nb_string = fill_template_string(templates["notebook.json"], app_params)
+            nb_string = fill_template_string(templates["notebook.json"], app_params, name="notebook.json")
             nb_file.write(nb_string)
 
         # insert the namespace file into the deployment folder
         with open(os.path.join(deploy_path, "namespace.json"), 'w+') as ns_file:
-            ns_string = fill_template_string(templates["namespace.json"], app_params)
+            ns_string = fill_template_string(templates["namespace.json"], app_params, name="namespace.json")
             ns_file.write(ns_string)
 
         # write deployment files for every service (by passing app parameters down to each service)
@@ -326,18 +386,48 @@ class App(object):
             if not deployed_service:
                 success = False
 
-        # use the cluster manager to deploy each file in the deploy/ folder
-        redirect_url = ClusterManager.get_instance().deploy_app(self.app_id, deploy_path)
-        if not redirect_url:
+        if not success:
+            shutil.rmtree(deploy_path)
+            return None
+        return deploy_path
+
+    def deploy(self, mode):
+        # every service must be deployable in single-node mode, so this is valid even if there
+        # aren't any services
+        if not mode:
+            mode = "single-node"
+
+        success = True
+        redirect_url = None
+
+        deploy_path = self._write_deployment(mode)
+        if not deploy_path:
             success = False
+        else:
+            # use the cluster manager to deploy each file in the deploy/ folder
+            redirect_url = ClusterManager.get_instance().deploy_app(self.app_id, deploy_path)
+            shutil.rmtree(deploy_path)
+            if not redirect_url:
+                success = False
 
         if success:
-            app_id = app_params["app.id"]
-            print("Successfully deployed app {0} in {1} mode with ID {2}".format(self.name, mode, app_id))
+            print("Successfully deployed app {0} in {1} mode with ID {2}".format(self.name, mode, self.app_id))
             return redirect_url
         else:
             print("Failed to deploy app {0} in {1} mode.".format(self.name, mode))
             return None
 
+    def prestart(self, mode):
+        """
+        Deploys the app without making it accessible through the proxy. Returns the IP of the
+        notebook server once it's ready, or None if the deployment failed
+        """
+        deploy_path = self._write_deployment(mode)
+        if not deploy_path:
+            return None
+        ip = ClusterManager.get_instance().prestart_app(self.app_id, deploy_path)
+        shutil.rmtree(deploy_path)
+        return ip
+
     def destroy(self):
         pass
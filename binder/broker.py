@@ -0,0 +1,269 @@
+import json
+
+import requests
+
+from binder.app import App
+from binder.buildcache import BuildCache
+from binder.buildlog import BuildLogStore
+from binder.buildqueue import BuildQueue
+from binder.buildstate import BuildStateStore
+from binder.concurrency import AdaptiveConcurrency
+from binder.indices import AppIndex
+from binder.settings import BROKER_URL, BROKER_TOKEN
+
+
+class Broker(object):
+    """
+    Where build workers lease jobs from. A worker claims a job, heartbeats while it builds it and
+    finishes it when the build is done (whatever its result). heartbeat returns False once the job
+    isn't the worker's anymore, and None if the broker couldn't be reached. Builds record their app,
+    states, stages, images and output with the broker's host
+    """
+
+    @staticmethod
+    def get_broker(url=BROKER_URL):
+        if url == "local":
+            return LocalBroker()
+        return HTTPBroker(url)
+
+    def claim(self, worker, max_running=None):
+        pass
+
+    def heartbeat(self, job, worker):
+        pass
+
+    def finish(self, job, worker):
+        pass
+
+    def record_concurrency(self, worker, period):
+        """
+        Records a period of the worker's adaptive concurrency (see AdaptiveConcurrency.record_period)
+        """
+        pass
+
+    def prepare_build(self, job, worker):
+        """
+        Called in the build's own process before the job's app is built
+        """
+        pass
+
+    def create_app(self, job, worker, spec):
+        pass
+
+    def update_build_state(self, job, worker, state):
+        """
+        Returns the ID of the job's build (see AppIndex.update_build_state)
+        """
+        pass
+
+    def record_stage(self, job, worker, build_id, stage, started, finished, status, nbytes=None, error=None):
+        pass
+
+    def store_image(self, job, worker, key, image):
+        """
+        Makes image (built for key) the current image of the job's app, or forgets the app's images
+        if image is None (see BuildCache.forget)
+        """
+        pass
+
+    def append_log(self, job, worker, build_id, data, finished):
+        pass
+
+
+class LocalBroker(Broker):
+    """
+    Leases jobs straight from the build queue, for workers that can reach its database (the web
+    API's own builder, or workers on the same host). Builds record everything in that database
+    themselves
+    """
+
+    def __init__(self, queue=None):
+        self.queue = queue or BuildQueue.get_instance()
+
+    def claim(self, worker, max_running=None):
+        return self.queue.claim(worker, max_running=max_running)
+
+    def heartbeat(self, job, worker):
+        return self.queue.heartbeat(job["id"], worker)
+
+    def finish(self, job, worker):
+        finished = self.queue.finish(job["id"], worker)
+        if finished:
+            # a build that dies (or is killed) before recording its last state would be building forever
+            app = App.get_app(job["app"])
+            if app and App.index.get_build_state(app) == App.BuildState.BUILDING:
+                App.index.update_build_state(app, App.BuildState.FAILED)
+        return finished
+
+    def record_concurrency(self, worker, period):
+        AdaptiveConcurrency.record_period(period)
+
+    def append_log(self, job, worker, build_id, data, finished):
+        # the logs directory is shared with the web API, which reads the logs of other processes from disk
+        BuildLogStore.get_instance().append(build_id, data, finished)
+
+
+class HTTPBroker(Broker):
+    """
+    Leases jobs from the build queue of a web API server, for workers on other hosts. Builds keep
+    their app directories and caches on the worker's host, but record their app, states (and so
+    their build IDs), stages, images and concurrency with the web API
+    """
+
+    TIMEOUT = 10
+
+    def __init__(self, url, token=BROKER_TOKEN):
+        self.url = url.rstrip("/") + "/workers"
+        self.token = token
+        self.session = self._make_session()
+
+    def _make_session(self):
+        session = requests.Session()
+        session.headers["Content-Type"] = "application/json"
+        if self.token:
+            session.headers["Authorization"] = "token {}".format(self.token)
+        return session
+
+    def _post(self, path, data, params=None, headers=None):
+        try:
+            r = self.session.post(self.url + path, data=data, params=params, headers=headers,
+                                  timeout=HTTPBroker.TIMEOUT)
+            if r.status_code == 200:
+                return r.json()
+            print("Broker request {0} failed: {1}".format(path, r.status_code))
+        except (requests.exceptions.RequestException, ValueError) as e:
+            print("Could not reach the broker at {0}: {1}".format(self.url, e))
+        return None
+
+    def _post_job(self, job, path, worker, **fields):
+        fields["worker"] = worker
+        return self._post("/jobs/{0}/{1}".format(job["id"], path), json.dumps(fields))
+
+    def claim(self, worker, max_running=None):
+        result = self._post("/claim", json.dumps({"worker": worker, "max_running": max_running}))
+        return result["job"] if result else None
+
+    def heartbeat(self, job, worker):
+        result = self._post_job(job, "heartbeat", worker)
+        return result["ok"] if result else None
+
+    def finish(self, job, worker):
+        result = self._post_job(job, "finish", worker)
+        return result["ok"] if result else None
+
+    def record_concurrency(self, worker, period):
+        self._post("/concurrency", json.dumps({"worker": worker, "period": period}))
+
+    def prepare_build(self, job, worker):
+        # the build's process doesn't share the worker's connections
+        self.session = self._make_session()
+        App.index = BrokerAppIndex(App.index, self, job, worker)
+        BuildStateStore.store = BrokerBuildStateStore(self, job, worker)
+        BuildCache.cache = BrokerBuildCache(self, job, worker)
+
+    def create_app(self, job, worker, spec):
+        return self._post_job(job, "app", worker, spec=spec) is not None
+
+    def update_build_state(self, job, worker, state):
+        result = self._post_job(job, "state", worker, state=state)
+        return result["build_id"] if result else None
+
+    def record_stage(self, job, worker, build_id, stage, started, finished, status, nbytes=None, error=None):
+        self._post_job(job, "stage", worker, build_id=build_id, stage=stage, started=started, finished=finished,
+                       status=status, bytes=nbytes, error=error)
+
+    def store_image(self, job, worker, key, image):
+        self._post_job(job, "image", worker, key=key, image=image)
+
+    def append_log(self, job, worker, build_id, data, finished):
+        params = {"worker": worker, "build": build_id, "finished": 1 if finished else 0}
+        self._post("/jobs/{}/log".format(job["id"]), data, params=params,
+                   headers={"Content-Type": "application/octet-stream"})
+
+
+class BrokerAppIndex(AppIndex):
+    """
+    The app index of a remote build: the app's directory is on the worker's host (in its own
+    index), but the app's spec and build states are recorded by the broker
+    """
+
+    def __init__(self, index, broker, job, worker):
+        super(BrokerAppIndex, self).__init__()
+        self._index = index
+        self._broker = broker
+        self._job = job
+        self._worker = worker
+
+    def create(self, spec):
+        m = self._index.create(spec)
+        if not self._broker.create_app(self._job, self._worker, spec):
+            print("Could not record app {} with the broker".format(spec["name"]))
+        return m
+
+    def find_apps(self):
+        return self._index.find_apps()
+
+    def get_app(self, name):
+        return self._index.get_app(name)
+
+    def make_app_path(self, app):
+        return self._index.make_app_path(app)
+
+    def update_build_state(self, app, state):
+        build_id = self._broker.update_build_state(self._job, self._worker, state)
+        if build_id is None and state == App.BuildState.BUILDING:
+            print("Could not record the build of {} with the broker".format(app.name))
+        self._notify(app, state)
+        return build_id
+
+    def get_build_state(self, app):
+        # only the broker's host knows the latest state
+        return None
+
+    def save_app(self, app):
+        self._index.save_app(app)
+
+
+class BrokerBuildStateStore(BuildStateStore):
+    """
+    Sends the stages of a remote build to the broker, which records them under the build ID it gave
+    """
+
+    def __init__(self, broker, job, worker):
+        super(BrokerBuildStateStore, self).__init__()
+        self._broker = broker
+        self._job = job
+        self._worker = worker
+
+    def record(self, app_name, state):
+        return self._broker.update_build_state(self._job, self._worker, state)
+
+    def record_stage(self, build_id, stage, started, finished, status, nbytes=None, error=None):
+        self._broker.record_stage(self._job, self._worker, build_id, stage, started, finished, status, nbytes, error)
+
+
+class BrokerBuildCache(BuildCache):
+    """
+    The build cache of the worker's host, which also tells the broker what image the app ends up
+    with (launches look it up on the broker's host)
+    """
+
+    def __init__(self, broker, job, worker):
+        super(BrokerBuildCache, self).__init__()
+        self._broker = broker
+        self._job = job
+        self._worker = worker
+
+    def lookup(self, app_name, key):
+        image = super(BrokerBuildCache, self).lookup(app_name, key)
+        if image:
+            self._broker.store_image(self._job, self._worker, key, image)
+        return image
+
+    def store(self, app_name, key, image):
+        super(BrokerBuildCache, self).store(app_name, key, image)
+        self._broker.store_image(self._job, self._worker, key, image)
+
+    def forget(self, app_name):
+        super(BrokerBuildCache, self).forget(app_name)
+        self._broker.store_image(self._job, self._worker, None, None)
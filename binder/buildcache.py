@@ -0,0 +1,122 @@
+import hashlib
+import json
+import os
+import time
+
+from binder.db import get_connection, transaction
+from binder.settings import DB_PATH
+
+
+def hash_tree(path, digest):
+    """
+    Feeds the relative path and contents of every file under path into digest, in a stable order
+    """
+    for root, dirs, files in os.walk(path):
+        dirs.sort()
+        for f in sorted(files):
+            file_path = os.path.join(root, f)
+            digest.update(os.path.relpath(file_path, path) + "\0")
+            with open(file_path, "rb") as tree_file:
+                digest.update(hashlib.sha256(tree_file.read()).hexdigest())
+
+
+class BuildCache(object):
+    """
+    Maps build keys (a hash of everything that goes into an app image) to the digest of the image
+    they produced, so that a build whose inputs haven't changed can reuse the pushed image
+    """
+
+    # the singleton cache
+    cache = None
+
+    @staticmethod
+    def get_instance():
+        if not BuildCache.cache:
+            BuildCache.cache = BuildCache()
+        return BuildCache.cache
+
+    def __init__(self, db_path=DB_PATH):
+        self.db_path = db_path
+        get_connection(self.db_path).executescript("""
+            CREATE TABLE IF NOT EXISTS build_cache (
+                key TEXT PRIMARY KEY,
+                app TEXT NOT NULL,
+                -- the pushed image, by digest
+                image TEXT NOT NULL,
+                created REAL NOT NULL,
+                -- the last time the image was built or reused
+                used REAL NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS build_cache_app ON build_cache (app, used);
+            CREATE TABLE IF NOT EXISTS build_cache_lookups (
+                time REAL NOT NULL,
+                app TEXT NOT NULL,
+                hit INTEGER NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS build_cache_lookups_time ON build_cache_lookups (time);
+        """)
+
+    @staticmethod
+    def get_key(commit, spec, services, images_path):
+        """
+        Returns the build key of an app built from `commit` with `spec`, its services and the
+        images under images_path
+        """
+        digest = hashlib.sha256()
+        digest.update(commit + "\0")
+        digest.update(json.dumps(spec, sort_keys=True) + "\0")
+        for service in sorted(services, key=lambda s: s.full_name):
+            digest.update(service.full_name + "\0")
+            digest.update(json.dumps(service._json, sort_keys=True) + "\0")
+            digest.update((service.client or "") + "\0")
+        hash_tree(images_path, digest)
+        return digest.hexdigest()
+
+    def lookup(self, app_name, key):
+        """
+        Returns the image built for key (and marks it as the app's current image), or None
+        """
+        now = time.time()
+        conn = get_connection(self.db_path)
+        with transaction(conn):
+            row = conn.execute("SELECT image FROM build_cache WHERE key = ?", (key,)).fetchone()
+            if row:
+                conn.execute("UPDATE build_cache SET app = ?, used = ? WHERE key = ?", (app_name, now, key))
+            conn.execute("INSERT INTO build_cache_lookups (time, app, hit) VALUES (?, ?, ?)",
+                         (now, app_name, 1 if row else 0))
+        return row["image"] if row else None
+
+    def store(self, app_name, key, image):
+        now = time.time()
+        conn = get_connection(self.db_path)
+        with transaction(conn):
+            conn.execute("INSERT OR REPLACE INTO build_cache (key, app, image, created, used) VALUES (?, ?, ?, ?, ?)",
+                         (key, app_name, image, now, now))
+
+    def forget(self, app_name):
+        """
+        Removes the images the app was built with, e.g. once it's built into an image whose digest
+        isn't known (get_image then returns None, and the app is run from its latest tag)
+        """
+        conn = get_connection(self.db_path)
+        with transaction(conn):
+            conn.execute("DELETE FROM build_cache WHERE app = ?", (app_name,))
+
+    def get_image(self, app_name):
+        """
+        Returns the image (by digest) the app was last built or reused with, or None
+        """
+        conn = get_connection(self.db_path)
+        row = conn.execute("SELECT image FROM build_cache WHERE app = ? ORDER BY used DESC LIMIT 1",
+                           (app_name,)).fetchone()
+        return row["image"] if row else None
+
+    def get_stats(self, since=0):
+        conn = get_connection(self.db_path)
+        lookups, hits = conn.execute("SELECT COUNT(*), COALESCE(SUM(hit), 0) FROM build_cache_lookups WHERE time >= ?",
+                                     (since,)).fetchone()
+        return {
+            "lookups": lookups,
+            "hits": hits,
+            "hit_rate": float(hits) / lookups if lookups else None
+        }
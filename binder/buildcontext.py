@@ -0,0 +1,111 @@
+import fnmatch
+import subprocess
+import tarfile
+import time
+from cStringIO import StringIO
+
+from binder.settings import BUILD_CONTEXT_IGNORE, BUILD_CONTEXT_MAX_FILE_SIZE, BUILD_CONTEXT_MAX_SIZE
+
+
+class BuildContext(object):
+    """
+    Streams a docker build context, as a tar, straight into `docker build -`. Generated files are
+    added from memory and the repository's files are streamed from `git archive`, so nothing is
+    written to disk on the way
+    """
+
+    class ContextException(Exception):
+        pass
+
+    def __init__(self, image_name, ignore=None, max_file_size=BUILD_CONTEXT_MAX_FILE_SIZE,
+                 max_size=BUILD_CONTEXT_MAX_SIZE):
+        self.image_name = image_name
+        self.ignore = BUILD_CONTEXT_IGNORE + (ignore or [])
+        self.max_file_size = max_file_size
+        self.max_size = max_size
+
+        self.size = 0
+        self.files = 0
+
+        self._start = time.time()
+        self._proc = subprocess.Popen(["docker", "build", "-t", image_name, "-"], stdin=subprocess.PIPE)
+        self._tar = tarfile.open(fileobj=self._proc.stdin, mode="w|")
+
+    @staticmethod
+    def parse_ignore_file(contents):
+        """
+        Returns the patterns of a .dockerignore file (exceptions, starting with "!", aren't supported)
+        """
+        patterns = []
+        for line in contents.splitlines():
+            line = line.strip()
+            if line and not line.startswith("#") and not line.startswith("!"):
+                patterns.append(line.strip("/"))
+        return patterns
+
+    def _is_ignored(self, name):
+        parts = name.strip("/").split("/")
+        # a pattern excludes a path if it matches the path or any of its parent directories
+        for i in range(1, len(parts) + 1):
+            path = "/".join(parts[:i])
+            for pattern in self.ignore:
+                if fnmatch.fnmatch(path, pattern) or fnmatch.fnmatch(parts[i - 1], pattern):
+                    return True
+        return False
+
+    def _add(self, info, fileobj=None):
+        self.size += info.size
+        if self.size > self.max_size:
+            raise BuildContext.ContextException("build context is larger than {} bytes".format(self.max_size))
+        self._tar.addfile(info, fileobj)
+        self.files += 1
+
+    def add_file(self, name, contents, mode=0644):
+        info = tarfile.TarInfo(name)
+        info.size = len(contents)
+        info.mode = mode
+        info.mtime = time.time()
+        self._add(info, StringIO(contents))
+
+    def add_archive(self, archive, prefix="", exclude=None):
+        """
+        Adds the members of a tar stream (a file object), under prefix, except for those in exclude
+        and those matching the ignore patterns (relative to the archive's root). Raises a
+        ContextException listing the files larger than max_file_size, if there are any
+        """
+        exclude = exclude or []
+        oversized = []
+        with tarfile.open(fileobj=archive, mode="r|") as source:
+            for member in source:
+                if member.name in exclude or self._is_ignored(member.name):
+                    continue
+                if member.isfile() and member.size > self.max_file_size:
+                    # the rest of the archive is still read, so that every such file is reported
+                    print("{0} ({1} bytes) is too large for the build context".format(member.name, member.size))
+                    oversized.append(member.name)
+                    continue
+                member.name = prefix + member.name
+                self._add(member, source.extractfile(member) if member.isfile() else None)
+        if oversized:
+            raise BuildContext.ContextException("files larger than {0} bytes (add them to .dockerignore): {1}".format(
+                self.max_file_size, ", ".join(oversized)))
+
+    def build(self):
+        """
+        Ends the context and waits for docker to build the image. Returns whether it succeeded
+        """
+        self._tar.close()
+        self._proc.stdin.close()
+        returncode = self._proc.wait()
+        print("Streamed {0} files ({1} bytes) to docker, built {2} in {3:.2f}s".format(
+            self.files, self.size, self.image_name, time.time() - self._start))
+        return returncode == 0
+
+    def abort(self):
+        # the tar stream isn't ended, since docker isn't reading it anymore
+        self._tar.closed = self._tar.fileobj.closed = True
+        try:
+            self._proc.kill()
+        except OSError:
+            pass
+        self._proc.wait()
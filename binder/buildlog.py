@@ -0,0 +1,221 @@
+import bisect
+import gzip
+import os
+import shutil
+import time
+from threading import Lock
+
+from binder.settings import BUILD_LOG_DIR, BUILD_LOG_SEGMENT_SIZE, BUILD_LOG_RING_SIZE, BUILD_LOG_MAX_SIZE, \
+    BUILD_LOG_IDLE_TIMEOUT
+from binder.utils import make_dir
+
+# the most bytes returned by a read
+READ_LIMIT = 64 * 1024
+# how often the logs still being written are checked for idle ones (in seconds)
+IDLE_CHECK_PERIOD = 60
+
+
+class BuildLog(object):
+    """
+    The output of one build, in a directory of segments named by the offset of their first byte:
+    full segments are gzipped (<offset>.gz) and the last one is appended to as is (<offset>.log). A
+    `done` file marks finished logs. The last ring_size bytes are also kept in memory, so that
+    readers following the build are served without touching the disk
+    """
+
+    DONE = "done"
+
+    def __init__(self, path, segment_size=BUILD_LOG_SEGMENT_SIZE, ring_size=BUILD_LOG_RING_SIZE,
+                 max_size=BUILD_LOG_MAX_SIZE):
+        self.path = path
+        self.segment_size = segment_size
+        self.ring_size = max(ring_size, segment_size)
+        self.max_size = max_size
+        self.updated = time.time()
+        make_dir(self.path)
+
+        # a log can be reopened, e.g. when the web API restarts during a build or a closed log gets
+        # more output, and isn't finished until it's closed again
+        done_path = os.path.join(self.path, BuildLog.DONE)
+        if os.path.exists(done_path):
+            os.remove(done_path)
+        segments = BuildLog._get_segments(self.path)
+        self._current = segments[-1][0] if segments and segments[-1][1].endswith(".log") else None
+        self.size = 0
+        if segments:
+            last_offset, last_name = segments[-1]
+            self.size = last_offset + len(BuildLog._read_segment(self.path, last_name))
+        self._ring = bytearray()
+
+    @staticmethod
+    def _get_segments(path):
+        """
+        Returns the [(offset, file name)] of the log's segments, in order
+        """
+        segments = {}
+        for f in os.listdir(path):
+            offset, ext = os.path.splitext(f)
+            # a segment is gzipped before its uncompressed copy is removed
+            if offset.isdigit() and (ext == ".gz" or (ext == ".log" and int(offset) not in segments)):
+                segments[int(offset)] = f
+        return sorted(segments.items())
+
+    @staticmethod
+    def _read_segment(path, name):
+        opener = gzip.open if name.endswith(".gz") else open
+        with opener(os.path.join(path, name), "rb") as segment:
+            return segment.read()
+
+    def _seal(self):
+        # gzips the current segment
+        name = "{:012d}".format(self._current)
+        tmp_path = os.path.join(self.path, name + ".gz.tmp")
+        with open(os.path.join(self.path, name + ".log"), "rb") as current:
+            with gzip.open(tmp_path, "wb") as segment:
+                shutil.copyfileobj(current, segment)
+        os.rename(tmp_path, os.path.join(self.path, name + ".gz"))
+        os.remove(os.path.join(self.path, name + ".log"))
+        self._current = None
+
+    def append(self, data):
+        if not data or self.size >= self.max_size:
+            return
+        if self.size + len(data) > self.max_size:
+            data = data[:self.max_size - self.size] + "\n[log truncated at {} bytes]\n".format(self.max_size)
+        if self._current is None:
+            self._current = self.size
+        with open(os.path.join(self.path, "{:012d}.log".format(self._current)), "ab") as current:
+            current.write(data)
+        self.size += len(data)
+        self.updated = time.time()
+        self._ring.extend(data)
+        del self._ring[:-self.ring_size]
+        if self.size - self._current >= self.segment_size:
+            self._seal()
+
+    def close(self):
+        if self._current is not None:
+            self._seal()
+        open(os.path.join(self.path, BuildLog.DONE), "w").close()
+
+    def read(self, offset, limit=READ_LIMIT):
+        ring_start = self.size - len(self._ring)
+        if offset >= ring_start:
+            return str(self._ring[offset - ring_start:offset - ring_start + limit])
+        return BuildLog.read_from_disk(self.path, offset, limit)["data"]
+
+    @staticmethod
+    def read_from_disk(path, offset, limit=READ_LIMIT):
+        """
+        Reads at most `limit` bytes of a log from `offset` on, within a single segment. Returns the
+        data and whether the log is finished
+        """
+        finished = os.path.exists(os.path.join(path, BuildLog.DONE))
+        segments = BuildLog._get_segments(path)
+        i = bisect.bisect_right([o for o, name in segments], offset) - 1
+        data = ""
+        if i >= 0:
+            start, name = segments[i]
+            try:
+                data = BuildLog._read_segment(path, name)[offset - start:offset - start + limit]
+            except IOError:
+                # the segment was just gzipped, the next read will find the gzipped copy
+                pass
+        return {"data": data, "finished": finished}
+
+
+class BuildLogStore(object):
+    """
+    The logs of all builds, by build ID. Build workers append to the logs of their builds (through
+    the broker when they're remote), and readers follow them by byte offset
+    """
+
+    # the singleton store
+    store = None
+
+    @staticmethod
+    def get_instance():
+        if not BuildLogStore.store:
+            BuildLogStore.store = BuildLogStore()
+        return BuildLogStore.store
+
+    def __init__(self, log_dir=BUILD_LOG_DIR, idle_timeout=BUILD_LOG_IDLE_TIMEOUT):
+        self.log_dir = log_dir
+        self.idle_timeout = idle_timeout
+        make_dir(self.log_dir)
+        self._lock = Lock()
+        # build ID -> BuildLog, for the logs still being written in this process
+        self._logs = {}
+        self._last_idle_check = time.time()
+
+    def _get_path(self, build_id):
+        # build IDs come from URLs, so only numbers are let through
+        return os.path.join(self.log_dir, str(int(build_id)))
+
+    def _close_idle(self):
+        # called with the lock held. The builds of idle logs are most likely gone, and their readers
+        # would wait on them forever
+        now = time.time()
+        if now - self._last_idle_check < IDLE_CHECK_PERIOD:
+            return
+        self._last_idle_check = now
+        for build_id, log in self._logs.items():
+            if now - log.updated >= self.idle_timeout:
+                log.append("\n[no output for {} seconds, log closed]\n".format(int(now - log.updated)))
+                log.close()
+                del self._logs[build_id]
+
+    def append(self, build_id, data, finished=False):
+        build_id = int(build_id)
+        with self._lock:
+            self._close_idle()
+            log = self._logs.get(build_id)
+            if not log:
+                log = self._logs[build_id] = BuildLog(self._get_path(build_id))
+            log.append(data)
+            if finished:
+                log.close()
+                del self._logs[build_id]
+            return log.size
+
+    def read(self, build_id, offset=0, limit=READ_LIMIT):
+        """
+        Returns {"data", "offset" (where the next read starts), "finished"}, or None if the build has
+        no log
+        """
+        build_id = int(build_id)
+        with self._lock:
+            self._close_idle()
+            log = self._logs.get(build_id)
+            if log:
+                data = log.read(offset, limit)
+                return {"data": data, "offset": offset + len(data), "finished": False}
+        path = self._get_path(build_id)
+        if not os.path.isdir(path):
+            return None
+        result = BuildLog.read_from_disk(path, offset, limit)
+        result["offset"] = offset + len(result["data"])
+        # the last bytes may have been written after the log was checked for a done file
+        result["finished"] = result["finished"] and not result["data"]
+        return result
+
+    def collect_garbage(self, max_age):
+        """
+        Removes the logs that haven't been written to for max_age days. Returns the number of
+        removed logs
+        """
+        cutoff = time.time() - max_age * 24 * 3600
+        removed = 0
+        with self._lock:
+            self._close_idle()
+            for build_id, log in self._logs.items():
+                if log.updated < cutoff:
+                    del self._logs[build_id]
+            for f in os.listdir(self.log_dir):
+                path = os.path.join(self.log_dir, f)
+                if f.isdigit() and int(f) not in self._logs and os.path.getmtime(path) < cutoff:
+                    shutil.rmtree(path)
+                    removed += 1
+        if removed:
+            print("Removed {} build logs".format(removed))
+        return removed
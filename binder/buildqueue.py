@@ -0,0 +1,240 @@
+import heapq
+import json
+import time
+import uuid
+from collections import deque
+
+from binder.db import get_connection, transaction
+from binder.settings import DB_PATH, BUILD_LEASE
+
+
+class BuildQueue(object):
+    """
+    A durable queue of build jobs in SQLite, so that pending and interrupted builds survive
+    restarts. Specs stay in the database until their job is claimed. Pending jobs of the same app
+    are coalesced into one, an app is never claimed twice at once, higher priorities go first and,
+    within a priority, the owner with the fewest running builds goes first (oldest submission
+    breaks ties). Claimed jobs are leased to a worker, which renews the lease until the job is
+    finished; jobs whose lease expires are requeued
+    """
+
+    PENDING = "pending"
+    RUNNING = "running"
+
+    # the singleton queue
+    queue = None
+
+    @staticmethod
+    def get_instance():
+        if not BuildQueue.queue:
+            BuildQueue.queue = BuildQueue()
+        return BuildQueue.queue
+
+    def __init__(self, db_path=DB_PATH):
+        self.db_path = db_path
+        get_connection(self.db_path).executescript("""
+            CREATE TABLE IF NOT EXISTS build_jobs (
+                id TEXT PRIMARY KEY,
+                app TEXT NOT NULL,
+                owner TEXT NOT NULL,
+                priority INTEGER NOT NULL,
+                submitted REAL NOT NULL,
+                coalesced INTEGER NOT NULL DEFAULT 0,
+                spec TEXT NOT NULL,
+                state TEXT NOT NULL,
+                started REAL
+            );
+            CREATE INDEX IF NOT EXISTS build_jobs_state ON build_jobs (state, app);
+        """)
+        # queues created before jobs were leased to workers
+        conn = get_connection(self.db_path)
+        columns = [row["name"] for row in conn.execute("PRAGMA table_info(build_jobs)")]
+        if "worker" not in columns:
+            conn.execute("ALTER TABLE build_jobs ADD COLUMN worker TEXT")
+            conn.execute("ALTER TABLE build_jobs ADD COLUMN lease_expires REAL")
+
+    @staticmethod
+    def _to_job(row, with_spec=True):
+        job = dict(row)
+        if with_spec:
+            job["spec"] = json.loads(job["spec"])
+        else:
+            job.pop("spec", None)
+        return job
+
+    def submit(self, spec, owner, priority=0):
+        """
+        Queues a build of the app in spec. If the app already has a pending job, the new spec
+        replaces its spec and the job keeps its place (moving up if priority is higher). Returns
+        the pending job (without its spec)
+        """
+        conn = get_connection(self.db_path)
+        with transaction(conn):
+            row = conn.execute("SELECT id FROM build_jobs WHERE app = ? AND state = ?",
+                               (spec["name"], BuildQueue.PENDING)).fetchone()
+            if row:
+                job_id = row["id"]
+                conn.execute("""
+                    UPDATE build_jobs SET spec = ?, priority = MAX(priority, ?), coalesced = coalesced + 1
+                    WHERE id = ?
+                """, (json.dumps(spec), priority, job_id))
+            else:
+                job_id = uuid.uuid4().hex
+                conn.execute("""
+                    INSERT INTO build_jobs (id, app, owner, priority, submitted, spec, state)
+                    VALUES (?, ?, ?, ?, ?, ?, ?)
+                """, (job_id, spec["name"], owner, priority, time.time(), json.dumps(spec), BuildQueue.PENDING))
+            row = conn.execute("SELECT * FROM build_jobs WHERE id = ?", (job_id,)).fetchone()
+        return BuildQueue._to_job(row, with_spec=False)
+
+    def _requeue(self, conn, condition, params):
+        """
+        Puts the running jobs matching condition back in the queue, unless their app has been
+        submitted again since (then the newer job replaces them). Returns the number of requeued jobs
+        """
+        params = dict(params, running=BuildQueue.RUNNING, pending=BuildQueue.PENDING)
+        conn.execute("""
+            DELETE FROM build_jobs WHERE state = :running AND {}
+                AND app IN (SELECT app FROM build_jobs WHERE state = :pending)
+        """.format(condition), params)
+        return conn.execute("""
+            UPDATE build_jobs SET state = :pending, started = NULL, worker = NULL, lease_expires = NULL
+            WHERE state = :running AND {}
+        """.format(condition), params).rowcount
+
+    def claim(self, worker, lease=BUILD_LEASE, max_running=None):
+        """
+        Leases the next job to worker for `lease` seconds and returns it (with its spec). Returns
+        None if the worker already runs max_running jobs or no pending job can run
+        """
+        now = time.time()
+        conn = get_connection(self.db_path)
+        with transaction(conn):
+            # every claim reclaims the jobs of workers that stopped renewing their leases
+            reclaimed = self._requeue(conn, "lease_expires < :now", {"now": now})
+            if reclaimed:
+                print("Reclaimed {} build jobs with expired leases".format(reclaimed))
+            if max_running is not None:
+                running = conn.execute("SELECT COUNT(*) FROM build_jobs WHERE state = ? AND worker = ?",
+                                       (BuildQueue.RUNNING, worker)).fetchone()[0]
+                if running >= max_running:
+                    return None
+            row = conn.execute("""
+                SELECT j.* FROM build_jobs j
+                LEFT JOIN (SELECT owner, COUNT(*) AS n FROM build_jobs WHERE state = :running GROUP BY owner) r
+                    ON r.owner = j.owner
+                WHERE j.state = :pending
+                    AND j.app NOT IN (SELECT app FROM build_jobs WHERE state = :running)
+                ORDER BY j.priority DESC, COALESCE(r.n, 0), j.submitted
+                LIMIT 1
+            """, {"running": BuildQueue.RUNNING, "pending": BuildQueue.PENDING}).fetchone()
+            if not row:
+                return None
+            conn.execute("UPDATE build_jobs SET state = ?, started = ?, worker = ?, lease_expires = ? WHERE id = ?",
+                         (BuildQueue.RUNNING, now, worker, now + lease, row["id"]))
+            row = conn.execute("SELECT * FROM build_jobs WHERE id = ?", (row["id"],)).fetchone()
+        return BuildQueue._to_job(row)
+
+    def heartbeat(self, job_id, worker, lease=BUILD_LEASE):
+        """
+        Renews the worker's lease on a job. Returns False if the job isn't leased to the worker
+        anymore (it should then stop building it)
+        """
+        conn = get_connection(self.db_path)
+        with transaction(conn):
+            renewed = conn.execute("""
+                UPDATE build_jobs SET lease_expires = ? WHERE id = ? AND worker = ? AND state = ?
+            """, (time.time() + lease, job_id, worker, BuildQueue.RUNNING)).rowcount
+        return renewed == 1
+
+    def finish(self, job_id, worker):
+        """
+        Removes a finished job, if it's still leased to the worker. Returns whether it was
+        """
+        conn = get_connection(self.db_path)
+        with transaction(conn):
+            return conn.execute("DELETE FROM build_jobs WHERE id = ? AND worker = ?", (job_id, worker)).rowcount == 1
+
+    def get_leased_job(self, job_id, worker):
+        """
+        Returns the job (without its spec) if it's running and leased to worker, and None otherwise
+        """
+        conn = get_connection(self.db_path)
+        row = conn.execute("SELECT * FROM build_jobs WHERE id = ? AND worker = ? AND state = ?",
+                           (job_id, worker, BuildQueue.RUNNING)).fetchone()
+        return BuildQueue._to_job(row, with_spec=False) if row else None
+
+    def requeue_running(self, worker):
+        """
+        Puts the jobs leased to a worker back in the queue (unless their app has been submitted
+        again since). Returns the number of requeued jobs
+        """
+        conn = get_connection(self.db_path)
+        with transaction(conn):
+            return self._requeue(conn, "worker = :worker", {"worker": worker})
+
+    def get_order(self):
+        """
+        Returns the pending jobs (without their specs) in the order they would be claimed in if no
+        other job were submitted or finished meanwhile
+        """
+        conn = get_connection(self.db_path)
+        owner_running = {}
+        running = set()
+        for row in conn.execute("SELECT app, owner FROM build_jobs WHERE state = ?", (BuildQueue.RUNNING,)):
+            running.add(row["app"])
+            owner_running[row["owner"]] = owner_running.get(row["owner"], 0) + 1
+        waiting = [dict(row) for row in conn.execute(
+            "SELECT id, app, owner, priority, submitted, coalesced FROM build_jobs WHERE state = ? "
+            "ORDER BY priority DESC, submitted", (BuildQueue.PENDING,))]
+
+        # rebuilds of running apps wait for the current builds to finish
+        blocked = [job for job in waiting if job["app"] in running]
+        owner_jobs = {}
+        for job in waiting:
+            if job["app"] not in running:
+                owner_jobs.setdefault(job["owner"], deque()).append(job)
+
+        def owner_key(owner):
+            head = owner_jobs[owner][0]
+            return (-head["priority"], owner_running.get(owner, 0), head["submitted"]), owner
+
+        # an owner's key only changes when one of its jobs is taken, so a heap of owners is enough
+        heap = [owner_key(owner) for owner in owner_jobs]
+        heapq.heapify(heap)
+        order = []
+        while heap:
+            key, owner = heapq.heappop(heap)
+            order.append(owner_jobs[owner].popleft())
+            owner_running[owner] = owner_running.get(owner, 0) + 1
+            if owner_jobs[owner]:
+                heapq.heappush(heap, owner_key(owner))
+        return order + blocked
+
+    def get_queued_apps(self):
+        """
+        Returns the names of the apps with a pending or running job
+        """
+        conn = get_connection(self.db_path)
+        return set(row["app"] for row in conn.execute("SELECT DISTINCT app FROM build_jobs"))
+
+    def get_running(self):
+        conn = get_connection(self.db_path)
+        return [dict(row) for row in conn.execute(
+            "SELECT id, app, owner, priority, submitted, started, worker, lease_expires FROM build_jobs "
+            "WHERE state = ? ORDER BY started", (BuildQueue.RUNNING,))]
+
+    def get_stats(self):
+        conn = get_connection(self.db_path)
+        counts = dict((row["state"], row["n"]) for row in conn.execute(
+            "SELECT state, COUNT(*) AS n FROM build_jobs GROUP BY state"))
+        by_owner = dict((row["owner"], row["n"]) for row in conn.execute(
+            "SELECT owner, COUNT(*) AS n FROM build_jobs WHERE state = ? GROUP BY owner", (BuildQueue.RUNNING,)))
+        by_worker = dict((row["worker"], row["n"]) for row in conn.execute(
+            "SELECT worker, COUNT(*) AS n FROM build_jobs WHERE state = ? GROUP BY worker", (BuildQueue.RUNNING,)))
+        return {
+            "pending": counts.get(BuildQueue.PENDING, 0),
+            "running": counts.get(BuildQueue.RUNNING, 0),
+            "running_by_owner": by_owner,
+            "running_by_worker": by_worker
+        }
@@ -0,0 +1,232 @@
+import bisect
+import time
+from contextlib import contextmanager
+
+from binder.db import get_connection, transaction
+from binder.settings import DB_PATH
+
+
+# upper bounds (in seconds) of the buckets of stage duration histograms
+HISTOGRAM_BUCKETS = [1, 5, 15, 30, 60, 120, 300, 600, 1800]
+
+
+class BuildStateStore(object):
+    """
+    Records every build of every app, with each build state transition and the timeline of its
+    stages, in SQLite. Any number of builder processes can record transitions at once, since each
+    one is its own transaction
+    """
+
+    BUILDING = "BUILDING"
+    FAILED = "FAILED"
+
+    # the singleton store
+    store = None
+
+    @staticmethod
+    def get_instance():
+        if not BuildStateStore.store:
+            BuildStateStore.store = BuildStateStore()
+        return BuildStateStore.store
+
+    def __init__(self, db_path=DB_PATH):
+        self.db_path = db_path
+        get_connection(self.db_path).executescript("""
+            CREATE TABLE IF NOT EXISTS builds (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                app TEXT NOT NULL,
+                state TEXT NOT NULL,
+                started REAL NOT NULL,
+                updated REAL NOT NULL,
+                finished REAL
+            );
+            CREATE INDEX IF NOT EXISTS builds_app ON builds (app, id);
+            CREATE INDEX IF NOT EXISTS builds_finished ON builds (finished);
+            CREATE INDEX IF NOT EXISTS builds_updated ON builds (updated);
+            CREATE TABLE IF NOT EXISTS build_transitions (
+                build_id INTEGER NOT NULL REFERENCES builds (id),
+                state TEXT NOT NULL,
+                time REAL NOT NULL,
+                -- time spent in the previous state
+                duration REAL
+            );
+            CREATE INDEX IF NOT EXISTS build_transitions_build ON build_transitions (build_id);
+            CREATE TABLE IF NOT EXISTS build_stages (
+                build_id INTEGER NOT NULL REFERENCES builds (id),
+                stage TEXT NOT NULL,
+                started REAL NOT NULL,
+                finished REAL NOT NULL,
+                -- "ok" or "failed"
+                status TEXT NOT NULL,
+                bytes INTEGER,
+                error TEXT
+            );
+            CREATE INDEX IF NOT EXISTS build_stages_build ON build_stages (build_id);
+            CREATE INDEX IF NOT EXISTS build_stages_started ON build_stages (started);
+        """)
+
+    def _get_latest(self, conn, app_name):
+        return conn.execute("SELECT * FROM builds WHERE app = ? ORDER BY id DESC LIMIT 1",
+                            (app_name,)).fetchone()
+
+    def record(self, app_name, state):
+        """
+        Records a state transition for the app's latest build, or starts a new build if the app is
+        now BUILDING. Every other state finishes the build. Returns the build's ID
+        """
+        now = time.time()
+        conn = get_connection(self.db_path)
+        with transaction(conn):
+            latest = self._get_latest(conn, app_name)
+            if state == BuildStateStore.BUILDING and latest and latest["state"] == BuildStateStore.BUILDING:
+                # an app is never built twice at once, so a build that is still BUILDING when the next
+                # one starts was stopped (or lost its lease) before recording its last state
+                conn.execute("UPDATE builds SET state = ?, updated = ?, finished = ? WHERE id = ?",
+                             (BuildStateStore.FAILED, now, now, latest["id"]))
+                conn.execute("INSERT INTO build_transitions (build_id, state, time, duration) VALUES (?, ?, ?, ?)",
+                             (latest["id"], BuildStateStore.FAILED, now, now - latest["updated"]))
+            if state == BuildStateStore.BUILDING or not latest:
+                cursor = conn.execute("INSERT INTO builds (app, state, started, updated) VALUES (?, ?, ?, ?)",
+                                      (app_name, state, now, now))
+                build_id, duration = cursor.lastrowid, None
+            else:
+                build_id, duration = latest["id"], now - latest["updated"]
+            finished = None if state == BuildStateStore.BUILDING else now
+            conn.execute("UPDATE builds SET state = ?, updated = ?, finished = ? WHERE id = ?",
+                         (state, now, finished, build_id))
+            conn.execute("INSERT INTO build_transitions (build_id, state, time, duration) VALUES (?, ?, ?, ?)",
+                         (build_id, state, now, duration))
+        return build_id
+
+    def get_state(self, app_name):
+        latest = self._get_latest(get_connection(self.db_path), app_name)
+        return latest["state"] if latest else None
+
+    def get_updates(self, since):
+        """
+        Returns {app name: state} for the apps whose latest build changed state since the `since`
+        timestamp
+        """
+        conn = get_connection(self.db_path)
+        # only an app's latest build is ever updated, so the last row of each app wins
+        return dict((row["app"], row["state"]) for row in conn.execute(
+            "SELECT app, state FROM builds WHERE updated >= ? ORDER BY updated, id", (since,)))
+
+    def get_build(self, build_id):
+        conn = get_connection(self.db_path)
+        build = conn.execute("SELECT * FROM builds WHERE id = ?", (build_id,)).fetchone()
+        if not build:
+            return None
+        build = dict(build)
+        build["transitions"] = [dict(t) for t in conn.execute(
+            "SELECT state, time, duration FROM build_transitions WHERE build_id = ? ORDER BY time",
+            (build_id,))]
+        build["stages"] = [dict(stage) for stage in conn.execute(
+            "SELECT stage, started, finished, status, bytes, error FROM build_stages WHERE build_id = ? ORDER BY started",
+            (build_id,))]
+        return build
+
+    def get_latest_id(self, app_name):
+        latest = self._get_latest(get_connection(self.db_path), app_name)
+        return latest["id"] if latest else None
+
+    def record_stage(self, build_id, stage, started, finished, status, nbytes=None, error=None):
+        conn = get_connection(self.db_path)
+        with transaction(conn):
+            conn.execute("""
+                INSERT INTO build_stages (build_id, stage, started, finished, status, bytes, error)
+                VALUES (?, ?, ?, ?, ?, ?, ?)
+            """, (build_id, stage, started, finished, status, nbytes, error))
+
+    @contextmanager
+    def time_stage(self, build_id, stage):
+        """
+        Records how long the block takes as a stage of the build, and whether it raised. The block
+        can set "bytes" in the dict it's given
+        """
+        info = {"bytes": None}
+        if build_id is None:
+            # builds aren't recorded here when the app index keeps build states in files
+            yield info
+            return
+        started = time.time()
+        try:
+            yield info
+        except Exception as e:
+            self.record_stage(build_id, stage, started, time.time(), "failed", info["bytes"], str(e))
+            raise
+        self.record_stage(build_id, stage, started, time.time(), "ok", info["bytes"])
+
+    def get_stage_stats(self, since):
+        """
+        Returns, for every stage of the builds started since the `since` timestamp, its number of
+        runs and failures, latency percentiles and a histogram of its durations
+        """
+        conn = get_connection(self.db_path)
+        durations = {}
+        failures = {}
+        for row in conn.execute("SELECT stage, finished - started AS seconds, status FROM build_stages WHERE started >= ?",
+                                (since,)):
+            durations.setdefault(row["stage"], []).append(row["seconds"])
+            if row["status"] != "ok":
+                failures[row["stage"]] = failures.get(row["stage"], 0) + 1
+        stats = {}
+        for stage, times in durations.items():
+            times.sort()
+            histogram = [0] * (len(HISTOGRAM_BUCKETS) + 1)
+            for seconds in times:
+                histogram[bisect.bisect_left(HISTOGRAM_BUCKETS, seconds)] += 1
+            stats[stage] = {
+                "count": len(times),
+                "failures": failures.get(stage, 0),
+                "total": sum(times),
+                "p50": times[int(round(0.5 * (len(times) - 1)))],
+                "p95": times[int(round(0.95 * (len(times) - 1)))],
+                "max": times[-1],
+                "buckets": HISTOGRAM_BUCKETS,
+                "histogram": histogram
+            }
+        return stats
+
+    def get_history(self, app_name, limit=10):
+        """
+        Returns the app's most recent builds, newest first, with their state transitions and stages
+        """
+        conn = get_connection(self.db_path)
+        ids = [row["id"] for row in conn.execute(
+            "SELECT id FROM builds WHERE app = ? ORDER BY id DESC LIMIT ?", (app_name, limit))]
+        return [self.get_build(build_id) for build_id in ids]
+
+    def get_apps_in_state(self, state):
+        """
+        Returns the names of all apps whose latest build is in the given state
+        """
+        conn = get_connection(self.db_path)
+        return [row["app"] for row in conn.execute("""
+            SELECT app FROM builds
+            WHERE id IN (SELECT MAX(id) FROM builds GROUP BY app) AND state = ?
+            ORDER BY app
+        """, (state,))]
+
+    def get_build_times(self, state, since):
+        """
+        Returns the durations (in seconds) of the builds that finished in the given state since the
+        `since` timestamp, shortest first
+        """
+        conn = get_connection(self.db_path)
+        return [row[0] for row in conn.execute("""
+            SELECT finished - started AS seconds FROM builds
+            WHERE finished >= ? AND state = ?
+            ORDER BY seconds
+        """, (since, state))]
+
+    def get_percentile(self, percentile, state, since):
+        """
+        Returns the given percentile (0-100) of the build times returned by get_build_times, or None
+        if there were no such builds
+        """
+        times = self.get_build_times(state, since)
+        if not times:
+            return None
+        index = int(round(percentile / 100.0 * (len(times) - 1)))
+        return times[index]
@@ -2,18 +2,24 @@ import json
 import os
 import re
 import shutil
+import socket
 import subprocess
 import time
-import requests
 from urlparse import urljoin
 from datetime import datetime, timedelta
+from multiprocessing.pool import ThreadPool
 from crontab import CronTab
 
 from memoized_property import memoized_property
 from multiprocess import Pool
 
-from binder.settings import ROOT, REGISTRY_NAME, DOCKER_HUB_USER, APP_CRON_PERIOD
-from binder.utils import fill_template_string, get_env_string
+from binder.settings import ROOT, REGISTRY_NAME, DOCKER_HUB_USER, NOTEBOOK_PORT,\
+    LAUNCH_TIMEOUT, LAUNCH_CHECK_PORT, SYSTEM_NAMESPACES, TEARDOWN_CONCURRENCY
+from binder.utils import fill_template_string
+from binder.kube import KubernetesClient
+from binder.inventory import ClusterInventory
+from binder.preload import ImagePreloader
+from binder.proxy import ProxyClient
 
 
 class ClusterManager(object):
@@ -50,6 +56,19 @@ class ClusterManager(object):
         """
         pass
 
+    def prestart_app(self, app_id, app_dir):
+        """
+        Deploys an app on the cluster without making it accessible. Returns the IP of the notebook
+        server once it's ready
+        """
+        pass
+
+    def route_app(self, app_id, ip):
+        """
+        Makes a prestarted app accessible. Returns the app's URL
+        """
+        pass
+
     def destroy_app(self, app_id):
         pass
 
@@ -71,33 +90,38 @@ class KubernetesManager(ClusterManager):
             print("Could not get Kubernetes home: {}".format(e))
             return None
 
+    @property
+    def client(self):
+        return KubernetesClient.get_instance()
+
+    @property
+    def inventory(self):
+        return ClusterInventory.get_instance()
+
+    @property
+    def proxy(self):
+        return ProxyClient.get_instance()
+
     def _generate_auth_token(self):
         return str(hash(time.time()))
 
     def _create(self, filename, namespace=None):
-        success = True
-        try:
-            cmd = ["kubectl.sh", "create", "-f", filename]
-            if namespace:
-                cmd.append('--namespace={0}'.format(namespace))
-            subprocess.check_call(cmd)
-        except subprocess.CalledProcessError as e:
-            print("Could not deploy specification: {0} on Kubernetes cluster: {1}".format(path, e))
-            success = False
+        with open(filename, 'r') as spec_file:
+            obj = json.load(spec_file)
+        success = self.client.create(obj, namespace=namespace)
+        if not success:
+            print("Could not deploy specification: {0} on Kubernetes cluster".format(filename))
         return success
 
     def __get_service_url(self, service_name):
-        try:
-            cmd = ["kubectl.sh", "describe", "service", service_name]
-            output = subprocess.check_output(cmd)
-            ip_re = re.compile("LoadBalancer Ingress:(?P<ip>.*)\n")
-            m = ip_re.search(output)
-            if not m:
-                print("Could not extract IP from service description")
-                return None
-            return m.group("ip").strip()
-        except subprocess.CalledProcessError as e:
+        service = self.client.get_service(service_name)
+        if not service:
+            return None
+        ingress = service.get("status", {}).get("loadBalancer", {}).get("ingress")
+        if not ingress:
+            print("Could not extract IP from service description")
             return None
+        return ingress[0].get("ip")
 
     def _get_proxy_url(self):
         return self.__get_service_url("proxy-registration")
@@ -109,33 +133,6 @@ class KubernetesManager(ClusterManager):
         #return self.__get_service_url("proxy-lookup")
         return ClusterManager.CLUSTER_HOST
 
-    def _get_pod_ip(self, app_id):
-        try:
-            cmd = ["kubectl.sh", "describe", "pod", "notebook-server", "--namespace={}".format(app_id)]
-            output = subprocess.check_output(cmd)
-            ip_re = re.compile("IP:(?P<ip>.*)\n")
-            ready_re = re.compile("State:\s+(?P<ready>.*)")
-            m = ip_re.search(output)
-            if not m:
-                print("Could not extract IP from pod description")
-                return None
-            return m.group("ip").strip()
-
-            # TODO the following code makes the above check safer (will prevent proxy errors) but is too slow
-            ready = ready_re.search(output)
-            if not ready:
-                print("Extracted the pod IP, but the notebook container is not ready")
-                return None 
-            else:
-                status = ready.group("ready").lower().strip()
-                print "status: {}".format(status)
-                if status != "running":
-                    print("Extracted the pod IP, but the notebook container is not ready")
-                    return None
-
-        except subprocess.CalledProcessError as e:
-            return None
-
     def _launch_registry_server(self):
         registry_path = os.path.join(ROOT, "registry")
 
@@ -169,21 +166,11 @@ class KubernetesManager(ClusterManager):
         # insert the notebooks container into the pod.json template
         for name in template_names:
             with open(os.path.join(deploy_path, name), 'w+') as p_file:
-                p_string = fill_template_string(templates[name], params)
+                p_string = fill_template_string(templates[name], params, name=name)
                 p_file.write(p_string)
             # launch each component
             self._create(os.path.join(deploy_path, name))
 
-    def _read_proxy_info(self):
-        with open(os.path.join(ROOT, ".proxy_info"), "r") as proxy_file:
-            raw_host, raw_token = proxy_file.readlines()
-            return "http://" + raw_host.strip() + "/api/routes", raw_token.strip()
-
-    def _write_proxy_info(self, url, token):
-        with open(os.path.join(ROOT, ".proxy_info"), "w+") as proxy_file:
-            proxy_file.write("{}\n".format(url))
-            proxy_file.write("{}\n".format(token))
-
     def _read_registry_url(self):
         with open(os.path.join(ROOT, ".registry_info"), "r") as registry_file:
             url = registry_file.readlines()[0]
@@ -197,67 +184,66 @@ class KubernetesManager(ClusterManager):
         now = datetime.utcnow()
         threshold = (now - timedelta(minutes=min_inactive)).isoformat()
 
-        base_url, token = self._read_proxy_info()
-        h = {"Authorization": "token {}".format(token)}
-        proxy_url = base_url + "?inactive_since={}".format(threshold)
-        print("proxy_url: {}".format(proxy_url))
-        try:
-            r = requests.get(proxy_url, headers=h)
-            if r.status_code == 200:
-                routes = r.json().keys()
-                return map(lambda r: r[1:], routes)
-        except requests.exceptions.ConnectionError:
+        routes = self.proxy.get_routes(inactive_since=threshold)
+        if routes is None:
             print("Could not get all routes inactive for {} minutes".format(min_inactive))
-        return None
+        return routes
 
     def _remove_proxy_route(self, app_id):
-        base_url, token = self._read_proxy_info()
-        h = {"Authorization": "token {}".format(token)}
-        proxy_url = base_url + "/" + app_id
-        try:
-            r = requests.delete(proxy_url, headers=h)
-            if r.status_code == 204:
-                print("Removed proxy route for {}".format(app_id))
+        return self.proxy.remove_route(app_id)
+
+    def _is_notebook_running(self, pod):
+        status = pod.get("status", {})
+        if status.get("phase") != "Running" or not status.get("podIP"):
+            return False
+        for container in status.get("containerStatuses", []):
+            if container["name"] == "notebook-server":
+                return "running" in container.get("state", {})
+        return False
+
+    def _wait_for_port(self, ip, port, deadline):
+        while time.time() < deadline:
+            try:
+                conn = socket.create_connection((ip, port), timeout=max(deadline - time.time(), 0.1))
+                conn.close()
                 return True
-        except requests.exceptions.ConnectionError:
-            print("Could not remove proxy route for {}".format(app_id))
+            except socket.error:
+                time.sleep(0.1)
         return False
 
-    def _register_proxy_route(self, app_id):
-        num_retries = 30
-        pause = 1
-        for i in range(num_retries):
-            # TODO should the notebook port be a parameter?
-            ip = self._get_pod_ip(app_id)
-            # TODO this is a stopgap solution for a race condition that should be fixed through other means
-            time.sleep(1)
-            if ip:
-                base_url, token = self._read_proxy_info()
-                body = {'target': "http://" + ip + ":8888"}
-                h = {"Authorization": "token {}".format(token)}
-                proxy_url = base_url + "/" + app_id
-                print("body: {}, headers: {}, proxy_url: {}".format(body, h, proxy_url))
-                try:
-                    r = requests.post(proxy_url, data=json.dumps(body), headers=h)
-                    if r.status_code == 201:
-                        print("Proxying {} to {}".format(proxy_url, ip + ":8888"))
-                        return True
-                    else:
-                        raise Exception("could not register route with proxy server")
-                except requests.exceptions.ConnectionError:
-                    pass
-            print("App not yet assigned an IP address. Waiting for {} seconds...".format(pause))
-            time.sleep(pause)
+    def _wait_for_notebook(self, app_id, timeout=LAUNCH_TIMEOUT):
+        """
+        Blocks until the notebook server of app_id is running and (if LAUNCH_CHECK_PORT is set)
+        accepting connections. Returns the pod's IP, or None if it isn't ready after `timeout` seconds
+        """
+        start = time.time()
+        ip = None
+        for pod in self.client.watch_pod("notebook-server", app_id, timeout):
+            if self._is_notebook_running(pod):
+                ip = pod["status"]["podIP"]
+                break
+        if not ip:
+            print("Notebook server for {0} not running after {1}s".format(app_id, timeout))
+            return None
+        if LAUNCH_CHECK_PORT and not self._wait_for_port(ip, NOTEBOOK_PORT, start + timeout):
+            print("Notebook server for {0} not accepting connections after {1}s".format(app_id, timeout))
+            return None
+        print("Notebook server for {0} ready after {1:.2f}s".format(app_id, time.time() - start))
+        return ip
 
-        return False
+    def _register_proxy_route(self, app_id, ip=None):
+        if not ip:
+            ip = self._wait_for_notebook(app_id)
+        if not ip:
+            return False
+        return self.proxy.add_route(app_id, "http://{0}:{1}".format(ip, NOTEBOOK_PORT))
 
     def get_running_apps(self):
-        try:
-            output = subprocess.check_output(['kubectl.sh', 'get', 'namespaces'])
-            return map(lambda line: line.split()[0], output.split('\n')[1:-1]) 
-        except subprocess.CalledProcessError as e:
-            print("Couldn't get running apps: {}".format(e))
-        return None
+        return self.inventory.get_running_apps()
+
+    def _get_node_names(self):
+        nodes = self.client.list_nodes()
+        return [node["metadata"]["name"] for node in nodes] if nodes else []
 
     def _nodes_command(self, func):
         provider = os.environ["KUBERNETES_PROVIDER"]
@@ -277,11 +263,7 @@ class KubernetesManager(ClusterManager):
             if not zone:
                 return False
 
-            nodes_cmd = ["kubectl.sh", "get", "nodes"]
-            output = subprocess.check_output(nodes_cmd)
-            nodes = output.split("\n")[1:]
-            
-            return [func(node, zone) for node in nodes]          
+            return [func(node, zone) for node in self._get_node_names()]
             
         elif provider == 'aws':
             # TODO support aws
@@ -292,40 +274,22 @@ class KubernetesManager(ClusterManager):
             return []
 
     def get_total_capacity(self):
-        def _get_capacity(node, zone):
-            pod_re = re.compile(".*pods:\s+(?P<pods>\d+)")
-            split = node.split()
-            if len(split) > 0:
-                node_name = split[0]
-                cmd = ['kubectl.sh', 'describe', 'node', node_name]
-                output_lines = subprocess.check_output(cmd).split('\n')
-                match_lines = [pod_re.search(l) for l in output_lines if pod_re.search(l)]
-                if match_lines:
-                    return int(match_lines[0].group('pods'))
-                return 0
-            return 0
-        caps = self._nodes_command(_get_capacity)
-        return sum(caps)
-           
+        return self.inventory.get_total_capacity()
+
+    def get_allocated_pods(self):
+        return self.inventory.get_allocated_pods()
+
+    def preload_images(self, image_names):
+        nodes = self._nodes_command(lambda node_name, zone: (node_name, zone))
+        if not nodes:
+            print("Could not find any nodes to preload images onto")
+            return False
+        nodes = [(node_name, zone) for node_name, zone in nodes if node_name != "kubernetes-master"]
+        report = ImagePreloader.get_instance().preload(image_names, nodes)
+        return report["failed"] == 0
+
     def preload_image(self, image_name):
-        def _preload(node, zone):
-            split = node.split()
-            if len(split) > 0:
-                node_name = split[0]
-                if node_name != "kubernetes-master":
-                    print("Preloading {0} onto {1}...".format(image_name, node_name))
-                    docker_cmd = "sudo docker pull {0}/{1}".format(REGISTRY_NAME, image_name)
-                    cmd = ["gcloud", "compute", "ssh", node_name, "--zone", zone,
-                           "--command", "{}".format(docker_cmd)]
-                    return subprocess.Popen(cmd)
-            return None
-        procs = self._nodes_command(_preload)
-        print("Waiting for preloading to finish...")
-        for proc in procs:
-            if proc:
-                proc.wait()
-        print("Preloaded image {} onto all nodes".format(image_name))
-        return True
+        return self.preload_images([image_name])
 
     def _start_proxy_server(self):
         token = self._generate_auth_token()
@@ -338,7 +302,7 @@ class KubernetesManager(ClusterManager):
             if proxy_url:
                 print("proxy_url: {}".format(proxy_url))
                 # record the proxy url and auth token
-                self._write_proxy_info(proxy_url, token)
+                self.proxy.write_info(proxy_url, token)
                 break
         if not proxy_url:
             print("Could not obtain the proxy server's URL. Cluster launch unsuccessful")
@@ -394,14 +358,7 @@ class KubernetesManager(ClusterManager):
             print("Preloading binder-base image onto all nodes...")
             success = success and self.preload_image("binder-base")
 
-            # start the inactive app removal cron job
-            cron = CronTab()
-            cmd = " ".join([get_env_string(), os.path.join(ROOT, "util", "stop-inactive-apps"),
-                            "&>/tmp/binder-cron"])
-            job = cron.new(cmd, comment="binder-stop")
-            job.minute.every(APP_CRON_PERIOD)
-            job.enable(True)
-            cron.write_to_user(user=True)
+            # inactive apps are stopped by the culler (run by the web API or `binder cluster cull`)
 
         except subprocess.CalledProcessError as e:
             success = False
@@ -417,7 +374,7 @@ class KubernetesManager(ClusterManager):
             os.environ["KUBERNETES_PROVIDER"] = provider
             subprocess.check_call(['kube-down.sh'])
 
-            # start the inactive app removal cron job
+            # remove the inactive app removal cron job installed by older versions
             cron = CronTab()
             jobs = cron.find_comment("binder-stop")
             for job in jobs:
@@ -434,56 +391,104 @@ class KubernetesManager(ClusterManager):
     def list_apps(self):
         pass
 
-    def deploy_app(self, app_id, app_dir):
-        success = True
+    def _create_app(self, app_id, app_dir):
+        objects = []
+        for f in os.listdir(app_dir):
+            with open(os.path.join(app_dir, f), 'r') as spec_file:
+                objects.append(json.load(spec_file))
 
-        # first create a namespace for the app
-        success = self._create(os.path.join(app_dir, "namespace.json"))
+        # the namespace and all other components in the new namespace are submitted together
+        start = time.time()
+        results = self.client.apply(objects, namespace=app_id)
+        self.inventory.add_app(app_id)
+        print("Deployment of {0} submitted in {1:.2f}s:".format(app_id, time.time() - start))
+        for result in results:
+            status = "created" if result["created"] else "failed ({})".format(result["error"])
+            print("  {0} {1}: {2}".format(result["kind"], result["name"], status))
 
-        # now launch all other components in the new namespace
-        for f in os.listdir(app_dir):
-            if f != "namespace.json":
-                path = os.path.join(app_dir, f)
-                success = success and self._create(path, namespace=app_id)
-                if not success:
-                    print("Could not deploy {0} on Kubernetes cluster".format(path))
+        return all([result["created"] for result in results])
+
+    def _get_app_url(self, app_id):
+        lookup_url = self._get_lookup_url()
+        app_url = urljoin("http://" + lookup_url, app_id)
+        print("Access app at: \n   {}".format(app_url))
+        return app_url
+
+    def deploy_app(self, app_id, app_dir):
+        success = self._create_app(app_id, app_dir)
 
         # create a route in the proxy
         success = success and self._register_proxy_route(app_id)
         if not success:
             return None
 
-        lookup_url = self._get_lookup_url()
-        app_url = urljoin("http://" + lookup_url, app_id)
-        print("Access app at: \n   {}".format(app_url))
-        return app_url
+        return self._get_app_url(app_id)
+
+    def prestart_app(self, app_id, app_dir):
+        if not self._create_app(app_id, app_dir):
+            return None
+        return self._wait_for_notebook(app_id)
+
+    def route_app(self, app_id, ip):
+        # the notebook server might have gone away since it was prestarted
+        if LAUNCH_CHECK_PORT and not self._wait_for_port(ip, NOTEBOOK_PORT, time.time() + 1):
+            print("Prestarted notebook server for {} is not accepting connections".format(app_id))
+            return None
+        if not self._register_proxy_route(app_id, ip):
+            return None
+        return self._get_app_url(app_id)
 
     def stop_app(self, app_id):
-        if app_id == "kube-system":
+        if app_id in SYSTEM_NAMESPACES:
             return 
-        try:
-            stop_cmd = ["kubectl.sh", "stop", "pods,services,replicationControllers", "--all",
-                   "--namespace={}".format(app_id)]
-            cleanup_cmd = ["kubectl.sh", "delete", "namespace", app_id]
-            subprocess.check_call(stop_cmd)
-            subprocess.check_call(cleanup_cmd)
+        if self._delete_app(app_id):
             self._remove_proxy_route(app_id)
             print("Stopped app {}".format(app_id))
-        except subprocess.CalledProcessError as e:
+        else:
             print("Could not stop app {}".format(app_id))
 
-    def _stop_apps(self, app_ids):
+    def _delete_app(self, app_id):
+        if self.client.delete_namespace(app_id):
+            self.inventory.remove_app(app_id)
+            return True
+        return False
+
+    def stop_apps(self, app_ids, parallelism=TEARDOWN_CONCURRENCY):
+        """
+        Stops many apps at once. All of their proxy routes are removed first, so that users stop
+        being sent to apps that are going away, then their namespaces are deleted concurrently.
+        Returns a report of the teardown
+        """
+        app_ids = [app_id for app_id in (app_ids or []) if app_id not in SYSTEM_NAMESPACES]
+        report = {"stopped": [], "failed": [], "seconds": 0}
         if not app_ids:
             print("No apps to stop")
-            return
-        for app_id in app_ids:
-            self.stop_app(app_id)
+            return report
+
+        start = time.time()
+        workers = ThreadPool(min(parallelism, len(app_ids)))
+        try:
+            self.proxy.remove_routes(app_ids)
+            routes_removed = time.time() - start
+            deleted = workers.map(self._delete_app, app_ids)
+        finally:
+            workers.close()
+
+        report["stopped"] = [app_id for app_id, ok in zip(app_ids, deleted) if ok]
+        report["failed"] = [app_id for app_id, ok in zip(app_ids, deleted) if not ok]
+        report["seconds"] = time.time() - start
+        print("Stopped {0} apps in {1:.2f}s ({2:.1f} apps/s, routes removed after {3:.2f}s)".format(
+              len(report["stopped"]), report["seconds"], len(report["stopped"]) / max(report["seconds"], 0.001),
+              routes_removed))
+        for app_id in report["failed"]:
+            print("Could not stop app {}".format(app_id))
+        return report
 
     def stop_inactive_apps(self, min_inactive):
         routes = self._get_inactive_routes(min_inactive)
-        self._stop_apps(routes)
+        return self.stop_apps(routes)
 
     def stop_all_apps(self):
         app_ids = self.get_running_apps()
-        self._stop_apps(app_ids)
+        return self.stop_apps(app_ids)
 
@@ -0,0 +1,224 @@
+import multiprocessing
+import os
+import subprocess
+import time
+from threading import Thread
+
+from binder.db import get_connection, transaction
+from binder.settings import DB_PATH, BUILD_CONCURRENCY_FLOOR, BUILD_CONCURRENCY_PERIOD, BUILD_MAX_LOAD, \
+    BUILD_MAX_IOWAIT, BUILD_MIN_FREE_DISK, BUILD_MAX_DOCKER_LATENCY, DOCKER_ROOT
+
+
+class HostLoad(object):
+    """
+    Measures how loaded the host is. Every measure is None where it can't be taken. The docker
+    latency is measured in the background, and lags one measure behind
+    """
+
+    def __init__(self, docker_root=DOCKER_ROOT):
+        self.docker_root = docker_root
+        self._cpu_times = None
+        self._docker_latency = None
+        self._probe = None
+        self._probe_started = None
+
+    def _get_load(self):
+        try:
+            return os.getloadavg()[0] / multiprocessing.cpu_count()
+        except OSError:
+            return None
+
+    def _get_iowait(self):
+        # the fraction of CPU time spent in iowait since the last measure
+        try:
+            with open("/proc/stat") as stat_file:
+                times = [int(t) for t in stat_file.readline().split()[1:]]
+        except (IOError, ValueError):
+            return None
+        previous, self._cpu_times = self._cpu_times, times
+        if not previous or len(times) < 5:
+            return None
+        total = sum(times) - sum(previous)
+        return float(times[4] - previous[4]) / total if total > 0 else 0.0
+
+    def _get_free_disk(self):
+        path = self.docker_root if os.path.exists(self.docker_root) else "/"
+        stat = os.statvfs(path)
+        return stat.f_bavail * stat.f_frsize
+
+    def _time_docker(self):
+        # a hung daemon counts as twice the max latency, rather than hanging the probe with it
+        start = time.time()
+        latency = None
+        with open(os.devnull, "w") as devnull:
+            try:
+                proc = subprocess.Popen(["docker", "version"], stdout=devnull, stderr=devnull)
+            except OSError:
+                # docker isn't installed
+                proc = None
+            while proc and proc.poll() is None:
+                if time.time() - start > 2 * BUILD_MAX_DOCKER_LATENCY:
+                    proc.kill()
+                    proc.wait()
+                    latency = time.time() - start
+                    break
+                time.sleep(0.05)
+        if proc and latency is None and proc.returncode == 0:
+            latency = time.time() - start
+        self._docker_latency = latency
+
+    def _get_docker_latency(self):
+        # the daemon is probed in a thread of its own, so that a slow daemon doesn't hold up the
+        # worker's heartbeats. This returns the latency of the last probe, or how long the running
+        # probe has been waiting if that's longer
+        now = time.time()
+        if self._probe and self._probe.is_alive():
+            waiting = now - self._probe_started
+            return max(self._docker_latency, waiting) if self._docker_latency is not None else waiting
+        self._probe = Thread(target=self._time_docker)
+        self._probe.daemon = True
+        self._probe_started = now
+        self._probe.start()
+        return self._docker_latency
+
+    def measure(self):
+        return {
+            "load": self._get_load(),
+            "iowait": self._get_iowait(),
+            "free_disk": self._get_free_disk(),
+            "docker_latency": self._get_docker_latency()
+        }
+
+
+class AdaptiveConcurrency(object):
+    """
+    Adapts how many builds a worker runs at once to the load of its host, between floor and
+    ceiling. The limit goes up by one after every period in which all its slots were busy and the
+    host kept up, and is halved as soon as the host is overloaded. Every period is recorded with
+    the builds completed during it, so throughput can be compared across concurrency levels. Periods
+    are recorded in the database by default, or passed to `record` (e.g. to send them to a broker)
+    """
+
+    def __init__(self, worker, ceiling, floor=BUILD_CONCURRENCY_FLOOR, period=BUILD_CONCURRENCY_PERIOD,
+                 host_load=None, db_path=DB_PATH, record=None):
+        self.worker = worker
+        self.ceiling = ceiling
+        self.floor = min(floor, ceiling)
+        self.period = period
+        self.host_load = host_load or HostLoad()
+        self.record = record or (lambda p: AdaptiveConcurrency.record_period(p, db_path))
+        # start with a build per CPU, and let the load decide from there
+        self.limit = max(self.floor, min(self.ceiling, multiprocessing.cpu_count()))
+
+        self._period_start = time.time()
+        self._peak = 0
+        self._completed = 0
+        # the first iowait measure only sets its baseline (and docker's is taken in the background)
+        self.host_load.measure()
+
+    @staticmethod
+    def _create_tables(db_path):
+        get_connection(db_path).executescript("""
+            CREATE TABLE IF NOT EXISTS build_concurrency (
+                time REAL NOT NULL,
+                worker TEXT NOT NULL,
+                concurrency INTEGER NOT NULL,
+                seconds REAL NOT NULL,
+                -- the most builds running at once during the period
+                peak INTEGER NOT NULL,
+                completed INTEGER NOT NULL,
+                load REAL,
+                iowait REAL,
+                free_disk INTEGER,
+                docker_latency REAL
+            );
+            CREATE INDEX IF NOT EXISTS build_concurrency_time ON build_concurrency (time);
+        """)
+
+    @staticmethod
+    def record_period(period, db_path=DB_PATH):
+        """
+        Records a period: its time, worker, concurrency, seconds, peak and completed builds, along
+        with the host's measures (see HostLoad.measure)
+        """
+        AdaptiveConcurrency._create_tables(db_path)
+        conn = get_connection(db_path)
+        with transaction(conn):
+            conn.execute("""
+                INSERT INTO build_concurrency (time, worker, concurrency, seconds, peak, completed, load, iowait,
+                    free_disk, docker_latency)
+                VALUES (:time, :worker, :concurrency, :seconds, :peak, :completed, :load, :iowait, :free_disk,
+                    :docker_latency)
+            """, period)
+
+    @staticmethod
+    def get_overload(measures):
+        """
+        Returns the reasons the host is overloaded (an empty list if it isn't)
+        """
+        limits = [("load", BUILD_MAX_LOAD), ("iowait", BUILD_MAX_IOWAIT),
+                  ("docker_latency", BUILD_MAX_DOCKER_LATENCY)]
+        reasons = ["{0} {1:.2f} > {2}".format(name, measures[name], limit) for name, limit in limits
+                   if measures[name] is not None and measures[name] > limit]
+        if measures["free_disk"] is not None and measures["free_disk"] < BUILD_MIN_FREE_DISK:
+            reasons.append("free disk {0} < {1}".format(measures["free_disk"], BUILD_MIN_FREE_DISK))
+        return reasons
+
+    def build_finished(self):
+        self._completed += 1
+
+    def update(self, running):
+        """
+        Called with the number of running builds every time the worker checks for work. Once a
+        period is over, records it and adjusts the limit. Returns the limit
+        """
+        self._peak = max(self._peak, running)
+        now = time.time()
+        if now - self._period_start < self.period:
+            return self.limit
+
+        measures = self.host_load.measure()
+        period = dict(measures, time=now, worker=self.worker, concurrency=self.limit,
+                      seconds=now - self._period_start, peak=self._peak, completed=self._completed)
+        self.record(period)
+
+        overload = AdaptiveConcurrency.get_overload(measures)
+        if overload:
+            limit = max(self.floor, self.limit // 2)
+            if limit != self.limit:
+                print("Host overloaded ({0}), running at most {1} builds".format(", ".join(overload), limit))
+            self.limit = limit
+        elif self._peak >= self.limit and self.limit < self.ceiling:
+            self.limit += 1
+            print("Host keeping up, running at most {} builds".format(self.limit))
+
+        self._period_start = now
+        self._peak = running
+        self._completed = 0
+        return self.limit
+
+    @staticmethod
+    def get_throughput(since, worker=None, db_path=DB_PATH):
+        """
+        Returns, for every concurrency level used since the `since` timestamp, how long workers ran
+        at it and how many builds they completed per hour. Only the periods in which all slots were
+        busy count towards the throughput, since the others measure demand rather than capacity
+        """
+        AdaptiveConcurrency._create_tables(db_path)
+        conn = get_connection(db_path)
+        query = """
+            SELECT concurrency, SUM(seconds) AS seconds, SUM(completed) AS completed,
+                SUM(CASE WHEN peak >= concurrency THEN seconds ELSE 0 END) AS busy_seconds,
+                SUM(CASE WHEN peak >= concurrency THEN completed ELSE 0 END) AS busy_completed,
+                AVG(load) AS load, AVG(iowait) AS iowait, AVG(docker_latency) AS docker_latency
+            FROM build_concurrency WHERE time >= ? {}
+            GROUP BY concurrency ORDER BY concurrency
+        """.format("AND worker = ?" if worker else "")
+        params = (since, worker) if worker else (since,)
+        levels = []
+        for row in conn.execute(query, params):
+            level = dict(row)
+            busy_completed = level.pop("busy_completed")
+            level["builds_per_hour"] = busy_completed * 3600.0 / level["busy_seconds"] if level["busy_seconds"] else None
+            levels.append(level)
+        return levels
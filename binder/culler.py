@@ -0,0 +1,72 @@
+import time
+from collections import deque
+from threading import Thread, Event
+
+from binder.settings import CULL_INACTIVE, CULL_PERIOD, CULL_HISTORY
+from binder.cluster import ClusterManager
+
+
+class Culler(Thread):
+    """
+    Periodically stops apps that have been inactive for too long. Runs inside the web API process,
+    or on its own through `binder cluster cull`. Sweeps find and remove proxy routes through the
+    manager's ProxyClient, so they share its keep-alive connections with launches
+    """
+
+    # the singleton culler
+    culler = None
+
+    @staticmethod
+    def get_instance():
+        if not Culler.culler:
+            Culler.culler = Culler()
+        return Culler.culler
+
+    def __init__(self, inactive=CULL_INACTIVE, period=CULL_PERIOD):
+        super(Culler, self).__init__()
+        self.daemon = True
+
+        # both in minutes
+        self.inactive = inactive
+        self.period = period
+
+        self._wakeup = Event()
+        self._stopped = False
+
+        self.total_culled = 0
+        self.sweeps = deque(maxlen=CULL_HISTORY)
+
+    def sweep(self):
+        start = time.time()
+        report = ClusterManager.get_instance().stop_inactive_apps(self.inactive)
+        sweep = {
+            "time": start,
+            "culled": len(report["stopped"]),
+            "failed": len(report["failed"]),
+            "seconds": time.time() - start
+        }
+        self.total_culled += sweep["culled"]
+        self.sweeps.append(sweep)
+        print("Culled {0} apps inactive for {1} minutes in {2:.2f}s".format(sweep["culled"], self.inactive,
+              sweep["seconds"]))
+        return sweep
+
+    def get_stats(self):
+        return {
+            "inactive": self.inactive,
+            "period": self.period,
+            "total_culled": self.total_culled,
+            "sweeps": list(self.sweeps)
+        }
+
+    def stop(self):
+        self._stopped = True
+        self._wakeup.set()
+
+    def run(self):
+        while not self._stopped:
+            try:
+                self.sweep()
+            except Exception as e:
+                print("Error while culling inactive apps: {}".format(e))
+            self._wakeup.wait(self.period * 60)
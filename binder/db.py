@@ -0,0 +1,42 @@
+import os
+import sqlite3
+import threading
+from contextlib import contextmanager
+
+from binder.settings import DB_PATH, DB_TIMEOUT
+
+_local = threading.local()
+
+
+def get_connection(path=DB_PATH):
+    """
+    Returns a connection to the SQLite database at path. Connections are never shared between
+    threads or processes, so every (process, thread) pair gets its own
+    """
+    if getattr(_local, "pid", None) != os.getpid():
+        # a forked process inherits the connections of the thread that forked it
+        _local.connections = {}
+        _local.pid = os.getpid()
+    if path not in _local.connections:
+        # transactions are started explicitly (see `transaction`)
+        conn = sqlite3.connect(path, timeout=DB_TIMEOUT, isolation_level=None)
+        conn.row_factory = sqlite3.Row
+        # lets readers proceed while another process is writing
+        conn.execute("PRAGMA journal_mode=WAL")
+        _local.connections[path] = conn
+    return _local.connections[path]
+
+
+@contextmanager
+def transaction(conn):
+    """
+    Runs a block of statements as a single write transaction. The write lock is taken up front, so
+    concurrent writers wait for each other (up to DB_TIMEOUT seconds) instead of failing midway
+    """
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        yield conn
+    except:
+        conn.execute("ROLLBACK")
+        raise
+    conn.execute("COMMIT")
@@ -0,0 +1,178 @@
+import fcntl
+import hashlib
+import os
+import re
+import shutil
+import subprocess
+import tempfile
+import time
+from contextlib import contextmanager
+
+from binder.db import get_connection, transaction
+from binder.settings import ROOT, DB_PATH, DEPS_DIR, DEPS_IMAGE_NAME, DEPS_GC_AGE, WHEELHOUSE_URL
+from binder.utils import make_dir
+from binder.wheelhouse import Wheelhouse
+
+
+class DepsImages(object):
+    """
+    Builds one "deps" image (the base image plus an app's pip requirements) for every distinct set
+    of requirements, so that apps with the same requirements share their dependency layers
+    """
+
+    # the singleton manager
+    manager = None
+
+    @staticmethod
+    def get_instance():
+        if not DepsImages.manager:
+            DepsImages.manager = DepsImages()
+        return DepsImages.manager
+
+    class BuildFailedException(Exception):
+        pass
+
+    def __init__(self, deps_dir=DEPS_DIR, db_path=DB_PATH):
+        self.deps_dir = deps_dir
+        self.db_path = db_path
+        make_dir(self.deps_dir)
+        get_connection(self.db_path).executescript("""
+            CREATE TABLE IF NOT EXISTS deps_images (
+                hash TEXT PRIMARY KEY,
+                image TEXT NOT NULL,
+                created REAL NOT NULL,
+                used REAL NOT NULL
+            );
+            -- the deps image each app was last built on
+            CREATE TABLE IF NOT EXISTS deps_usage (
+                app TEXT PRIMARY KEY,
+                hash TEXT NOT NULL,
+                used REAL NOT NULL
+            );
+        """)
+
+    @staticmethod
+    def _normalize(requirements):
+        lines = []
+        for line in requirements.splitlines():
+            # "#" only starts a comment at the start of a line or after whitespace (URLs have #egg=...)
+            line = re.sub(r"(^|\s)#.*$", "", line).strip()
+            if line:
+                lines.append(line)
+        return sorted(set(lines))
+
+    def _get_image_id(self, image):
+        try:
+            return subprocess.check_output(["docker", "inspect", "--format", "{{.Id}}", image]).strip()
+        except subprocess.CalledProcessError:
+            return None
+
+    @contextmanager
+    def _lock(self, deps_hash):
+        with open(os.path.join(self.deps_dir, deps_hash + ".lock"), "w+") as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def get_hash(self, requirements, base_image):
+        """
+        Returns the hash of a set of requirements installed on top of the local base image
+        """
+        digest = hashlib.sha256()
+        digest.update((self._get_image_id(base_image) or base_image) + "\0")
+        digest.update("\n".join(DepsImages._normalize(requirements)))
+        return digest.hexdigest()
+
+    def _build(self, image, requirements, base_image):
+        requirements = DepsImages._normalize(requirements)
+        # the wheelhouse is only an optimization, pip falls back to PyPI for any missing wheel
+        Wheelhouse.get_instance().populate(requirements, base_image)
+        build_path = tempfile.mkdtemp(dir=self.deps_dir)
+        try:
+            with open(os.path.join(build_path, "requirements.txt"), "w+") as req_file:
+                req_file.write("\n".join(requirements) + "\n")
+            with open(os.path.join(build_path, "Dockerfile"), "w+") as df:
+                df.write("FROM {}\n".format(base_image))
+                df.write("\n")
+                df.write("ADD requirements.txt requirements.txt\n")
+                for python, pip in sorted(Wheelhouse.PIPS.items()):
+                    df.write("RUN {0} install --find-links {1}/{2}/ -r requirements.txt\n".format(pip, WHEELHOUSE_URL,
+                                                                                                 python))
+            subprocess.check_call(["docker", "build", "-t", image, build_path])
+            print("Squashing and pushing {} to private registry...".format(image))
+            subprocess.check_call([os.path.join(ROOT, "util", "squash-and-push"), image])
+        except subprocess.CalledProcessError as e:
+            raise DepsImages.BuildFailedException("could not build deps image {0}: {1}".format(image, e))
+        finally:
+            shutil.rmtree(build_path)
+
+    def get_image(self, app_name, requirements, base_image):
+        """
+        Returns the deps image for the requirements, building it if this is the first app that needs
+        them. Builds of the same deps image in other processes are waited for, not repeated
+        """
+        deps_hash = self.get_hash(requirements, base_image)
+        image = "{0}:{1}".format(DEPS_IMAGE_NAME, deps_hash[:16])
+        conn = get_connection(self.db_path)
+        with self._lock(deps_hash):
+            built = conn.execute("SELECT 1 FROM deps_images WHERE hash = ?", (deps_hash,)).fetchone()
+            if built and self._get_image_id(image):
+                print("Reusing deps image {}".format(image))
+            else:
+                print("Building deps image {}...".format(image))
+                self._build(image, requirements, base_image)
+            now = time.time()
+            with transaction(conn):
+                conn.execute("INSERT OR IGNORE INTO deps_images (hash, image, created, used) VALUES (?, ?, ?, ?)",
+                             (deps_hash, image, now, now))
+                conn.execute("UPDATE deps_images SET used = ? WHERE hash = ?", (now, deps_hash))
+                conn.execute("INSERT OR REPLACE INTO deps_usage (app, hash, used) VALUES (?, ?, ?)",
+                             (app_name, deps_hash, now))
+        return image
+
+    def release(self, app_name):
+        """
+        Records that the app isn't built on a deps image anymore
+        """
+        conn = get_connection(self.db_path)
+        with transaction(conn):
+            conn.execute("DELETE FROM deps_usage WHERE app = ?", (app_name,))
+
+    def get_usage(self):
+        """
+        Returns every deps image with the number of apps currently built on it
+        """
+        conn = get_connection(self.db_path)
+        return [dict(row) for row in conn.execute("""
+            SELECT d.hash, d.image, d.created, d.used, COUNT(u.app) AS apps
+            FROM deps_images d LEFT JOIN deps_usage u ON u.hash = d.hash
+            GROUP BY d.hash ORDER BY apps DESC
+        """)]
+
+    def collect_garbage(self, max_age=DEPS_GC_AGE):
+        """
+        Removes the deps images that no app is built on anymore and that haven't been used for
+        max_age days. Returns the removed images
+        """
+        cutoff = time.time() - max_age * 24 * 3600
+        removed = []
+        for deps in self.get_usage():
+            if deps["apps"] or deps["used"] >= cutoff:
+                continue
+            # an app being built on the image holds its lock, and might have started using it since
+            with self._lock(deps["hash"]):
+                conn = get_connection(self.db_path)
+                if conn.execute("SELECT 1 FROM deps_images WHERE hash = ? AND used >= ?",
+                                (deps["hash"], cutoff)).fetchone():
+                    continue
+                if self._get_image_id(deps["image"]):
+                    if subprocess.call(["docker", "rmi", deps["image"]]) != 0:
+                        print("Could not remove deps image {}".format(deps["image"]))
+                        continue
+                with transaction(conn):
+                    conn.execute("DELETE FROM deps_images WHERE hash = ?", (deps["hash"],))
+            removed.append(deps["image"])
+        print("Removed {0} unused deps images".format(len(removed)))
+        return removed
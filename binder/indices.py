@@ -2,7 +2,11 @@ import json
 import os
 import tempfile
 import shutil
+from threading import Lock
 
+from binder.buildstate import BuildStateStore
+from binder.db import get_connection, transaction
+from binder.settings import APP_INDEX, DB_PATH
 from binder.utils import make_dir
 
 
@@ -16,19 +20,32 @@ class AppIndex(object):
     @staticmethod
     def get_index(*args, **kwargs):
         if not AppIndex._singleton:
-            AppIndex._singleton = FileAppIndex(*args, **kwargs)
+            if APP_INDEX == "sqlite":
+                AppIndex._singleton = SQLiteAppIndex(*args, **kwargs)
+            else:
+                AppIndex._singleton = FileAppIndex(*args, **kwargs)
         return AppIndex._singleton
 
+    def __init__(self):
+        self._listeners = []
+
     def create(self, spec):
         pass
 
-    def get_app(self):
+    def find_apps(self):
+        pass
+
+    def get_app(self, name):
         pass
 
     def make_app_path(self, app):
         pass
 
     def update_build_state(self, app, state):
+        """
+        Records the app's new build state. Returns the ID of the build (a new one if the app is now
+        BUILDING), or None if builds aren't recorded by ID
+        """
         pass
 
     def get_build_state(self, app):
@@ -37,6 +54,19 @@ class AppIndex(object):
     def save_app(self, app):
         pass
 
+    def add_state_listener(self, listener):
+        """
+        Registers listener(app, state) to be called after every build state update
+        """
+        self._listeners.append(listener)
+
+    def _notify(self, app, state):
+        for listener in self._listeners:
+            try:
+                listener(app, state)
+            except Exception as e:
+                print("Build state listener failed: {}".format(e))
+
 
 class FileAppIndex(AppIndex):
     """
@@ -46,6 +76,7 @@ class FileAppIndex(AppIndex):
     APPS_DIR = "apps"
 
     def __init__(self, root):
+        super(FileAppIndex, self).__init__()
         self.apps_dir = os.path.join(root, FileAppIndex.APPS_DIR)
         make_dir(self.apps_dir)
 
@@ -70,6 +101,14 @@ class FileAppIndex(AppIndex):
                 print("Could not build app: {0}".format(path))
         return apps
 
+    def get_app(self, name):
+        app_path = os.path.join(self.apps_dir, name)
+        try:
+            with open(os.path.join(app_path, "spec.json"), 'r') as sf:
+                return self._build_meta(json.load(sf), app_path)
+        except IOError:
+            return None
+
     def create(self, spec):
         app_path = os.path.join(self.apps_dir, spec["name"])
         make_dir(app_path, clean=True)
@@ -90,7 +129,12 @@ class FileAppIndex(AppIndex):
         state_file = tempfile.NamedTemporaryFile(delete=False)
         state_file.write(json.dumps({"build_state": state})+"\n")
         state_file.close()
-        shutil.move(state_file.name, os.path.join(self.get_app_path(app), "build", ".build_state"))
+        # the build directory doesn't exist on a web API whose apps are built by remote workers
+        build_path = os.path.join(self.get_app_path(app), "build")
+        make_dir(build_path)
+        shutil.move(state_file.name, os.path.join(build_path, ".build_state"))
+        self._notify(app, state)
+        return None
 
     def get_build_state(self, app):
         path = os.path.join(self.get_app_path(app), "build", ".build_state")
@@ -104,6 +148,137 @@ class FileAppIndex(AppIndex):
         print("app currently must be rebuilt before each launch")
 
 
+class SQLiteAppIndex(FileAppIndex):
+    """
+    Keeps app specs in an SQLite table (the apps' directories still hold their builds), with an
+    in-process cache of the specs that's dropped whenever any process changes the table
+    """
+
+    def __init__(self, root, db_path=DB_PATH):
+        super(SQLiteAppIndex, self).__init__(root)
+        self.db_path = db_path
+
+        self._lock = Lock()
+        # app name -> meta
+        self._cache = {}
+        # True once every app has been loaded into the cache
+        self._complete = False
+        # the table's generation when the cache was filled
+        self._generation = None
+
+        conn = get_connection(self.db_path)
+        conn.executescript("""
+            CREATE TABLE IF NOT EXISTS apps (
+                name TEXT PRIMARY KEY,
+                spec TEXT NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS apps_generation (
+                generation INTEGER NOT NULL
+            );
+        """)
+        with transaction(conn):
+            if not conn.execute("SELECT 1 FROM apps_generation").fetchone():
+                conn.execute("INSERT INTO apps_generation VALUES (0)")
+        if not conn.execute("SELECT 1 FROM apps LIMIT 1").fetchone() and os.listdir(self.apps_dir):
+            self.import_apps_dir()
+
+    def _build_meta(self, spec, path=None):
+        return super(SQLiteAppIndex, self)._build_meta(spec, path or os.path.join(self.apps_dir, spec["name"]))
+
+    def _bump_generation(self, conn):
+        conn.execute("UPDATE apps_generation SET generation = generation + 1")
+
+    def _check_cache(self, conn):
+        """
+        Drops the cache if the apps table has changed since it was filled. Returns the current generation
+        """
+        generation = conn.execute("SELECT generation FROM apps_generation").fetchone()[0]
+        with self._lock:
+            if generation != self._generation:
+                self._cache = {}
+                self._complete = False
+                self._generation = generation
+        return generation
+
+    def _store(self, conn, specs):
+        conn.executemany("INSERT OR REPLACE INTO apps (name, spec) VALUES (?, ?)",
+                         [(spec["name"], json.dumps(spec)) for spec in specs])
+        self._bump_generation(conn)
+
+    def import_apps_dir(self):
+        """
+        Imports the spec of every app found in the apps directory (as used by FileAppIndex).
+        Returns the number of imported apps
+        """
+        apps = super(SQLiteAppIndex, self).find_apps()
+        conn = get_connection(self.db_path)
+        with transaction(conn):
+            self._store(conn, [m["app"] for m in apps.values()])
+        # carry over the last state recorded in each app's .build_state file
+        store = BuildStateStore.get_instance()
+        for name, m in apps.items():
+            state_path = os.path.join(m["path"], "build", ".build_state")
+            if os.path.isfile(state_path) and not store.get_state(name):
+                with open(state_path, "r") as state_file:
+                    state = json.loads(state_file.read())["build_state"]
+                # no build survives the migration, and an unfinished one would look in progress forever
+                if state == BuildStateStore.BUILDING:
+                    print("Build of {} was interrupted, importing it as failed".format(name))
+                    state = BuildStateStore.FAILED
+                store.record(name, state)
+        print("Imported {0} apps from {1}".format(len(apps), self.apps_dir))
+        return len(apps)
+
+    def find_apps(self):
+        conn = get_connection(self.db_path)
+        generation = self._check_cache(conn)
+        with self._lock:
+            if self._complete:
+                return dict(self._cache)
+        rows = conn.execute("SELECT spec FROM apps").fetchall()
+        apps = {}
+        for row in rows:
+            spec = json.loads(row["spec"])
+            apps[spec["name"]] = self._build_meta(spec)
+        with self._lock:
+            if generation == self._generation:
+                self._cache = dict(apps)
+                self._complete = True
+        return apps
+
+    def get_app(self, name):
+        conn = get_connection(self.db_path)
+        generation = self._check_cache(conn)
+        with self._lock:
+            if name in self._cache:
+                return self._cache[name]
+        row = conn.execute("SELECT spec FROM apps WHERE name = ?", (name,)).fetchone()
+        if not row:
+            return None
+        m = self._build_meta(json.loads(row["spec"]))
+        with self._lock:
+            if generation == self._generation:
+                self._cache[name] = m
+        return m
+
+    def create(self, spec):
+        # the spec is also written to the app's directory, so that FileAppIndex can still be used
+        m = super(SQLiteAppIndex, self).create(spec)
+        conn = get_connection(self.db_path)
+        with transaction(conn):
+            self._store(conn, [spec])
+        return m
+
+    def update_build_state(self, app, state):
+        # unlike the .build_state files, the store isn't wiped when a build cleans its directory
+        build_id = BuildStateStore.get_instance().record(app.name, state)
+        self._notify(app, state)
+        return build_id
+
+    def get_build_state(self, app):
+        return BuildStateStore.get_instance().get_state(app.name)
+
+
 class ServiceIndex(object):
     """
     Responsible for finding and managing metadata about services
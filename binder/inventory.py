@@ -0,0 +1,120 @@
+import time
+from threading import Thread, Lock, Event
+
+from binder.settings import SYSTEM_NAMESPACES, INVENTORY_REFRESH_PERIOD
+from binder.kube import KubernetesClient
+
+
+class ClusterInventory(Thread):
+    """
+    In-memory view of the cluster (nodes, their pod capacity, allocated pods and running apps).
+    It's refreshed from the cluster in the background and updated as apps are started and stopped,
+    so it can be queried without contacting the cluster.
+    """
+
+    # the singleton inventory
+    inventory = None
+
+    @staticmethod
+    def get_instance():
+        if not ClusterInventory.inventory:
+            ClusterInventory.inventory = ClusterInventory(KubernetesClient.get_instance())
+        return ClusterInventory.inventory
+
+    def __init__(self, client, period=INVENTORY_REFRESH_PERIOD):
+        super(ClusterInventory, self).__init__()
+        self.daemon = True
+
+        self._client = client
+        self._period = period
+        self._lock = Lock()
+        self._wakeup = Event()
+        self._stopped = False
+
+        # node name -> pod capacity
+        self._capacity = {}
+        # node name -> number of pods scheduled onto the node
+        self._allocated = {}
+        self._namespaces = set()
+
+        # namespace -> (True if added/False if removed, time of the change), for changes that a
+        # refresh in progress might not have seen
+        self._changes = {}
+
+        self.last_refresh = None
+
+    def refresh(self):
+        start = time.time()
+        nodes = self._client.list_nodes()
+        namespaces = self._client.list_namespaces()
+        pods = self._client.list_pods()
+        if nodes is None or namespaces is None or pods is None:
+            print("Could not refresh the cluster inventory")
+            return False
+
+        capacity = {}
+        for node in nodes:
+            pods_cap = node.get("status", {}).get("capacity", {}).get("pods", 0)
+            capacity[node["metadata"]["name"]] = int(pods_cap)
+        allocated = dict((name, 0) for name in capacity)
+        for pod in pods:
+            node_name = pod.get("spec", {}).get("nodeName")
+            if node_name and pod.get("status", {}).get("phase") not in ["Succeeded", "Failed"]:
+                allocated[node_name] = allocated.get(node_name, 0) + 1
+        namespaces = set(ns["metadata"]["name"] for ns in namespaces)
+
+        with self._lock:
+            for namespace, (added, changed) in self._changes.items():
+                if changed < start:
+                    del self._changes[namespace]
+                elif added:
+                    namespaces.add(namespace)
+                else:
+                    namespaces.discard(namespace)
+            self._capacity = capacity
+            self._allocated = allocated
+            self._namespaces = namespaces
+            self.last_refresh = time.time()
+        return True
+
+    def _ensure_loaded(self):
+        # processes that don't run the refresh loop (i.e. the CLI) load the inventory on first use
+        if self.last_refresh is None:
+            self.refresh()
+
+    def add_app(self, app_id):
+        with self._lock:
+            self._namespaces.add(app_id)
+            self._changes[app_id] = (True, time.time())
+
+    def remove_app(self, app_id):
+        with self._lock:
+            self._namespaces.discard(app_id)
+            self._changes[app_id] = (False, time.time())
+
+    def get_running_apps(self):
+        self._ensure_loaded()
+        with self._lock:
+            return sorted(self._namespaces - set(SYSTEM_NAMESPACES))
+
+    def get_total_capacity(self):
+        self._ensure_loaded()
+        with self._lock:
+            return sum(self._capacity.values())
+
+    def get_allocated_pods(self):
+        self._ensure_loaded()
+        with self._lock:
+            return sum(self._allocated.values())
+
+    def stop(self):
+        self._stopped = True
+        self._wakeup.set()
+
+    def run(self):
+        while not self._stopped:
+            try:
+                self.refresh()
+            except Exception as e:
+                print("Error while refreshing the cluster inventory: {}".format(e))
+            self._wakeup.wait(self._period)
@@ -0,0 +1,325 @@
+import json
+import subprocess
+import time
+from multiprocessing.pool import ThreadPool
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from binder.settings import KUBERNETES_BACKEND, KUBERNETES_API_URL, KUBERNETES_API_TOKEN,\
+    KUBERNETES_API_POOL_SIZE, KUBERNETES_API_TIMEOUT, WATCH_POLL_PERIOD
+
+
+class KubernetesClient(object):
+    """
+    Responsible for talking to the Kubernetes cluster. Every method returns structured (JSON)
+    objects, regardless of how the cluster is being accessed.
+    """
+
+    # the singleton client
+    client = None
+
+    # maps object kinds onto the API's resource names
+    RESOURCES = {
+        "Namespace": "namespaces",
+        "Pod": "pods",
+        "Service": "services",
+        "ReplicationController": "replicationcontrollers",
+        "Node": "nodes"
+    }
+
+    @staticmethod
+    def get_instance():
+        if not KubernetesClient.client:
+            if KUBERNETES_BACKEND == "api":
+                KubernetesClient.client = APIClient(KUBERNETES_API_URL, token=KUBERNETES_API_TOKEN,
+                                                    pool_size=KUBERNETES_API_POOL_SIZE)
+            elif KUBERNETES_BACKEND == "kubectl":
+                KubernetesClient.client = KubectlClient()
+            else:
+                raise ValueError("unknown Kubernetes backend: {}".format(KUBERNETES_BACKEND))
+        return KubernetesClient.client
+
+    def create(self, obj, namespace=None):
+        """
+        Creates a single object (pod, service, namespace...) on the cluster. Returns True if
+        the object was created
+        """
+        pass
+
+    def get_pod(self, name, namespace):
+        pass
+
+    def apply(self, objects, namespace=None):
+        """
+        Creates a whole deployment (a list of objects) on the cluster. Namespaces are created
+        first, and all other objects are created inside `namespace`. Returns a result for every
+        object, of the form {"kind": ..., "name": ..., "created": True/False, "error": ...}
+        """
+        pass
+
+    def _result(self, obj, error=None):
+        return {
+            "kind": obj.get("kind"),
+            "name": obj.get("metadata", {}).get("name"),
+            "created": error is None,
+            "error": error
+        }
+
+    def watch_pod(self, name, namespace, timeout):
+        """
+        Yields the pod every time its status changes, for at most `timeout` seconds. Backends
+        that can't stream changes fall back to polling
+        """
+        deadline = time.time() + timeout
+        last_status = None
+        while time.time() < deadline:
+            pod = self.get_pod(name, namespace)
+            if pod and pod.get("status") != last_status:
+                last_status = pod.get("status")
+                yield pod
+            time.sleep(WATCH_POLL_PERIOD)
+
+    def get_service(self, name, namespace="default"):
+        pass
+
+    def list_namespaces(self):
+        pass
+
+    def list_nodes(self):
+        pass
+
+    def list_pods(self):
+        """
+        Lists the pods in all namespaces
+        """
+        pass
+
+    def delete_namespace(self, namespace):
+        """
+        Deletes a namespace and everything running inside of it
+        """
+        pass
+
+
+class KubectlClient(KubernetesClient):
+    """
+    Accesses the cluster by running kubectl.sh for every operation
+    """
+
+    def _get(self, args):
+        cmd = ["kubectl.sh", "get"] + args + ["-o", "json"]
+        try:
+            return json.loads(subprocess.check_output(cmd))
+        except (subprocess.CalledProcessError, ValueError) as e:
+            print("Could not get {0} from the Kubernetes cluster: {1}".format(" ".join(args), e))
+            return None
+
+    def create(self, obj, namespace=None):
+        cmd = ["kubectl.sh", "create", "-f", "-"]
+        if namespace:
+            cmd.append("--namespace={}".format(namespace))
+        proc = subprocess.Popen(cmd, stdin=subprocess.PIPE)
+        proc.communicate(json.dumps(obj))
+        return proc.returncode == 0
+
+    def apply(self, objects, namespace=None):
+        # kubectl creates the items of a List in order, so the whole deployment is submitted at once
+        # with the namespaces at the front
+        ordered = sorted(objects, key=lambda obj: obj.get("kind") != "Namespace")
+        cmd = ["kubectl.sh", "create", "-f", "-"]
+        if namespace:
+            cmd.append("--namespace={}".format(namespace))
+        proc = subprocess.Popen(cmd, stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                                stderr=subprocess.PIPE)
+        out, err = proc.communicate(json.dumps({"kind": "List", "apiVersion": "v1", "items": ordered}))
+        # kubectl prints <resource>/<name> for every object it created
+        created = set(line.strip() for line in out.splitlines())
+        results = []
+        for obj in ordered:
+            result = self._result(obj)
+            resource = KubernetesClient.RESOURCES.get(result["kind"])
+            if "{0}/{1}".format(resource, result["name"]) not in created:
+                result["created"] = False
+                result["error"] = err.strip() or "not created"
+            results.append(result)
+        return results
+
+    def get_pod(self, name, namespace):
+        return self._get(["pod", name, "--namespace={}".format(namespace)])
+
+    def get_service(self, name, namespace="default"):
+        return self._get(["service", name, "--namespace={}".format(namespace)])
+
+    def list_namespaces(self):
+        namespaces = self._get(["namespaces"])
+        return namespaces["items"] if namespaces else None
+
+    def list_nodes(self):
+        nodes = self._get(["nodes"])
+        return nodes["items"] if nodes else None
+
+    def list_pods(self):
+        pods = self._get(["pods", "--all-namespaces"])
+        return pods["items"] if pods else None
+
+    def delete_namespace(self, namespace):
+        try:
+            stop_cmd = ["kubectl.sh", "stop", "pods,services,replicationControllers", "--all",
+                        "--namespace={}".format(namespace)]
+            cleanup_cmd = ["kubectl.sh", "delete", "namespace", namespace]
+            subprocess.check_call(stop_cmd)
+            subprocess.check_call(cleanup_cmd)
+            return True
+        except subprocess.CalledProcessError as e:
+            print("Could not delete namespace {0}: {1}".format(namespace, e))
+            return False
+
+
+class APIClient(KubernetesClient):
+    """
+    Accesses the cluster through the Kubernetes API server, over a pool of keep-alive HTTP
+    connections. The API server can either be accessed directly or through `kubectl proxy`
+    """
+
+    API_PREFIX = "/api/v1"
+
+    def __init__(self, url, token=None, pool_size=10, verify=True, timeout=KUBERNETES_API_TIMEOUT):
+        self.url = url.rstrip("/") + APIClient.API_PREFIX
+        self.timeout = timeout
+
+        # used to create independent objects concurrently
+        self._workers = ThreadPool(pool_size)
+
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        self.session.verify = verify
+        self.session.headers["Content-Type"] = "application/json"
+        if token:
+            self.session.headers["Authorization"] = "Bearer {}".format(token)
+
+    def _path(self, kind, namespace=None, name=None):
+        resource = KubernetesClient.RESOURCES[kind]
+        parts = [self.url]
+        if kind not in ["Namespace", "Node"]:
+            parts += ["namespaces", namespace or "default"]
+        parts.append(resource)
+        if name:
+            parts.append(name)
+        return "/".join(parts)
+
+    def _request(self, method, url, **kwargs):
+        try:
+            r = self.session.request(method, url, timeout=self.timeout, **kwargs)
+        except requests.exceptions.RequestException as e:
+            print("Could not reach the Kubernetes API server at {0}: {1}".format(url, e))
+            return None, None
+        try:
+            body = r.json()
+        except ValueError:
+            body = None
+        return r.status_code, body
+
+    def _get(self, kind, namespace=None, name=None):
+        status, body = self._request("GET", self._path(kind, namespace, name))
+        if status != 200:
+            return None
+        return body
+
+    def _post(self, obj, namespace=None):
+        """
+        Returns None if the object was created, and an error message otherwise
+        """
+        kind = obj.get("kind")
+        if kind not in KubernetesClient.RESOURCES:
+            return "unknown kind: {}".format(kind)
+        status, body = self._request("POST", self._path(kind, namespace), data=json.dumps(obj))
+        if status != 201:
+            return body.get("message") if isinstance(body, dict) else "status {}".format(status)
+        return None
+
+    def create(self, obj, namespace=None):
+        error = self._post(obj, namespace)
+        if error:
+            print("Could not create {0} {1}: {2}".format(obj.get("kind"), obj["metadata"]["name"], error))
+            return False
+        return True
+
+    def apply(self, objects, namespace=None):
+        namespaces = [obj for obj in objects if obj.get("kind") == "Namespace"]
+        others = [obj for obj in objects if obj.get("kind") != "Namespace"]
+
+        results = [self._result(obj, self._post(obj)) for obj in namespaces]
+        if not all([result["created"] for result in results]):
+            return results + [self._result(obj, "namespace not created") for obj in others]
+
+        # everything else is independent, so it can be created concurrently
+        results += self._workers.map(lambda obj: self._result(obj, self._post(obj, namespace)), others)
+        return results
+
+    def get_pod(self, name, namespace):
+        return self._get("Pod", namespace, name)
+
+    def watch_pod(self, name, namespace, timeout):
+        deadline = time.time() + timeout
+        # without a resourceVersion, the API server first sends the pod's current state
+        resource_version = None
+        while time.time() < deadline:
+            remaining = deadline - time.time()
+            params = {
+                "watch": "true",
+                "fieldSelector": "metadata.name={}".format(name),
+                "timeoutSeconds": max(int(remaining), 1)
+            }
+            if resource_version:
+                params["resourceVersion"] = resource_version
+            try:
+                r = self.session.get(self._path("Pod", namespace), params=params, stream=True,
+                                     timeout=remaining + 5)
+                if r.status_code != 200:
+                    print("Could not watch pod {0} in {1}: status {2}".format(name, namespace, r.status_code))
+                    return
+                for line in r.iter_lines():
+                    if not line:
+                        continue
+                    event = json.loads(line)
+                    obj = event.get("object") or {}
+                    if event.get("type") == "ERROR" or obj.get("kind") == "Status":
+                        if obj.get("code") == 410 and resource_version:
+                            # the last seen version is too old, the pod is watched again from its current state
+                            resource_version = None
+                            break
+                        print("Error while watching pod {0}: {1}".format(name, obj.get("message", obj)))
+                        return
+                    resource_version = obj.get("metadata", {}).get("resourceVersion")
+                    yield obj
+            except (requests.exceptions.RequestException, ValueError) as e:
+                print("Could not watch pod {0} in {1}: {2}".format(name, namespace, e))
+                return
+            # the API server (or a proxy in between) can end a watch early, which is then resumed
+            time.sleep(min(WATCH_POLL_PERIOD, max(deadline - time.time(), 0)))
+
+    def get_service(self, name, namespace="default"):
+        return self._get("Service", namespace, name)
+
+    def list_namespaces(self):
+        namespaces = self._get("Namespace")
+        return namespaces["items"] if namespaces else None
+
+    def list_nodes(self):
+        nodes = self._get("Node")
+        return nodes["items"] if nodes else None
+
+    def list_pods(self):
+        status, pods = self._request("GET", "/".join([self.url, KubernetesClient.RESOURCES["Pod"]]))
+        return pods["items"] if status == 200 else None
+
+    def delete_namespace(self, namespace):
+        # deleting a namespace deletes all of the objects inside of it
+        status, body = self._request("DELETE", self._path("Namespace", name=namespace))
+        if status not in [200, 202]:
+            print("Could not delete namespace {0}: {1}".format(namespace, status))
+            return False
+        return True
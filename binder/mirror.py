@@ -0,0 +1,125 @@
+import fcntl
+import hashlib
+import os
+import shutil
+import subprocess
+import time
+from contextlib import contextmanager
+
+from binder.settings import MIRROR_DIR
+from binder.utils import make_dir
+
+
+class MirrorCache(object):
+    """
+    Keeps a bare mirror of every app repository under MIRROR_DIR, so that a rebuild only fetches
+    the objects that are new since the last build, and builds read files and archives straight
+    from the mirror.
+    Mirrors are locked with flock, since builds of the same repo can run in different processes
+    """
+
+    # the singleton cache
+    cache = None
+
+    @staticmethod
+    def get_instance():
+        if not MirrorCache.cache:
+            MirrorCache.cache = MirrorCache()
+        return MirrorCache.cache
+
+    class MirrorException(Exception):
+        pass
+
+    def __init__(self, mirror_dir=MIRROR_DIR):
+        self.mirror_dir = mirror_dir
+        make_dir(self.mirror_dir)
+
+    def get_mirror_path(self, url):
+        return os.path.join(self.mirror_dir, hashlib.sha1(url).hexdigest() + ".git")
+
+    @contextmanager
+    def _lock(self, url):
+        with open(self.get_mirror_path(url) + ".lock", "w+") as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def _git(self, args, cwd=None):
+        # never prompt for credentials, a missing repository should just fail
+        env = dict(os.environ, GIT_TERMINAL_PROMPT="0")
+        try:
+            return subprocess.check_output(["git"] + args, cwd=cwd, env=env, stderr=subprocess.STDOUT)
+        except subprocess.CalledProcessError as e:
+            raise MirrorCache.MirrorException("git {0} failed: {1}".format(args[0], e.output.strip()))
+
+    def _get_size(self, mirror_path):
+        """
+        Returns the size of the mirror's object store in bytes
+        """
+        if not os.path.isdir(mirror_path):
+            return 0
+        size = 0
+        for line in self._git(["count-objects", "-v"], cwd=mirror_path).splitlines():
+            key, value = line.split(":")
+            if key in ["size", "size-pack"]:
+                size += int(value) * 1024
+        return size
+
+    def _update(self, url):
+        mirror_path = self.get_mirror_path(url)
+        before = self._get_size(mirror_path)
+        if os.path.isdir(mirror_path):
+            self._git(["remote", "update", "--prune"], cwd=mirror_path)
+            cloned = False
+        else:
+            tmp_path = mirror_path + ".tmp"
+            if os.path.isdir(tmp_path):
+                shutil.rmtree(tmp_path)
+            self._git(["clone", "--mirror", url, tmp_path])
+            # an interrupted clone never leaves a broken mirror behind
+            os.rename(tmp_path, mirror_path)
+            cloned = True
+        return cloned, self._get_size(mirror_path) - before
+
+    def update(self, url):
+        """
+        Creates or updates the mirror of the repository at url. Returns a report with the number
+        of bytes added to the mirror
+        """
+        start = time.time()
+        with self._lock(url):
+            cloned, fetched = self._update(url)
+        report = {"url": url, "cloned": cloned, "bytes": fetched, "seconds": time.time() - start}
+        print("Fetched {0} bytes from {1} in {2:.2f}s".format(fetched, url, report["seconds"]))
+        return report
+
+    def resolve(self, url, commit=None):
+        """
+        Updates the mirror of the repository at url and returns the full SHA of `commit` (the
+        default branch's HEAD if it's not given), with the update's report
+        """
+        report = self.update(url)
+        revision = (commit or "HEAD") + "^{commit}"
+        sha = self._git(["rev-parse", "--verify", "--quiet", revision], cwd=self.get_mirror_path(url)).strip()
+        report["commit"] = sha
+        return sha, report
+
+    def read_file(self, url, commit, path):
+        """
+        Returns the contents of the file at path in `commit` of the mirrored repository, or None if
+        there's no such file
+        """
+        try:
+            return self._git(["show", "{0}:{1}".format(commit, path)], cwd=self.get_mirror_path(url))
+        except MirrorCache.MirrorException:
+            return None
+
+    def archive(self, url, commit):
+        """
+        Starts streaming `commit` of the mirrored repository as a tar. Returns the `git archive`
+        process, whose stdout is the stream
+        """
+        return subprocess.Popen(["git", "archive", "--format=tar", commit], cwd=self.get_mirror_path(url),
+                                stdout=subprocess.PIPE)
@@ -0,0 +1,157 @@
+import json
+import os
+import subprocess
+import tempfile
+import time
+from threading import Lock, Semaphore
+from multiprocessing.pool import ThreadPool
+
+from binder.settings import ROOT, REGISTRY_NAME, PRELOAD_MAX_CONCURRENCY, PRELOAD_PER_NODE,\
+    PRELOAD_INDEX_TTL
+
+
+class ImagePreloader(object):
+    """
+    Pulls images onto the cluster's nodes ahead of time. Keeps an index of the images present on
+    every node, so that images are only pulled onto nodes where they're missing or out of date.
+    """
+
+    INDEX_FILE = ".preload_index"
+
+    # the singleton preloader
+    preloader = None
+
+    @staticmethod
+    def get_instance():
+        if not ImagePreloader.preloader:
+            ImagePreloader.preloader = ImagePreloader()
+        return ImagePreloader.preloader
+
+    def __init__(self, max_concurrency=PRELOAD_MAX_CONCURRENCY, per_node=PRELOAD_PER_NODE):
+        self._workers = ThreadPool(max_concurrency)
+        self._per_node = per_node
+        self._node_slots = {}
+        self._lock = Lock()
+
+        # node name -> {"images": {image name: image ID}, "checked": time of the last full check}
+        self._index = self._read_index()
+
+    def _index_path(self):
+        return os.path.join(ROOT, ImagePreloader.INDEX_FILE)
+
+    def _read_index(self):
+        try:
+            with open(self._index_path(), "r") as index_file:
+                return json.load(index_file)
+        except (IOError, ValueError):
+            return {}
+
+    def _write_index(self):
+        with self._lock:
+            raw = json.dumps(self._index)
+        index_file = tempfile.NamedTemporaryFile(dir=ROOT, delete=False)
+        index_file.write(raw)
+        index_file.close()
+        os.rename(index_file.name, self._index_path())
+
+    def _get_full_name(self, image_name):
+        return "{0}/{1}".format(REGISTRY_NAME, image_name)
+
+    def _get_slot(self, node):
+        with self._lock:
+            if node not in self._node_slots:
+                self._node_slots[node] = Semaphore(self._per_node)
+            return self._node_slots[node]
+
+    def _ssh(self, node, zone, command):
+        cmd = ["gcloud", "compute", "ssh", node, "--zone", zone, "--command", command]
+        with self._get_slot(node):
+            return subprocess.check_output(cmd)
+
+    def _get_local_id(self, full_name):
+        # the ID of the image on this machine (where it was built and pushed from)
+        try:
+            cmd = ["docker", "inspect", "--format", "{{.Id}}", full_name]
+            return subprocess.check_output(cmd).strip()
+        except (subprocess.CalledProcessError, OSError):
+            return None
+
+    def _check_node(self, node_zone):
+        node, zone = node_zone
+        try:
+            output = self._ssh(node, zone, "sudo docker images --no-trunc")
+        except subprocess.CalledProcessError as e:
+            print("Could not list the images on {0}: {1}".format(node, e))
+            return
+        images = {}
+        # columns are REPOSITORY, TAG, IMAGE ID, ...
+        for line in output.splitlines()[1:]:
+            split = line.split()
+            if len(split) >= 3:
+                images["{0}:{1}".format(split[0], split[1])] = split[2]
+                if split[1] == "latest":
+                    images[split[0]] = split[2]
+        with self._lock:
+            self._index[node] = {"images": images, "checked": time.time()}
+
+    def _pull(self, job):
+        node, zone, full_name = job
+        start = time.time()
+        docker_cmd = "sudo docker pull {0} >/dev/null && sudo docker inspect --format '{{{{.Id}}}}' {0}"
+        try:
+            image_id = self._ssh(node, zone, docker_cmd.format(full_name)).strip()
+        except subprocess.CalledProcessError as e:
+            print("Could not preload {0} onto {1}: {2}".format(full_name, node, e))
+            return {"node": node, "image": full_name, "success": False, "seconds": time.time() - start}
+        with self._lock:
+            self._index.setdefault(node, {"images": {}, "checked": 0})["images"][full_name] = image_id
+        return {"node": node, "image": full_name, "success": True, "seconds": time.time() - start}
+
+    def _needs_pull(self, node, full_name, local_id):
+        node_id = self._index.get(node, {}).get("images", {}).get(full_name)
+        if not node_id:
+            return True
+        # if the image isn't available locally, trust the node's copy until the next check
+        return local_id is not None and node_id != local_id
+
+    def preload(self, image_names, nodes):
+        """
+        Makes sure that every image in image_names is present and up to date on every node, given as
+        (node name, zone) pairs. Returns a report of what had to be pulled
+        """
+        start = time.time()
+
+        # refresh the index entries of nodes that haven't been checked recently
+        stale = [(node, zone) for node, zone in nodes
+                 if time.time() - self._index.get(node, {}).get("checked", 0) > PRELOAD_INDEX_TTL]
+        self._workers.map(self._check_node, stale)
+
+        jobs = []
+        for image_name in image_names:
+            full_name = self._get_full_name(image_name)
+            local_id = self._get_local_id(full_name)
+            for node, zone in nodes:
+                if self._needs_pull(node, full_name, local_id):
+                    jobs.append((node, zone, full_name))
+        num_checked = len(image_names) * len(nodes)
+        print("Preloading {0} images onto {1} nodes: {2} pulls needed, {3} already present".format(
+              len(image_names), len(nodes), len(jobs), num_checked - len(jobs)))
+
+        pulls = []
+        for pull in self._workers.imap_unordered(self._pull, jobs):
+            pulls.append(pull)
+            status = "pulled" if pull["success"] else "failed to pull"
+            print("[{0}/{1}] {2} {3} onto {4} in {5:.2f}s".format(len(pulls), len(jobs), status,
+                  pull["image"], pull["node"], pull["seconds"]))
+        self._write_index()
+
+        report = {
+            "pulled": len([p for p in pulls if p["success"]]),
+            "failed": len([p for p in pulls if not p["success"]]),
+            "skipped": num_checked - len(jobs),
+            "seconds": time.time() - start,
+            "pulls": pulls
+        }
+        print("Preloading finished in {0:.2f}s ({1} pulled, {2} failed, {3} skipped)".format(
+              report["seconds"], report["pulled"], report["failed"], report["skipped"]))
+        return report
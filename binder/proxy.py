@@ -0,0 +1,118 @@
+import json
+import os
+from threading import Lock
+from multiprocessing.pool import ThreadPool
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from binder.settings import ROOT, PROXY_POOL_SIZE, PROXY_TIMEOUT
+
+
+class ProxyClient(object):
+    """
+    Manages the routes of the proxy server over a persistent, keep-alive session. The proxy's
+    address and auth token are read from .proxy_info, and only re-read when that file changes.
+    """
+
+    INFO_FILE = ".proxy_info"
+
+    # the singleton client
+    client = None
+
+    @staticmethod
+    def get_instance():
+        if not ProxyClient.client:
+            ProxyClient.client = ProxyClient(os.path.join(ROOT, ProxyClient.INFO_FILE))
+        return ProxyClient.client
+
+    def __init__(self, info_path, pool_size=PROXY_POOL_SIZE, timeout=PROXY_TIMEOUT):
+        self._info_path = info_path
+        self.timeout = timeout
+        self._info_mtime = None
+        self._lock = Lock()
+        self.url = None
+
+        self.session = requests.Session()
+        self.session.mount("http://", HTTPAdapter(pool_connections=1, pool_maxsize=pool_size))
+
+        # the proxy's API has no batch endpoints, so bulk operations are spread over the session's
+        # connection pool
+        self._workers = ThreadPool(pool_size)
+
+    def _load_info(self):
+        try:
+            mtime = os.stat(self._info_path).st_mtime
+        except OSError:
+            print("Could not find the proxy info at {}".format(self._info_path))
+            return False
+        with self._lock:
+            if mtime != self._info_mtime:
+                with open(self._info_path, "r") as proxy_file:
+                    raw_host, raw_token = proxy_file.readlines()
+                self.url = "http://" + raw_host.strip() + "/api/routes"
+                self.session.headers["Authorization"] = "token {}".format(raw_token.strip())
+                self._info_mtime = mtime
+        return True
+
+    def write_info(self, host, token):
+        with open(self._info_path, "w+") as proxy_file:
+            proxy_file.write("{}\n".format(host))
+            proxy_file.write("{}\n".format(token))
+
+    def add_route(self, app_id, target):
+        if not self._load_info():
+            return False
+        try:
+            r = self.session.post(self.url + "/" + app_id, data=json.dumps({"target": target}),
+                                  timeout=self.timeout)
+            if r.status_code == 201:
+                print("Proxying {0} to {1}".format(app_id, target))
+                return True
+            print("Could not register route for {0} with proxy server: {1}".format(app_id, r.status_code))
+        except requests.exceptions.RequestException:
+            print("Could not connect to the proxy server at {}".format(self.url))
+        return False
+
+    def remove_route(self, app_id):
+        if not self._load_info():
+            return False
+        try:
+            r = self.session.delete(self.url + "/" + app_id, timeout=self.timeout)
+            if r.status_code == 204:
+                print("Removed proxy route for {}".format(app_id))
+                return True
+        except requests.exceptions.RequestException:
+            print("Could not remove proxy route for {}".format(app_id))
+        return False
+
+    def get_routes(self, inactive_since=None):
+        """
+        Returns the IDs of all routed apps (only those inactive since `inactive_since`, an ISO
+        timestamp, if it's given), or None if the proxy couldn't be reached
+        """
+        if not self._load_info():
+            return None
+        params = {"inactive_since": inactive_since} if inactive_since else None
+        try:
+            r = self.session.get(self.url, params=params, timeout=self.timeout)
+            if r.status_code == 200:
+                return [route[1:] for route in r.json().keys()]
+        except requests.exceptions.RequestException:
+            print("Could not get routes from the proxy server at {}".format(self.url))
+        return None
+
+    def add_routes(self, targets):
+        """
+        Adds a route for every app in targets ({app_id: target}). Returns {app_id: True/False}
+        """
+        app_ids = targets.keys()
+        results = self._workers.map(lambda app_id: self.add_route(app_id, targets[app_id]), app_ids)
+        return dict(zip(app_ids, results))
+
+    def remove_routes(self, app_ids):
+        """
+        Removes the routes of all apps in app_ids. Returns {app_id: True/False}
+        """
+        results = self._workers.map(self.remove_route, app_ids)
+        return dict(zip(app_ids, results))
@@ -141,10 +141,12 @@ class Service(object):
                 final_params = dict(service_params.items() + namespace_params("component", dep_params).items())
                 print("final_params: {0}".format(final_params))
 
-                filled_comp = fill_template_string(comps[comp_name + ".json"], final_params)
+                filled_comp = fill_template_string(comps[comp_name + ".json"], final_params,
+                                                   name=self.full_name + "/" + comp_name + ".json")
 
                 final_params["containers"] = filled_comp
-                filled_template = fill_template_string(templates[dep_type + ".json"], final_params)
+                filled_template = fill_template_string(templates[dep_type + ".json"], final_params,
+                                                       name=comp_name + "-" + dep_type + ".json")
 
                 with open(os.path.join(deploy_path, comp_name + "-" + dep_type + ".json"), "w+") as df:
                     df.write(filled_template)
@@ -15,4 +15,130 @@ REGISTRY_NAME = "gcr.io/generic-notebooks"
 LOG_FILE = "/var/log/binder"
 LOG_LEVEL = logging.INFO
 
-APP_CRON_PERIOD = 5
+# SQLite database shared by the web API, the build workers and the CLI
+DB_PATH = os.path.join(ROOT, ".binder.db")
+# how long a writer waits for another process's transaction to finish (in seconds)
+DB_TIMEOUT = 30
+
+# "file" scans BINDER_HOME/apps for every lookup, "sqlite" keeps app specs in DB_PATH
+APP_INDEX = os.environ.get("BINDER_APP_INDEX", "sqlite")
+
+# bare mirrors of app repositories, updated incrementally by every build
+MIRROR_DIR = os.path.join(ROOT, ".mirrors")
+
+# apps with the same pip requirements are built on a shared "deps" image, tagged with the requirements' hash
+DEPS_IMAGE_NAME = REGISTRY_NAME + "/binder-deps"
+DEPS_DIR = os.path.join(ROOT, ".deps")
+# deps images that no app uses are removed after this many days
+DEPS_GC_AGE = 7
+
+# build contexts are streamed to docker without these files (and those matched by the repo's
+# .dockerignore). Builds with files larger than BUILD_CONTEXT_MAX_FILE_SIZE (which the repo can
+# .dockerignore) or contexts larger than BUILD_CONTEXT_MAX_SIZE fail (both in bytes)
+BUILD_CONTEXT_IGNORE = [".git", ".ipynb_checkpoints", "__pycache__", "*.pyc"]
+BUILD_CONTEXT_MAX_FILE_SIZE = 100 * 1024 ** 2
+BUILD_CONTEXT_MAX_SIZE = 2 * 1024 ** 3
+
+# wheels built for the base image's pips, served to `docker build` over HTTP. The server only listens
+# on WHEELHOUSE_HOST, by default the host's address on the docker0 bridge, as seen from the build
+# containers
+WHEELHOUSE_DIR = os.path.join(ROOT, ".wheelhouse")
+WHEELHOUSE_HOST = os.environ.get("BINDER_WHEELHOUSE_HOST", "172.17.0.1")
+WHEELHOUSE_PORT = 8010
+WHEELHOUSE_URL = os.environ.get("BINDER_WHEELHOUSE_URL", "http://{0}:{1}".format(WHEELHOUSE_HOST, WHEELHOUSE_PORT))
+# least recently used wheels are evicted beyond this size (in bytes)
+WHEELHOUSE_MAX_SIZE = 10 * 1024 ** 3
+
+# build workers (the web API's own, and any `binder worker`) renew the lease on each of their jobs every
+# BUILD_HEARTBEAT seconds. Jobs whose lease is older than BUILD_LEASE seconds are given to another worker
+BUILD_LEASE = 60
+BUILD_HEARTBEAT = 15
+# max number of builds run at once by a `binder worker`
+BUILD_WORKER_SLOTS = 4
+# where standalone workers get their jobs: the web API's URL, or "local" to use DB_PATH directly
+BROKER_URL = os.environ.get("BINDER_BROKER_URL", "local")
+# the token workers must send to the web API's broker endpoints, which are disabled if it isn't set
+BROKER_TOKEN = os.environ.get("BINDER_BROKER_TOKEN")
+# the token operators must send to submit builds with a priority above the default (0). Nobody can if
+# it isn't set
+OPERATOR_TOKEN = os.environ.get("BINDER_OPERATOR_TOKEN")
+# workers adapt how many builds they run at once (between BUILD_CONCURRENCY_FLOOR and their max number
+# of builds) to the load of their host, checking it every BUILD_CONCURRENCY_PERIOD seconds. The host is
+# overloaded when any of these is over its limit
+BUILD_CONCURRENCY_ADAPTIVE = True
+BUILD_CONCURRENCY_FLOOR = 2
+BUILD_CONCURRENCY_PERIOD = 30
+# 1-minute load average, per CPU
+BUILD_MAX_LOAD = 1.5
+# fraction of CPU time spent waiting for I/O
+BUILD_MAX_IOWAIT = 0.3
+# free space where docker keeps its images (in bytes)
+BUILD_MIN_FREE_DISK = 10 * 1024 ** 3
+DOCKER_ROOT = "/var/lib/docker"
+# how long the docker daemon takes to answer `docker version` (in seconds)
+BUILD_MAX_DOCKER_LATENCY = 5
+# each build's output is kept in a directory of BUILD_LOG_DIR, in gzipped segments of BUILD_LOG_SEGMENT_SIZE
+# bytes. The last BUILD_LOG_RING_SIZE bytes of running builds are also kept in memory for live readers.
+# Output beyond BUILD_LOG_MAX_SIZE is dropped, and the web API removes logs after BUILD_LOG_MAX_AGE days
+# (`binder gc logs` does the same where it doesn't run). Logs without output for BUILD_LOG_IDLE_TIMEOUT
+# seconds (e.g. of builds whose worker died) are closed
+BUILD_LOG_DIR = os.environ.get("BINDER_BUILD_LOG_DIR", os.path.join(ROOT, "logs"))
+BUILD_LOG_SEGMENT_SIZE = 64 * 1024
+BUILD_LOG_RING_SIZE = 256 * 1024
+BUILD_LOG_MAX_SIZE = 50 * 1024 ** 2
+BUILD_LOG_MAX_AGE = 30
+BUILD_LOG_IDLE_TIMEOUT = 30 * 60
+
+# apps that have been inactive for CULL_INACTIVE minutes are stopped, checking every CULL_PERIOD minutes
+CULL_INACTIVE = 60
+CULL_PERIOD = 5
+# run the culler inside the web API process
+CULL_IN_PROCESS = True
+# number of recent culler sweeps kept for reporting
+CULL_HISTORY = 100
+
+# "kubectl" runs kubectl.sh for every cluster operation, "api" talks to the Kubernetes API server
+KUBERNETES_BACKEND = os.environ.get("BINDER_KUBERNETES_BACKEND", "kubectl")
+# defaults to the address of `kubectl proxy`
+KUBERNETES_API_URL = os.environ.get("KUBERNETES_API_URL", "http://127.0.0.1:8001")
+KUBERNETES_API_TOKEN = os.environ.get("KUBERNETES_API_TOKEN")
+KUBERNETES_API_POOL_SIZE = 10
+# how long a request to the API server may take before it's given up on (in seconds)
+KUBERNETES_API_TIMEOUT = 10
+# how often the kubectl backend polls for pod status changes (in seconds)
+WATCH_POLL_PERIOD = 0.5
+
+# namespaces that are never treated as running apps
+SYSTEM_NAMESPACES = ["default", "kube-system"]
+# how often the in-memory cluster inventory is refreshed (in seconds)
+INVENTORY_REFRESH_PERIOD = 30
+
+# max number of concurrent image pulls across the cluster, and onto a single node
+PRELOAD_MAX_CONCURRENCY = 10
+PRELOAD_PER_NODE = 2
+# how long the list of images present on a node is trusted before it's checked again (in seconds)
+PRELOAD_INDEX_TTL = 600
+
+# max number of open connections to the proxy server
+PROXY_POOL_SIZE = 10
+# how long a request to the proxy server may take (in seconds), so that a stuck proxy can't stall
+# launches or the culler
+PROXY_TIMEOUT = 10
+
+# max number of apps being torn down at once
+TEARDOWN_CONCURRENCY = 20
+
+NOTEBOOK_PORT = 8888
+# how long to wait for a launched notebook server to become ready (in seconds)
+LAUNCH_TIMEOUT = 60
+# only register a proxy route once the notebook server accepts connections
+LAUNCH_CHECK_PORT = True
+
+# prestarted notebook servers kept for each app, as {app name: (min idle servers, max pool size)}.
+# Apps that aren't listed use WARM_POOL_DEFAULT
+WARM_POOL_DEFAULT = (0, 0)
+WARM_POOL_APPS = {}
+# how often the warm pool is checked for missing servers (in seconds)
+WARM_POOL_PERIOD = 10
+# max number of servers being prestarted at once
+WARM_POOL_WORKERS = 4
@@ -1,7 +1,6 @@
 import shutil
 import os
 import re
-import settings
 
 def namespace_params(ns, params):
     ns_params = {}
@@ -9,25 +8,70 @@ def namespace_params(ns, params):
         ns_params[ns + '.' + p] = params[p]
     return ns_params
 
-def make_patterns(params):
-    return [(re.compile("{{" + k + "}}"), '{0}'.format(params[k])) for k in params]
+# a {{placeholder}}, by name
+PLACEHOLDER = re.compile("{{([^{}]+)}}")
+# max number of parsed templates kept by Template.get
+TEMPLATE_CACHE_SIZE = 256
 
-def fill_template_string(template, params):
-    res = make_patterns(params)
-    replaced = template
-    for pattern, new in res:
-        replaced = pattern.sub(new, replaced)
-    return replaced
+class Template(object):
+    """
+    A template string parsed once into its text and {{placeholders}}, and rendered in a single pass.
+    Placeholders without a parameter are left as is
+    """
+
+    # template string -> Template
+    _cache = {}
+
+    @staticmethod
+    def get(template):
+        """
+        Returns the parsed template, parsing it only if it wasn't parsed recently
+        """
+        parsed = Template._cache.get(template)
+        if not parsed:
+            if len(Template._cache) >= TEMPLATE_CACHE_SIZE:
+                Template._cache.clear()
+            parsed = Template._cache[template] = Template(template)
+        return parsed
+
+    def __init__(self, template):
+        # split() alternates the text between placeholders and the names of the placeholders
+        parts = PLACEHOLDER.split(template)
+        self._head = parts[0]
+        self._parts = zip(parts[1::2], parts[2::2])
+        self.placeholders = frozenset(parts[1::2])
+
+    def render(self, params):
+        out = [self._head]
+        for name, text in self._parts:
+            if name in params:
+                out.append('{0}'.format(params[name]))
+            else:
+                out.append("{{" + name + "}}")
+            out.append(text)
+        return "".join(out)
+
+    def get_unfilled(self, params):
+        return sorted(name for name in self.placeholders if name not in params)
+
+def fill_template_string(template, params, name=None):
+    """
+    Fills the template's placeholders with params. If the template is given a name, its placeholders
+    that params don't fill are reported
+    """
+    parsed = Template.get(template)
+    if name:
+        unfilled = parsed.get_unfilled(params)
+        if unfilled:
+            print("Unfilled placeholders in {0}: {1}".format(name, ", ".join(unfilled)))
+    return parsed.render(params)
 
 def fill_template(template_path, params):
     try:
-        res = make_patterns(params)
         with open(template_path, 'r+') as template:
-            raw = template.read()
+            # files are only filled once, so they're not cached
+            replaced = Template(template.read()).render(params)
         with open(template_path, 'w') as template:
-            replaced = raw
-            for pattern, new in res:
-                replaced = pattern.sub(new, replaced)
             template.write(replaced)
     except (IOError, TypeError) as e:
         print("Could not fill template {0}: {1}".format(template_path, e))
@@ -39,15 +83,3 @@ def make_dir(path, clean=False):
             os.mkdir(path)
     else:
         os.mkdir(path)
-
-def get_binder_home():
-    import binder
-    return "/".join(binder.__file__.split("/")[:-1])
-
-def get_env_string():
-    env = [
-        "BINDER_HOME={}".format(settings.ROOT),
-        "KUBERNETES_PROVIDER={}".format(os.environ["KUBERNETES_PROVIDER"]),
-        "PYTHONPATH=$PYTHONPATH:{}".format(get_binder_home())
-    ]
-    return " ".join(env)
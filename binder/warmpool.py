@@ -0,0 +1,153 @@
+import time
+from threading import Thread, Lock, Event
+from multiprocessing.pool import ThreadPool
+
+from binder.settings import WARM_POOL_DEFAULT, WARM_POOL_APPS, WARM_POOL_PERIOD, WARM_POOL_WORKERS
+from binder.app import App
+from binder.buildqueue import BuildQueue
+from binder.cluster import ClusterManager
+
+
+class WarmPool(Thread):
+    """
+    Keeps a pool of prestarted notebook servers for each app, so that launching an app only
+    requires registering a proxy route. The pool is refilled in the background whenever it drops
+    below its minimum number of idle servers.
+    """
+
+    # the singleton pool
+    pool = None
+
+    # only single-node deployments are pooled
+    MODE = "single-node"
+
+    @staticmethod
+    def get_instance():
+        if not WarmPool.pool:
+            WarmPool.pool = WarmPool()
+        return WarmPool.pool
+
+    def __init__(self, period=WARM_POOL_PERIOD):
+        super(WarmPool, self).__init__()
+        self.daemon = True
+
+        self._period = period
+        self._lock = Lock()
+        self._wakeup = Event()
+        self._stopped = False
+
+        # app name -> list of (app_id, ip) tuples for servers that are ready to be claimed
+        self._idle = {}
+        # app name -> number of servers currently being started
+        self._starting = {}
+        # app name -> number of times its pool was invalidated, so that servers started before the
+        # last invalidation are never added to the pool
+        self._generations = {}
+
+        self._starter = ThreadPool(WARM_POOL_WORKERS)
+
+    def get_limits(self, name):
+        """
+        Returns the (min idle servers, max pool size) pair for an app
+        """
+        return WARM_POOL_APPS.get(name, WARM_POOL_DEFAULT)
+
+    def _pooled_apps(self):
+        if WARM_POOL_DEFAULT[0] > 0:
+            apps = App.get_app()
+        else:
+            apps = filter(None, [App.get_app(name) for name in WARM_POOL_APPS])
+        # an app that's about to be rebuilt would be prestarted with its old image
+        queued = BuildQueue.get_instance().get_queued_apps()
+        return [app for app in apps if app.build_state == App.BuildState.COMPLETED and app.name not in queued]
+
+    def _prestart(self, name, generation):
+        app, ip = None, None
+        try:
+            app = App.get_app(name)
+            ip = app.prestart(WarmPool.MODE) if app else None
+        except Exception as e:
+            print("Error while prestarting {0}: {1}".format(name, e))
+        with self._lock:
+            self._starting[name] -= 1
+            current = self._generations.get(name, 0) == generation
+            added = ip and current and not self._stopped
+            if added:
+                self._idle.setdefault(name, []).append((app.app_id, ip))
+        if added:
+            print("Added notebook server {0} to the warm pool for {1}".format(app.app_id, name))
+        elif app:
+            if ip and not current:
+                print("Discarding notebook server {0}, {1} was invalidated while it started".format(app.app_id, name))
+            else:
+                print("Could not prestart a notebook server for {}".format(name))
+            ClusterManager.get_instance().stop_app(app.app_id)
+
+    def _replenish(self):
+        for app in self._pooled_apps():
+            min_idle, max_size = self.get_limits(app.name)
+            with self._lock:
+                idle = len(self._idle.get(app.name, []))
+                starting = self._starting.get(app.name, 0)
+                num_new = min(min_idle - idle - starting, max_size - idle - starting)
+                if num_new <= 0:
+                    continue
+                self._starting[app.name] = starting + num_new
+                generation = self._generations.get(app.name, 0)
+            for i in range(num_new):
+                self._starter.apply_async(self._prestart, (app.name, generation))
+
+    def _claim(self, name):
+        with self._lock:
+            idle = self._idle.get(name)
+            claimed = idle.pop(0) if idle else None
+        # refill the pool right away instead of waiting for the next period
+        self._wakeup.set()
+        return claimed
+
+    def launch(self, app, mode=MODE):
+        """
+        Launches an app with a server from its pool if possible, and from scratch otherwise. Returns
+        the app's URL
+        """
+        if mode == WarmPool.MODE:
+            cm = ClusterManager.get_instance()
+            claimed = self._claim(app.name)
+            while claimed:
+                app_id, ip = claimed
+                start = time.time()
+                redirect_url = cm.route_app(app_id, ip)
+                if redirect_url:
+                    print("Launched app {0} from the warm pool in {1:.2f}s".format(app.name, time.time() - start))
+                    return redirect_url
+                cm.stop_app(app_id)
+                claimed = self._claim(app.name)
+        return app.deploy(mode)
+
+    def invalidate(self, name):
+        """
+        Stops all idle servers of an app (i.e. when it's being rebuilt), and those still starting
+        once they're up
+        """
+        with self._lock:
+            idle = self._idle.pop(name, [])
+            self._generations[name] = self._generations.get(name, 0) + 1
+        if idle:
+            ClusterManager.get_instance().stop_apps([app_id for app_id, ip in idle])
+
+    def stop(self):
+        self._stopped = True
+        self._wakeup.set()
+        with self._lock:
+            names = self._idle.keys()
+        for name in names:
+            self.invalidate(name)
+
+    def run(self):
+        while not self._stopped:
+            try:
+                self._replenish()
+            except Exception as e:
+                print("Could not replenish the warm pool: {}".format(e))
+            self._wakeup.wait(self._period)
+            self._wakeup.clear()
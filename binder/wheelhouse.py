@@ -0,0 +1,275 @@
+import fcntl
+import os
+import posixpath
+import shutil
+import subprocess
+import tempfile
+import time
+import urllib
+from contextlib import contextmanager
+from threading import Thread
+from BaseHTTPServer import HTTPServer
+from SimpleHTTPServer import SimpleHTTPRequestHandler
+from SocketServer import ThreadingMixIn
+
+from binder.db import get_connection, transaction
+from binder.settings import DB_PATH, WHEELHOUSE_DIR, WHEELHOUSE_HOST, WHEELHOUSE_PORT, WHEELHOUSE_MAX_SIZE
+from binder.utils import make_dir
+
+
+class Wheelhouse(object):
+    """
+    A directory of wheels built for the pips of the base image, shared by all builds. Missing
+    wheels are built in a container of the base image before a deps image is built, and the deps
+    image then installs from the wheelhouse (served by WheelhouseServer) instead of PyPI
+    """
+
+    # pip of each python in the base image, by the wheelhouse subdirectory its wheels go into
+    PIPS = {
+        "py2": "pip",
+        "py3": "/home/main/anaconda/envs/python3/bin/pip"
+    }
+
+    # the singleton wheelhouse
+    wheelhouse = None
+
+    @staticmethod
+    def get_instance():
+        if not Wheelhouse.wheelhouse:
+            Wheelhouse.wheelhouse = Wheelhouse()
+        return Wheelhouse.wheelhouse
+
+    def __init__(self, wheelhouse_dir=WHEELHOUSE_DIR, max_size=WHEELHOUSE_MAX_SIZE, db_path=DB_PATH):
+        self.wheelhouse_dir = wheelhouse_dir
+        self.max_size = max_size
+        self.db_path = db_path
+        make_dir(self.wheelhouse_dir)
+        for python in Wheelhouse.PIPS:
+            make_dir(os.path.join(self.wheelhouse_dir, python))
+        get_connection(self.db_path).executescript("""
+            CREATE TABLE IF NOT EXISTS wheelhouse_lookups (
+                time REAL NOT NULL,
+                python TEXT NOT NULL,
+                requirement TEXT NOT NULL,
+                hit INTEGER NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS wheelhouse_lookups_time ON wheelhouse_lookups (time);
+        """)
+
+    @contextmanager
+    def _lock(self):
+        with open(os.path.join(self.wheelhouse_dir, ".lock"), "w+") as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    @staticmethod
+    def _normalize_name(name):
+        return name.lower().replace("_", "-")
+
+    @staticmethod
+    def _parse_requirement(line):
+        """
+        Returns the (name, pinned version or None) of a requirement line, or None if it doesn't name
+        a package on an index (options, URLs, editable installs...)
+        """
+        if line.startswith("-") or "://" in line:
+            return None
+        spec = line.split(";")[0].strip()
+        for i, c in enumerate(spec):
+            if c in "<>=!~[ ":
+                name, rest = spec[:i], spec[i:].strip()
+                break
+        else:
+            name, rest = spec, ""
+        version = rest[2:].strip() if rest.startswith("==") and "," not in rest else None
+        return Wheelhouse._normalize_name(name), version
+
+    def _find_wheels(self, python):
+        """
+        Returns {(name, version): [wheel paths]} for all the wheels of a python
+        """
+        wheels = {}
+        python_dir = os.path.join(self.wheelhouse_dir, python)
+        for f in os.listdir(python_dir):
+            if f.endswith(".whl"):
+                parts = f.split("-")
+                key = (Wheelhouse._normalize_name(parts[0]), parts[1])
+                wheels.setdefault(key, []).append(os.path.join(python_dir, f))
+        return wheels
+
+    def _lookup(self, python, requirements):
+        """
+        Records which of the requirements already have a wheel, and marks those wheels as used.
+        Returns the number of hits
+        """
+        wheels = self._find_wheels(python)
+        now = time.time()
+        lookups = []
+        for line in requirements:
+            parsed = Wheelhouse._parse_requirement(line)
+            if not parsed:
+                continue
+            name, version = parsed
+            found = [path for (n, v), paths in wheels.items() for path in paths
+                     if n == name and (not version or v == version)]
+            for path in found:
+                try:
+                    os.utime(path, None)
+                except OSError as e:
+                    # e.g. a wheel left behind by older versions, which built them as root
+                    print("Could not mark wheel {0} as used: {1}".format(path, e))
+            lookups.append((now, python, line, 1 if found else 0))
+        conn = get_connection(self.db_path)
+        with transaction(conn):
+            conn.executemany("INSERT INTO wheelhouse_lookups (time, python, requirement, hit) VALUES (?, ?, ?, ?)",
+                             lookups)
+        return sum(lookup[3] for lookup in lookups)
+
+    def _add_wheels(self, python, build_dir):
+        """
+        Moves the wheels built in build_dir into the wheelhouse (called with the lock held). Returns
+        the number of new wheels
+        """
+        python_dir = os.path.join(self.wheelhouse_dir, python)
+        added = 0
+        for f in os.listdir(build_dir):
+            # pip also saves the wheels it found in the wheelhouse, or built at the same time by
+            # another build
+            if f.endswith(".whl") and not os.path.exists(os.path.join(python_dir, f)):
+                os.rename(os.path.join(build_dir, f), os.path.join(python_dir, f))
+                added += 1
+        return added
+
+    def populate(self, requirements, base_image):
+        """
+        Builds the wheels of every requirement (a list of requirement lines) that's missing from the
+        wheelhouse, for every python of the base image. Returns whether all of them could be built
+        """
+        success = True
+        req_dir = tempfile.mkdtemp(dir=self.wheelhouse_dir)
+        try:
+            with open(os.path.join(req_dir, "requirements.txt"), "w+") as req_file:
+                req_file.write("\n".join(requirements) + "\n")
+            for python, pip in Wheelhouse.PIPS.items():
+                with self._lock():
+                    hits = self._lookup(python, requirements)
+                print("Wheelhouse ({0}): {1} of {2} requirements cached".format(python, hits, len(requirements)))
+                # wheels are built into a directory of their own, so that the builds of other apps
+                # don't wait for them, and only moved into the wheelhouse under the lock. pip wheel
+                # doesn't rebuild requirements that already have a wheel in --find-links.
+                # the wheels are built as the binder user (who has no home in the image), so that
+                # it can still mark and evict them
+                build_dir = os.path.join(req_dir, python)
+                os.mkdir(build_dir)
+                cmd = ["docker", "run", "--rm", "--user", "{0}:{1}".format(os.getuid(), os.getgid()),
+                       "-e", "HOME=/tmp",
+                       "-v", "{}:/wheelhouse:ro".format(os.path.join(self.wheelhouse_dir, python)),
+                       "-v", "{}:/build".format(build_dir),
+                       "-v", "{}:/requirements:ro".format(req_dir),
+                       base_image, pip, "wheel", "--find-links", "/wheelhouse", "--wheel-dir", "/build",
+                       "-r", "/requirements/requirements.txt"]
+                if subprocess.call(cmd) != 0:
+                    print("Could not build all wheels for {}".format(python))
+                    success = False
+                with self._lock():
+                    self._add_wheels(python, build_dir)
+            with self._lock():
+                self.evict()
+        finally:
+            shutil.rmtree(req_dir)
+        return success
+
+    def get_size(self):
+        size = 0
+        for python in Wheelhouse.PIPS:
+            for paths in self._find_wheels(python).values():
+                size += sum(os.path.getsize(path) for path in paths)
+        return size
+
+    def evict(self):
+        """
+        Removes the least recently used wheels until the wheelhouse is smaller than max_size.
+        Returns the number of removed wheels
+        """
+        wheels = []
+        for python in Wheelhouse.PIPS:
+            for paths in self._find_wheels(python).values():
+                wheels.extend((os.path.getmtime(path), os.path.getsize(path), path) for path in paths)
+        size = sum(w[1] for w in wheels)
+        removed = 0
+        for mtime, wheel_size, path in sorted(wheels):
+            if size <= self.max_size:
+                break
+            try:
+                os.remove(path)
+            except OSError as e:
+                print("Could not evict wheel {0}: {1}".format(path, e))
+                continue
+            size -= wheel_size
+            removed += 1
+        if removed:
+            print("Evicted {0} wheels from the wheelhouse".format(removed))
+        return removed
+
+    def get_stats(self, since=0):
+        conn = get_connection(self.db_path)
+        lookups, hits = conn.execute("SELECT COUNT(*), COALESCE(SUM(hit), 0) FROM wheelhouse_lookups WHERE time >= ?",
+                                     (since,)).fetchone()
+        misses = [dict(row) for row in conn.execute("""
+            SELECT python, requirement, COUNT(*) AS misses FROM wheelhouse_lookups
+            WHERE time >= ? AND hit = 0
+            GROUP BY python, requirement ORDER BY misses DESC LIMIT 10
+        """, (since,))]
+        return {
+            "lookups": lookups,
+            "hits": hits,
+            "hit_rate": float(hits) / lookups if lookups else None,
+            "size": self.get_size(),
+            "top_misses": misses
+        }
+
+
+class WheelhouseServer(Thread):
+    """
+    Serves the wheelhouse over HTTP, as --find-links pages for the pips running in `docker build`.
+    It only listens on `host`, since anyone it's reachable from can read the wheels
+    """
+
+    # the singleton server
+    server = None
+
+    @staticmethod
+    def get_instance():
+        if not WheelhouseServer.server:
+            WheelhouseServer.server = WheelhouseServer()
+        return WheelhouseServer.server
+
+    class _Server(ThreadingMixIn, HTTPServer):
+        daemon_threads = True
+
+    def __init__(self, wheelhouse_dir=WHEELHOUSE_DIR, host=WHEELHOUSE_HOST, port=WHEELHOUSE_PORT):
+        super(WheelhouseServer, self).__init__()
+        self.daemon = True
+
+        class Handler(SimpleHTTPRequestHandler):
+
+            def translate_path(self, path):
+                path = posixpath.normpath(urllib.unquote(path.split("?", 1)[0].split("#", 1)[0]))
+                parts = [p for p in path.split("/") if p and p not in (os.curdir, os.pardir)]
+                return os.path.join(wheelhouse_dir, *parts)
+
+            def log_message(self, format, *args):
+                pass
+
+        self._httpd = WheelhouseServer._Server((host, port), Handler)
+
+    def stop(self):
+        # shutdown() waits for serve_forever to return, so it would block if the server never started
+        if self.is_alive():
+            self._httpd.shutdown()
+
+    def run(self):
+        self._httpd.serve_forever()
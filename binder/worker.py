@@ -0,0 +1,240 @@
+import os
+import socket
+import sys
+import time
+import Queue
+from threading import Thread
+
+from multiprocess import Process, Queue as ProcessQueue
+
+from binder.app import App
+from binder.concurrency import AdaptiveConcurrency
+from binder.settings import BUILD_HEARTBEAT, BUILD_WORKER_SLOTS, BUILD_CONCURRENCY_ADAPTIVE
+
+# how long an idle worker waits before asking the broker for a job again (in seconds)
+POLL_PERIOD = 1
+
+
+class OutputCapture(Thread):
+    """
+    Captures everything written to the build process's stdout and stderr (including the output of
+    docker and git) and sends it to the worker, as the log of the app's build once it has a build
+    ID. Output written before that is only sent along with the build's first output, or to the
+    worker's own stdout if the build never started
+    """
+
+    CHUNK_SIZE = 16 * 1024
+
+    def __init__(self, job, events):
+        super(OutputCapture, self).__init__()
+        self.job = job
+        self.app = None
+        self._events = events
+        self._saved = (os.dup(1), os.dup(2))
+        self._read_fd, write_fd = os.pipe()
+        sys.stdout.flush()
+        sys.stderr.flush()
+        os.dup2(write_fd, 1)
+        os.dup2(write_fd, 2)
+        os.close(write_fd)
+        sys.stdout = os.fdopen(1, "w", 0)
+        sys.stderr = os.fdopen(2, "w", 0)
+        self.daemon = True
+        self.start()
+
+    def run(self):
+        pending = []
+        build_id = None
+        while True:
+            data = os.read(self._read_fd, OutputCapture.CHUNK_SIZE)
+            if not data:
+                break
+            build_id = self.app.build_id if self.app else None
+            pending.append(data)
+            if build_id is not None:
+                self._events.put(("log", self.job["id"], build_id, "".join(pending), False))
+                pending = []
+        if build_id is not None:
+            self._events.put(("log", self.job["id"], build_id, "".join(pending), True))
+        elif pending:
+            os.write(self._saved[0], "".join(pending))
+        os.close(self._read_fd)
+
+    def stop(self, timeout=10):
+        # restoring the original stdout and stderr closes the pipe, unless a process started by the
+        # build still holds it
+        os.dup2(self._saved[0], 1)
+        os.dup2(self._saved[1], 2)
+        self.join(timeout)
+
+
+def build_app(job, broker, worker_id, preload, events):
+    # runs in the build's own process, and never raises
+    name = job["spec"]["name"]
+    capture = OutputCapture(job, events)
+    try:
+        broker.prepare_build(job, worker_id)
+        # every build state transition is sent back to the worker
+        App.index.add_state_listener(lambda app, state: events.put(("state", job["id"], app.name, state)))
+        # the broker never leases a build of an app that's already building
+        new_app = capture.app = App.create(job["spec"])
+    except Exception as e:
+        print("Could not start building app {}: {}".format(name, e))
+        capture.stop()
+        return
+    try:
+        new_app.build(preload=preload)
+    except Exception as e:
+        # the "catch-all" clause
+        print("Could not build app {}: {}".format(new_app.name, e))
+        App.index.update_build_state(new_app, App.BuildState.FAILED)
+    finally:
+        capture.stop()
+
+
+class BuildWorker(object):
+    """
+    Leases build jobs from a broker and runs up to `slots` of them at once, each in its own
+    process (if adaptive, fewer while the host is overloaded, see AdaptiveConcurrency). The worker
+    renews the lease of each of its jobs every BUILD_HEARTBEAT seconds, and stops a build whose
+    lease was given to another worker. A worker that dies stops renewing its leases, so its jobs
+    are given to another worker once they expire
+    """
+
+    def __init__(self, broker, worker_id=None, slots=BUILD_WORKER_SLOTS, preload=False, on_state_change=None,
+                 on_log=None, heartbeat_period=BUILD_HEARTBEAT, adaptive=BUILD_CONCURRENCY_ADAPTIVE):
+        self.broker = broker
+        self.worker_id = worker_id or "{0}-{1}".format(socket.gethostname(), os.getpid())
+        self.slots = slots
+        self.preload = preload
+        self.heartbeat_period = heartbeat_period
+        self.concurrency = None
+        if adaptive:
+            # periods are recorded with the broker, whose host reports the throughput
+            record = lambda period: broker.record_concurrency(self.worker_id, period)
+            self.concurrency = AdaptiveConcurrency(self.worker_id, slots, record=record)
+        # build logs are sent to the broker by default. Builds record their states with the broker
+        # themselves, on_state_change is only told about them
+        self._on_state_change = on_state_change
+        self._on_log = on_log
+
+        self._events = ProcessQueue()
+        # job ID -> (job, process)
+        self._builds = {}
+        # job ID -> build ID, for the logs that builds haven't finished
+        self._open_logs = {}
+        self._stopped = False
+
+    def _start_build(self, job):
+        print("Worker {0} building {1} (job {2})".format(self.worker_id, job["app"], job["id"]))
+        process = Process(target=build_app, args=(job, self.broker, self.worker_id, self.preload, self._events))
+        process.start()
+        self._builds[job["id"]] = (job, process)
+
+    def _reap_builds(self):
+        finished = [(job_id, job, process) for job_id, (job, process) in self._builds.items()
+                    if not process.is_alive()]
+        if not finished:
+            return
+        # the last output (and states) of the builds are forwarded before their jobs are finished, so
+        # that a build is complete by the time its job is gone from the queue
+        self._forward_events(0)
+        for job_id, job, process in finished:
+            process.join()
+            del self._builds[job_id]
+            # a build that crashed or was killed never finished its log (nor recorded its last state,
+            # which the broker does when the job is finished)
+            self._close_log(job_id, "build process exited with code {}".format(process.exitcode))
+            if self.concurrency:
+                self.concurrency.build_finished()
+            if self.broker.finish(job, self.worker_id) is False:
+                print("Job {} was given to another worker before it finished".format(job_id))
+
+    def _heartbeat(self):
+        for job_id, (job, process) in self._builds.items():
+            # if the broker can't be reached, the build goes on, in case the broker comes back in time
+            if self.broker.heartbeat(job, self.worker_id) is False:
+                print("Lost the lease on job {}, stopping its build".format(job_id))
+                process.terminate()
+                process.join()
+                del self._builds[job_id]
+                # the build is marked FAILED when the job's next build starts. Its log can only be
+                # closed by a local broker, remote ones close it once it's idle
+                self._forward_events(0)
+                self._close_log(job_id, "build stopped, its job was given to another worker")
+
+    def _forward_events(self, timeout):
+        # waiting for events also paces the worker's loop
+        try:
+            events = [self._events.get(timeout=timeout) if timeout else self._events.get_nowait()]
+        except Queue.Empty:
+            return
+        while True:
+            try:
+                events.append(self._events.get_nowait())
+            except Queue.Empty:
+                break
+
+        # the output of a build is sent in one piece per batch of events
+        logs = {}
+        for event in events:
+            if event[0] == "state":
+                kind, job_id, name, state = event
+                if self._on_state_change:
+                    self._on_state_change(name, state)
+            else:
+                kind, job_id, build_id, data, finished = event
+                chunks, _ = logs.get((job_id, build_id), ([], False))
+                chunks.append(data)
+                logs[(job_id, build_id)] = (chunks, finished)
+        for (job_id, build_id), (chunks, finished) in logs.items():
+            if finished:
+                self._open_logs.pop(job_id, None)
+            else:
+                self._open_logs[job_id] = build_id
+            self._send_log(job_id, build_id, "".join(chunks), finished)
+
+    def _send_log(self, job_id, build_id, data, finished):
+        if self._on_log:
+            self._on_log(build_id, data, finished)
+        else:
+            # the last output of a build can arrive after the build was reaped
+            self.broker.append_log({"id": job_id}, self.worker_id, build_id, data, finished)
+
+    def _close_log(self, job_id, reason):
+        build_id = self._open_logs.pop(job_id, None)
+        if build_id is not None:
+            self._send_log(job_id, build_id, "\n[{}]\n".format(reason), True)
+
+    def stop(self):
+        self._stopped = True
+
+    def run(self):
+        if self.concurrency:
+            print("Build worker {0} running {1}-{2} builds at once".format(
+                self.worker_id, self.concurrency.floor, self.slots))
+        else:
+            print("Build worker {0} running {1} builds at once".format(self.worker_id, self.slots))
+        last_heartbeat = time.time()
+        while not self._stopped:
+            self._forward_events(0)
+            self._reap_builds()
+            if time.time() - last_heartbeat >= self.heartbeat_period:
+                self._heartbeat()
+                last_heartbeat = time.time()
+            slots = self.concurrency.update(len(self._builds)) if self.concurrency else self.slots
+            job = None
+            if len(self._builds) < slots:
+                job = self.broker.claim(self.worker_id, max_running=slots)
+                if job:
+                    self._start_build(job)
+            if not job:
+                self._forward_events(POLL_PERIOD)
+        # the interrupted jobs are requeued once their leases expire
+        for job, process in self._builds.values():
+            process.terminate()
+            process.join()
+        self._forward_events(0)
+        for job_id in self._builds.keys():
+            self._close_log(job_id, "build interrupted, its worker stopped")
+        self._builds = {}
@@ -0,0 +1,145 @@
+import json
+import re
+import urlparse
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from SocketServer import ThreadingMixIn
+import time
+from threading import Lock, Thread
+
+
+class FakeKubernetesAPI(ThreadingMixIn, HTTPServer):
+    """
+    A small in-memory stand-in for the Kubernetes API server, good enough for APIClient: objects
+    can be created, read, listed and deleted (deleting a namespace deletes everything inside of it),
+    and watches stream the events queued with add_watch_events before the connection is closed
+    """
+
+    daemon_threads = True
+
+    def __init__(self):
+        HTTPServer.__init__(self, ("127.0.0.1", 0), FakeKubernetesHandler)
+        self.lock = Lock()
+        # (namespace, resource) -> {name: obj}, namespaces and nodes have no namespace
+        self.objects = {}
+        # every request as (method, path, query, headers)
+        self.requests = []
+        # lists of raw lines (or a status code to fail with), one per watch to come
+        self.watch_events = []
+        # how long every request takes to be answered (in seconds)
+        self.delay = 0
+        self._thread = None
+
+    @property
+    def url(self):
+        return "http://{0}:{1}".format(*self.server_address)
+
+    def start(self):
+        self._thread = Thread(target=self.serve_forever)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+    def handle_error(self, request, client_address):
+        # clients that time out close their connections while they're being answered
+        pass
+
+    def add_object(self, resource, obj, namespace=None):
+        with self.lock:
+            self.objects.setdefault((namespace, resource), {})[obj["metadata"]["name"]] = obj
+
+    def add_watch_events(self, events):
+        """
+        Queues the lines (events as dicts, or raw strings) streamed by the next watch, or the status
+        code it fails with
+        """
+        with self.lock:
+            if isinstance(events, int):
+                self.watch_events.append(events)
+            else:
+                self.watch_events.append([e if isinstance(e, basestring) else json.dumps(e) for e in events])
+
+
+class FakeKubernetesHandler(BaseHTTPRequestHandler):
+
+    # /api/v1[/namespaces/<namespace>]/<resource>[/<name>]
+    PATH = re.compile(r"^/api/v1(?:/namespaces/(?P<namespace>[^/]+)(?=/))?/(?P<resource>[^/]+)(?:/(?P<name>[^/]+))?$")
+
+    def log_message(self, *args):
+        pass
+
+    def _parse(self):
+        url = urlparse.urlparse(self.path)
+        query = dict(urlparse.parse_qsl(url.query))
+        self.server.requests.append((self.command, url.path, query, dict(self.headers)))
+        time.sleep(self.server.delay)
+        match = FakeKubernetesHandler.PATH.match(url.path)
+        if not match:
+            return None, None, None, query
+        return match.group("namespace"), match.group("resource"), match.group("name"), query
+
+    def _reply(self, status, body):
+        data = json.dumps(body)
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _status(self, code, message):
+        self._reply(code, {"kind": "Status", "status": "Failure", "message": message, "code": code})
+
+    def do_GET(self):
+        namespace, resource, name, query = self._parse()
+        if not resource:
+            return self._status(404, "not found")
+        if query.get("watch") == "true":
+            return self._watch()
+        with self.server.lock:
+            if name:
+                obj = self.server.objects.get((namespace, resource), {}).get(name)
+                if not obj:
+                    return self._status(404, "{0} \"{1}\" not found".format(resource, name))
+                return self._reply(200, obj)
+            items = [obj for (ns, res), objs in self.server.objects.items()
+                     if res == resource and (namespace is None or ns == namespace) for obj in objs.values()]
+        self._reply(200, {"kind": "List", "items": items})
+
+    def _watch(self):
+        with self.server.lock:
+            lines = self.server.watch_events.pop(0) if self.server.watch_events else []
+        if isinstance(lines, int):
+            return self._status(lines, "watch failed")
+        # the stream ends when the connection is closed
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.end_headers()
+        for line in lines:
+            self.wfile.write(line + "\n")
+        self.close_connection = 1
+
+    def do_POST(self):
+        namespace, resource, name, query = self._parse()
+        obj = json.loads(self.rfile.read(int(self.headers.getheader("Content-Length", 0))))
+        name = obj["metadata"]["name"]
+        with self.server.lock:
+            objs = self.server.objects.setdefault((namespace, resource), {})
+            if name in objs:
+                return self._status(409, "{0} \"{1}\" already exists".format(resource, name))
+            if namespace and namespace not in self.server.objects.get((None, "namespaces"), {}):
+                return self._status(404, "namespaces \"{}\" not found".format(namespace))
+            objs[name] = obj
+        self._reply(201, obj)
+
+    def do_DELETE(self):
+        namespace, resource, name, query = self._parse()
+        with self.server.lock:
+            obj = self.server.objects.get((namespace, resource), {}).pop(name, None)
+            if not obj:
+                return self._status(404, "{0} \"{1}\" not found".format(resource, name))
+            if resource == "namespaces":
+                for key in [key for key in self.server.objects if key[0] == name]:
+                    del self.server.objects[key]
+        self._reply(200, obj)
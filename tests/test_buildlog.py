@@ -0,0 +1,114 @@
+import os
+import shutil
+import tempfile
+import time
+import unittest
+
+from binder import buildlog
+from binder.buildlog import BuildLog, BuildLogStore
+
+
+class BuildLogTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, "1")
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_segments(self):
+        log = BuildLog(self.path, segment_size=10, ring_size=10)
+        for i in range(5):
+            log.append("{:08d}\n".format(i))
+        self.assertEqual(log.size, 45)
+        # full segments are gzipped, the last one is appended to as is
+        self.assertEqual(sorted(os.listdir(self.path)), ["000000000000.gz", "000000000018.gz",
+                                                          "000000000036.log"])
+        # the ring only holds the last bytes, older ones are read from the segments
+        self.assertEqual(log.read(40), "0004\n")
+        self.assertEqual(log.read(5), "000\n00000001\n")
+        self.assertEqual(log.read(20, limit=4), "0000")
+
+    def test_read_from_disk(self):
+        log = BuildLog(self.path, segment_size=10)
+        data = "".join("line {}\n".format(i) for i in range(10))
+        log.append(data[:30])
+        log.append(data[30:])
+        # a read stays within a single segment
+        self.assertEqual(BuildLog.read_from_disk(self.path, 20), {"data": data[20:30], "finished": False})
+        self.assertEqual(BuildLog.read_from_disk(self.path, 35)["data"], data[35:])
+        offset, read = 0, ""
+        while offset < len(data):
+            chunk = BuildLog.read_from_disk(self.path, offset, limit=7)["data"]
+            offset += len(chunk)
+            read += chunk
+        self.assertEqual(read, data)
+        self.assertEqual(BuildLog.read_from_disk(self.path, len(data))["data"], "")
+
+    def test_done(self):
+        log = BuildLog(self.path, segment_size=10)
+        log.append("some output\nmore")
+        log.close()
+        self.assertEqual(BuildLog.read_from_disk(self.path, 0, limit=100),
+                         {"data": "some output\nmore", "finished": True})
+        # a reopened log isn't finished until it's closed again
+        reopened = BuildLog(self.path, segment_size=10)
+        self.assertEqual(reopened.size, 16)
+        self.assertFalse(BuildLog.read_from_disk(self.path, 0)["finished"])
+        reopened.append(" output\n")
+        reopened.close()
+        self.assertEqual(BuildLog.read_from_disk(self.path, 16), {"data": " output\n", "finished": True})
+
+    def test_max_size(self):
+        log = BuildLog(self.path, max_size=10)
+        log.append("0123456789abc")
+        log.append("def")
+        self.assertEqual(BuildLog.read_from_disk(self.path, 0)["data"], "0123456789\n[log truncated at 10 bytes]\n")
+
+
+class BuildLogStoreTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.store = BuildLogStore(log_dir=self.dir, idle_timeout=60)
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_read(self):
+        self.assertIsNone(self.store.read(1))
+        self.store.append(1, "first\n")
+        self.assertEqual(self.store.read(1), {"data": "first\n", "offset": 6, "finished": False})
+        self.store.append(1, "second\n", finished=True)
+        self.assertEqual(self.store.read(1, 6), {"data": "second\n", "offset": 13, "finished": False})
+        # readers only see a log as finished once they've read all of it
+        self.assertEqual(self.store.read(1, 13), {"data": "", "offset": 13, "finished": True})
+
+    def test_idle_close(self):
+        self.store.append(1, "output\n")
+        self.store.append(2, "output\n")
+        self.store._logs[1].updated -= 120
+        self.store._last_idle_check -= buildlog.IDLE_CHECK_PERIOD
+        self.assertFalse(self.store.read(2)["finished"])
+        self.assertEqual(sorted(self.store._logs), [2])
+        result = self.store.read(1, 7)
+        self.assertIn("log closed", result["data"])
+        self.assertTrue(self.store.read(1, result["offset"])["finished"])
+        # the idle check runs at most once per period
+        self.store._logs[2].updated -= 120
+        self.store.read(2)
+        self.assertEqual(sorted(self.store._logs), [2])
+
+    def test_collect_garbage(self):
+        self.store.append(1, "old\n", finished=True)
+        self.store.append(2, "new\n", finished=True)
+        old = time.time() - 3 * 24 * 3600
+        os.utime(os.path.join(self.dir, "1"), (old, old))
+        self.assertEqual(self.store.collect_garbage(2), 1)
+        self.assertIsNone(self.store.read(1))
+        self.assertIsNotNone(self.store.read(2))
+
+
+if __name__ == "__main__":
+    unittest.main()
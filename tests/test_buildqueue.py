@@ -0,0 +1,124 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from binder.buildqueue import BuildQueue
+
+
+def make_spec(name, **fields):
+    spec = {"name": name, "repo": "https://www.github.com/{}".format(name.replace("-", "/"))}
+    spec.update(fields)
+    return spec
+
+
+class BuildQueueTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.queue = BuildQueue(db_path=os.path.join(self.dir, "binder.db"))
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_claim(self):
+        submitted = self.queue.submit(make_spec("a-app"), "a")
+        self.assertNotIn("spec", submitted)
+        job = self.queue.claim("worker-1")
+        self.assertEqual(job["id"], submitted["id"])
+        self.assertEqual(job["spec"], make_spec("a-app"))
+        self.assertEqual((job["state"], job["worker"]), (BuildQueue.RUNNING, "worker-1"))
+        self.assertIsNone(self.queue.claim("worker-2"))
+
+        self.assertEqual(self.queue.get_leased_job(job["id"], "worker-1")["app"], "a-app")
+        self.assertIsNone(self.queue.get_leased_job(job["id"], "worker-2"))
+        self.assertFalse(self.queue.finish(job["id"], "worker-2"))
+        self.assertTrue(self.queue.finish(job["id"], "worker-1"))
+        self.assertEqual(self.queue.get_stats()["running"], 0)
+
+    def test_max_running(self):
+        self.queue.submit(make_spec("a-one"), "a")
+        self.queue.submit(make_spec("a-two"), "a")
+        self.assertIsNotNone(self.queue.claim("worker-1", max_running=1))
+        self.assertIsNone(self.queue.claim("worker-1", max_running=1))
+        self.assertIsNotNone(self.queue.claim("worker-2", max_running=1))
+
+    def test_coalescing(self):
+        first = self.queue.submit(make_spec("a-app", version=1), "a")
+        second = self.queue.submit(make_spec("a-app", version=2), "a")
+        self.assertEqual(second["id"], first["id"])
+        self.assertEqual(second["coalesced"], 1)
+        self.assertEqual(second["submitted"], first["submitted"])
+        self.assertEqual(self.queue.claim("worker-1")["spec"]["version"], 2)
+        self.assertIsNone(self.queue.claim("worker-1"))
+
+    def test_running_app_is_not_claimed_again(self):
+        running = self.queue.submit(make_spec("a-app"), "a")
+        self.queue.claim("worker-1")
+        rebuild = self.queue.submit(make_spec("a-app"), "a")
+        self.assertNotEqual(rebuild["id"], running["id"])
+        self.assertIsNone(self.queue.claim("worker-2"))
+        self.assertEqual([job["id"] for job in self.queue.get_order()], [rebuild["id"]])
+        self.queue.finish(running["id"], "worker-1")
+        self.assertEqual(self.queue.claim("worker-2")["id"], rebuild["id"])
+
+    def test_priority_bump(self):
+        self.queue.submit(make_spec("a-first"), "a")
+        self.queue.submit(make_spec("b-second"), "b")
+        bumped = self.queue.submit(make_spec("b-second"), "b", priority=5)
+        self.assertEqual(bumped["priority"], 5)
+        # a coalesced submission never lowers the priority
+        self.assertEqual(self.queue.submit(make_spec("b-second"), "b", priority=-5)["priority"], 5)
+        self.assertEqual([job["app"] for job in self.queue.get_order()], ["b-second", "a-first"])
+        self.assertEqual(self.queue.claim("worker-1")["app"], "b-second")
+
+    def test_owner_fairness(self):
+        for name in ["a-one", "a-two", "a-three"]:
+            self.queue.submit(make_spec(name), "a")
+        self.queue.submit(make_spec("b-one"), "b")
+        self.queue.submit(make_spec("c-one"), "c")
+        expected = ["a-one", "b-one", "c-one", "a-two", "a-three"]
+        self.assertEqual([job["app"] for job in self.queue.get_order()], expected)
+        # get_order predicts the order of claims
+        self.assertEqual([self.queue.claim("worker-1")["app"] for _ in expected], expected)
+
+    def test_owner_with_running_builds_waits(self):
+        self.queue.submit(make_spec("a-one"), "a")
+        self.queue.claim("worker-1")
+        self.queue.submit(make_spec("a-two"), "a")
+        self.queue.submit(make_spec("b-one"), "b")
+        self.assertEqual([job["app"] for job in self.queue.get_order()], ["b-one", "a-two"])
+
+    def test_lease_expiry(self):
+        job = self.queue.submit(make_spec("a-app"), "a")
+        self.queue.claim("worker-1", lease=-1)
+        self.assertFalse(self.queue.heartbeat(job["id"], "worker-2"))
+        # until it's reclaimed, an expired lease can still be renewed
+        self.assertTrue(self.queue.heartbeat(job["id"], "worker-1", lease=-1))
+
+        # the next claim requeues the expired job, and leases it again
+        reclaimed = self.queue.claim("worker-2")
+        self.assertEqual((reclaimed["id"], reclaimed["worker"]), (job["id"], "worker-2"))
+        self.assertFalse(self.queue.heartbeat(job["id"], "worker-1"))
+        self.assertFalse(self.queue.finish(job["id"], "worker-1"))
+        self.assertTrue(self.queue.heartbeat(job["id"], "worker-2"))
+
+    def test_expired_job_replaced_by_newer_submission(self):
+        old = self.queue.submit(make_spec("a-app", version=1), "a")
+        self.queue.claim("worker-1", lease=-1)
+        new = self.queue.submit(make_spec("a-app", version=2), "a")
+        job = self.queue.claim("worker-2")
+        self.assertEqual((job["id"], job["spec"]["version"]), (new["id"], 2))
+        self.assertIsNone(self.queue.get_leased_job(old["id"], "worker-1"))
+        self.assertEqual(self.queue.get_stats()["running"], 1)
+
+    def test_requeue_running(self):
+        job = self.queue.submit(make_spec("a-app"), "a")
+        self.queue.claim("worker-1")
+        self.assertEqual(self.queue.requeue_running("worker-1"), 1)
+        self.assertEqual(self.queue.get_queued_apps(), set(["a-app"]))
+        self.assertEqual(self.queue.claim("worker-2")["id"], job["id"])
+
+
+if __name__ == "__main__":
+    unittest.main()
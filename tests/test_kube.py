@@ -0,0 +1,115 @@
+import unittest
+
+from binder.kube import APIClient
+from tests.fake_kube import FakeKubernetesAPI
+
+
+def make_obj(kind, name, **fields):
+    obj = {"kind": kind, "apiVersion": "v1", "metadata": {"name": name}}
+    obj.update(fields)
+    return obj
+
+
+class APIClientTest(unittest.TestCase):
+
+    def setUp(self):
+        self.api = FakeKubernetesAPI()
+        self.api.start()
+        self.api.add_object("namespaces", make_obj("Namespace", "default"))
+        self.client = APIClient(self.api.url, token="secret", pool_size=2, timeout=5)
+
+    def tearDown(self):
+        self.api.stop()
+
+    def test_get(self):
+        pod = make_obj("Pod", "notebook", status={"phase": "Running"})
+        self.api.add_object("pods", pod, namespace="app-1")
+        self.assertEqual(self.client.get_pod("notebook", "app-1"), pod)
+        self.assertIsNone(self.client.get_pod("missing", "app-1"))
+        method, path, query, headers = self.api.requests[0]
+        self.assertEqual((method, path), ("GET", "/api/v1/namespaces/app-1/pods/notebook"))
+        self.assertEqual(headers["authorization"], "Bearer secret")
+
+    def test_list(self):
+        self.api.add_object("pods", make_obj("Pod", "a"), namespace="app-1")
+        self.api.add_object("pods", make_obj("Pod", "b"), namespace="app-2")
+        self.assertEqual(sorted(p["metadata"]["name"] for p in self.client.list_pods()), ["a", "b"])
+        self.assertEqual([n["metadata"]["name"] for n in self.client.list_namespaces()], ["default"])
+
+    def test_create(self):
+        service = make_obj("Service", "proxy")
+        self.assertTrue(self.client.create(service))
+        self.assertEqual(self.api.objects[("default", "services")]["proxy"], service)
+        # the object already exists
+        self.assertFalse(self.client.create(service))
+        self.assertFalse(self.client.create(make_obj("Unknown", "thing")))
+
+    def test_apply(self):
+        objects = [make_obj("Pod", "notebook"), make_obj("Service", "notebook"), make_obj("Namespace", "app-1")]
+        results = self.client.apply(objects, namespace="app-1")
+        self.assertTrue(all(result["created"] for result in results))
+        self.assertEqual(results[0]["kind"], "Namespace")
+        self.assertIn("notebook", self.api.objects[("app-1", "pods")])
+
+        # nothing is created in a namespace that couldn't be created
+        results = self.client.apply([make_obj("Namespace", "app-1"), make_obj("Pod", "other")], namespace="app-1")
+        self.assertEqual([result["created"] for result in results], [False, False])
+        self.assertEqual(results[1]["error"], "namespace not created")
+
+    def test_delete_namespace(self):
+        self.api.add_object("namespaces", make_obj("Namespace", "app-1"))
+        self.api.add_object("pods", make_obj("Pod", "notebook"), namespace="app-1")
+        self.assertTrue(self.client.delete_namespace("app-1"))
+        self.assertNotIn(("app-1", "pods"), self.api.objects)
+        self.assertFalse(self.client.delete_namespace("app-1"))
+
+    def test_watch_pod(self):
+        pending = make_obj("Pod", "notebook", status={"phase": "Pending"})
+        running = make_obj("Pod", "notebook", status={"phase": "Running"})
+        self.api.add_watch_events([{"type": "ADDED", "object": pending}, "",
+                                   {"type": "MODIFIED", "object": running}])
+        pods = list(self.client.watch_pod("notebook", "app-1", timeout=1))
+        self.assertEqual(pods, [pending, running])
+        method, path, query, headers = self.api.requests[0]
+        self.assertEqual(path, "/api/v1/namespaces/app-1/pods")
+        self.assertEqual(query["fieldSelector"], "metadata.name=notebook")
+        self.assertEqual(query["watch"], "true")
+
+    def test_watch_pod_resumed(self):
+        # the first watch ends early, the next one starts from the last seen version
+        pending = make_obj("Pod", "notebook", status={"phase": "Pending"})
+        pending["metadata"]["resourceVersion"] = "7"
+        running = make_obj("Pod", "notebook", status={"phase": "Running"})
+        self.api.add_watch_events([{"type": "ADDED", "object": pending}])
+        self.api.add_watch_events([{"type": "MODIFIED", "object": running}])
+        self.assertEqual(list(self.client.watch_pod("notebook", "app-1", timeout=1)), [pending, running])
+        watches = [query for method, path, query, headers in self.api.requests]
+        self.assertNotIn("resourceVersion", watches[0])
+        self.assertEqual(watches[1]["resourceVersion"], "7")
+
+    def test_watch_pod_errors(self):
+        self.api.add_watch_events(403)
+        self.assertEqual(list(self.client.watch_pod("notebook", "app-1", timeout=1)), [])
+        self.assertEqual(len(self.api.requests), 1)
+
+        status = {"kind": "Status", "status": "Failure", "code": 500, "message": "internal error"}
+        self.api.add_watch_events([{"type": "ERROR", "object": status}])
+        self.assertEqual(list(self.client.watch_pod("notebook", "app-1", timeout=1)), [])
+        self.api.add_watch_events([{"object": status}])
+        self.assertEqual(list(self.client.watch_pod("notebook", "app-1", timeout=1)), [])
+        self.assertEqual(len(self.api.requests), 3)
+
+    def test_timeout(self):
+        self.api.delay = 2
+        client = APIClient(self.api.url, timeout=0.5)
+        self.assertIsNone(client.get_pod("notebook", "app-1"))
+
+    def test_unreachable(self):
+        self.api.stop()
+        self.assertIsNone(self.client.get_pod("notebook", "app-1"))
+        self.assertFalse(self.client.create(make_obj("Pod", "notebook")))
+        self.assertIsNone(self.client.list_nodes())
+
+
+if __name__ == "__main__":
+    unittest.main()
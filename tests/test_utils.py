@@ -0,0 +1,71 @@
+import sys
+import unittest
+from StringIO import StringIO
+
+from binder import utils
+from binder.utils import Template, fill_template_string, namespace_params
+
+
+class TemplateTest(unittest.TestCase):
+
+    def setUp(self):
+        Template._cache.clear()
+
+    def test_render(self):
+        template = Template("image: {{app.image}}\nport: {{app.port}}\nname: {{app.image}}-{{unknown}}\n")
+        self.assertEqual(template.placeholders, frozenset(["app.image", "app.port", "unknown"]))
+        params = namespace_params("app", {"image": "gcr.io/app", "port": 8888})
+        # placeholders without a parameter are left as is
+        self.assertEqual(template.render(params), "image: gcr.io/app\nport: 8888\nname: gcr.io/app-{{unknown}}\n")
+        self.assertEqual(template.get_unfilled(params), ["unknown"])
+
+    def test_render_is_single_pass(self):
+        # filled values aren't filled again, whatever the order of the parameters
+        params = {"a": "{{b}}", "b": "x"}
+        self.assertEqual(Template("{{a}} {{b}}").render(params), "{{b}} x")
+        self.assertEqual(Template("no placeholders {}").render(params), "no placeholders {}")
+
+    def test_cache(self):
+        parsed = Template.get("{{a}}")
+        self.assertIs(Template.get("{{a}}"), parsed)
+        self.assertIsNot(Template.get("{{b}}"), parsed)
+
+    def test_cache_size(self):
+        original_size = utils.TEMPLATE_CACHE_SIZE
+        utils.TEMPLATE_CACHE_SIZE = 2
+        try:
+            first = Template.get("{{a}}")
+            Template.get("{{b}}")
+            # a full cache is emptied before the next template is added
+            Template.get("{{c}}")
+            self.assertEqual(len(Template._cache), 1)
+            self.assertIsNot(Template.get("{{a}}"), first)
+        finally:
+            utils.TEMPLATE_CACHE_SIZE = original_size
+
+
+class FillTemplateStringTest(unittest.TestCase):
+
+    def setUp(self):
+        self.stdout, sys.stdout = sys.stdout, StringIO()
+
+    def tearDown(self):
+        sys.stdout = self.stdout
+
+    def test_fill(self):
+        self.assertEqual(fill_template_string("{{x}}+{{y}}", {"x": 1, "y": 2}), "1+2")
+        self.assertEqual(sys.stdout.getvalue(), "")
+
+    def test_unfilled_reported_for_named_templates(self):
+        filled = fill_template_string("{{x}} {{z}} {{y}}", {"x": 1}, name="pod.json")
+        self.assertEqual(filled, "1 {{z}} {{y}}")
+        self.assertEqual(sys.stdout.getvalue(), "Unfilled placeholders in pod.json: y, z\n")
+
+    def test_unfilled_not_reported_without_name(self):
+        self.assertEqual(fill_template_string("{{x}}", {}), "{{x}}")
+        fill_template_string("{{x}}", {"x": 1}, name="filled.json")
+        self.assertEqual(sys.stdout.getvalue(), "")
+
+
+if __name__ == "__main__":
+    unittest.main()
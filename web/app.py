@@ -1,27 +1,96 @@
-import Queue
+import hmac
 import json
 import signal
 import time
 
 from tornado import gen
-from tornado.ioloop import IOLoop
+from tornado.ioloop import IOLoop, PeriodicCallback
 from tornado.web import Application, RequestHandler
 from tornado.httpserver import HTTPServer
+from tornado.iostream import StreamClosedError
 
 from binder.service import Service
 from binder.app import App
+from binder.broker import LocalBroker
+from binder.buildcache import BuildCache
+from binder.buildlog import BuildLogStore
+from binder.buildstate import BuildStateStore
+from binder.concurrency import AdaptiveConcurrency
 from binder.cluster import ClusterManager
+from binder.inventory import ClusterInventory
+from binder.culler import Culler
+from binder.settings import APP_INDEX, BROKER_TOKEN, BUILD_LOG_MAX_AGE, CULL_IN_PROCESS, OPERATOR_TOKEN
+from binder.warmpool import WarmPool
+from binder.wheelhouse import WheelhouseServer
 
-from .builder import Builder
+from .builder import Builder, LOCAL_WORKER_ID, NUM_WORKERS as NUM_BUILD_WORKERS
+from .launcher import Launcher
+from .scheduler import BuildScheduler
+from .status import StatusHub
 
 # TODO move settings into a config file
 PORT = 8080
 NUM_WORKERS = 10
 PRELOAD = True
-QUEUE_SIZE = 50
+# the most builds returned by a timeline request
+MAX_TIMELINE_LIMIT = 100
+# builds can be submitted with a priority between -MAX_PRIORITY and MAX_PRIORITY (default 0). Priorities
+# above 0 need the OPERATOR_TOKEN, so that they don't defeat the fairness between owners
+MAX_PRIORITY = 10
 ALLOW_ORIGIN = True
-
-build_queue = Queue.Queue(QUEUE_SIZE)
+# max number of apps being deployed at once
+LAUNCH_WORKERS = 20
+# how long long-polling status requests are held open (in seconds)
+LONG_POLL_TIMEOUT = 30
+# how often keep-alive comments are sent on status streams (in seconds)
+STREAM_HEARTBEAT = 15
+# how often log streams check for output written by other processes (in seconds)
+LOG_POLL_PERIOD = 1
+# how often the build store is checked for states recorded by other processes (in seconds)
+STATE_POLL_PERIOD = 2
+# how often build logs older than BUILD_LOG_MAX_AGE are removed (in seconds)
+LOG_GC_PERIOD = 3600
+
+scheduler = BuildScheduler(NUM_BUILD_WORKERS, LOCAL_WORKER_ID)
+status_hub = StatusHub()
+launcher = Launcher(LAUNCH_WORKERS, status_hub=status_hub)
+
+class BuildStatePoller(object):
+    """
+    Publishes the build states recorded by other processes (command line builds, standalone workers)
+    into the status hub, which only hears about the builds of the web API's own worker otherwise
+    """
+
+    def __init__(self, hub):
+        self._hub = hub
+        self._since = time.time()
+
+    def poll(self):
+        now = time.time()
+        # a transition is timestamped before it's committed, so consecutive polls overlap
+        updates = BuildStateStore.get_instance().get_updates(self._since - STATE_POLL_PERIOD)
+        self._since = now
+        for app_name, state in updates.items():
+            status = self._hub.get(app_name)
+            # apps that nobody has asked about yet are read from the index when they are
+            if status and status["state"] != state:
+                self._hub.publish(app_name, state)
+
+def parse_non_negative_int(value):
+    # parses the versions and offsets passed by clients, returns None unless value is a non-negative integer
+    try:
+        number = int(value)
+    except (TypeError, ValueError):
+        return None
+    return number if number >= 0 else None
+
+def parse_hours(value):
+    # for report periods passed by clients, returns None unless value is a positive number of hours
+    try:
+        hours = float(value)
+    except (TypeError, ValueError):
+        return None
+    return hours if 0 < hours < float("inf") else None
 
 class BinderHandler(RequestHandler):
 
@@ -39,15 +108,15 @@ class BuildHandler(BinderHandler):
         # by default, there aren't any required fields in an app specification
         pass
 
-    def _write_build_state(self, app):
-        if app.build_state == App.BuildState.BUILDING:
-            self.write({"build_status": "building"})
-        elif app.build_state == App.BuildState.FAILED:
-            self.write({"build_status": "failed"})
-        elif app.build_state == App.BuildState.COMPLETED:
-             self.write({"build_status": "completed"})
+    def _get_build_status(self, state):
+        if state == App.BuildState.BUILDING:
+            return "building"
+        elif state == App.BuildState.FAILED:
+            return "failed"
+        elif state == App.BuildState.COMPLETED:
+            return "completed"
         else:
-            self.write({"build_status": "unknown"})
+            return "unknown"
 
 
 class GithubHandler(BuildHandler):
@@ -62,15 +131,77 @@ class GithubHandler(BuildHandler):
 
 class GithubStatusHandler(GithubHandler):
 
+    def _get_status(self, app_name):
+        # build states are pushed into the status hub by the builder (and by the BuildStatePoller
+        # for the builds of other processes), so the app index is only read the first time an app
+        # is asked about
+        status = status_hub.get(app_name)
+        if not status:
+            app = App.get_app(app_name)
+            if not app:
+                return None
+            status_hub.publish(app_name, app.build_state)
+            status = status_hub.get(app_name)
+        return status
+
+    @gen.coroutine
     def get(self, organization, repo):
         super(GithubStatusHandler, self).get()
         app_name = self._make_app_name(organization, repo)
-        app = App.get_app(app_name)
-        if not app:
+        status = self._get_status(app_name)
+        if not status:
             self.set_status(404)
             self.write({"error": "app does not exist"})
-        else:
-            self._write_build_state(app)
+            return
+        # long-polling clients pass the last version they've seen, and get an answer once the
+        # status changes (or the request times out)
+        since = self.get_argument("since", None)
+        if since is not None:
+            since = parse_non_negative_int(since)
+            if since is None:
+                self.set_status(400)
+                self.write({"error": "since must be a non-negative integer"})
+                return
+            status = yield status_hub.wait(app_name, since, LONG_POLL_TIMEOUT)
+        self.write({"build_status": self._get_build_status(status["state"]), "version": status["version"]})
+
+
+class GithubStatusStreamHandler(GithubStatusHandler):
+
+    def on_connection_close(self):
+        self._closed = True
+
+    @gen.coroutine
+    def get(self, organization, repo):
+        super(GithubStatusHandler, self).get()
+        self._closed = False
+        version = parse_non_negative_int(self.request.headers.get("Last-Event-ID", "0"))
+        if version is None:
+            self.set_status(400)
+            self.write({"error": "Last-Event-ID must be a non-negative integer"})
+            return
+        app_name = self._make_app_name(organization, repo)
+        status = self._get_status(app_name)
+        if not status:
+            self.set_status(404)
+            self.write({"error": "app does not exist"})
+            return
+
+        # server-sent events, resuming after the last event a reconnecting client has seen
+        self.set_header("Content-Type", "text/event-stream")
+        self.set_header("Cache-Control", "no-cache")
+        while not self._closed:
+            status = yield status_hub.wait(app_name, version, STREAM_HEARTBEAT)
+            if status["version"] > version:
+                version = status["version"]
+                data = json.dumps({"build_status": self._get_build_status(status["state"])})
+                self.write("id: {0}\ndata: {1}\n\n".format(version, data))
+            else:
+                self.write(": keep-alive\n\n")
+            try:
+                yield self.flush()
+            except StreamClosedError:
+                break
 
 
 class GithubBuildHandler(GithubHandler):
@@ -78,33 +209,119 @@ class GithubBuildHandler(GithubHandler):
     @gen.coroutine
     def get(self, organization, repo):
         # if the app is still building, return an error. If the app is built, deploy it and return
-        # the redirect url
+        # the redirect url (or, if the "async" argument is set, the launch ID right away)
         super(GithubHandler, self).get()
         app_name = self._make_app_name(organization, repo)
         app = App.get_app(app_name)
         if app and app.build_state == App.BuildState.COMPLETED:
-            redirect_url = app.deploy("single-node")
-            self.write({"redirect_url": redirect_url})
+            launch, future = launcher.launch(app, "single-node")
+            if self.get_argument("async", None):
+                self.write({"launch_id": launch["id"], "status_url": "/launches/" + launch["id"]})
+                return
+            # the deployment runs in the launcher's threads, so other requests are served meanwhile
+            launch = yield future
+            self.write({"redirect_url": launch["redirect_url"], "launch_id": launch["id"]})
         else:
             self.set_status(404)
             self.write({"error": "no app available to deploy"})
 
+    def _is_operator(self):
+        if not OPERATOR_TOKEN:
+            return False
+        expected = "token {}".format(OPERATOR_TOKEN)
+        return hmac.compare_digest(str(self.request.headers.get("Authorization", "")), expected)
+
     def post(self, organization, repo):
         # if the spec is properly formed, create/build the app
         super(GithubBuildHandler, self).post()
         print("request.body: {}".format(self.request.body))
         spec = json.loads(self.request.body)
+        try:
+            priority = max(min(int(self.get_argument("priority", 0)), MAX_PRIORITY), -MAX_PRIORITY)
+        except ValueError:
+            priority = None
         if self._is_malformed(spec):
             self.set_status(400)
             self.write({"error": "malformed app specification"})
+        elif priority is None:
+            self.set_status(400)
+            self.write({"error": "priority must be an integer"})
+        elif priority > 0 and not self._is_operator():
+            self.set_status(403)
+            self.write({"error": "only operators can raise the priority of a build"})
         else:
-            try:
-                spec["name"] = self._make_app_name(organization, repo).lower()
-                spec["repo"] = "https://www.github.com/{0}/{1}".format(organization, repo)
-                build_queue.put(spec)
-                self.write({"success": "app submitted to build queue"})
-            except Queue.Full:
-                self.write({"error": "build queue full"})
+            spec["name"] = self._make_app_name(organization, repo).lower()
+            spec["repo"] = "https://www.github.com/{0}/{1}".format(organization, repo)
+            scheduler.submit(spec, organization.lower(), priority)
+            # servers prestarted with the old image shouldn't be handed out anymore
+            WarmPool.get_instance().invalidate(spec["name"])
+            response = {"success": "app submitted to build queue", "status_url": self.request.path + "/queue"}
+            response.update(scheduler.get_position(spec["name"]) or {})
+            self.write(response)
+
+
+class GithubQueueHandler(GithubHandler):
+
+    def get(self, organization, repo):
+        super(GithubQueueHandler, self).get()
+        position = scheduler.get_position(self._make_app_name(organization, repo))
+        if not position:
+            self.set_status(404)
+            self.write({"error": "app has no pending build"})
+            return
+        self.write(position)
+
+
+class GithubTimelineHandler(GithubHandler):
+
+    def get(self, organization, repo):
+        super(GithubTimelineHandler, self).get()
+        app_name = self._make_app_name(organization, repo)
+        limit = parse_non_negative_int(self.get_argument("limit", "10"))
+        if not limit:
+            self.set_status(400)
+            self.write({"error": "limit must be a positive integer"})
+            return
+        builds = BuildStateStore.get_instance().get_history(app_name, min(limit, MAX_TIMELINE_LIMIT))
+        if not builds:
+            self.set_status(404)
+            self.write({"error": "app has no recorded builds"})
+            return
+        self.write({"builds": builds})
+
+
+class GithubLogHandler(GithubHandler):
+
+    def get(self, organization, repo, stream=None):
+        # the log of the app's latest build
+        super(GithubLogHandler, self).get()
+        build_id = BuildStateStore.get_instance().get_latest_id(self._make_app_name(organization, repo))
+        if not build_id:
+            self.set_status(404)
+            self.write({"error": "app has no recorded builds"})
+            return
+        url = "/builds/{0}/log{1}".format(build_id, stream or "")
+        if self.request.query:
+            url += "?" + self.request.query
+        self.redirect(url)
+
+
+class LaunchHandler(BinderHandler):
+
+    @gen.coroutine
+    def get(self, launch_id):
+        super(LaunchHandler, self).get()
+        launch = launcher.get_launch(launch_id)
+        if not launch:
+            self.set_status(404)
+            self.write({"error": "launch does not exist"})
+            return
+        # long-polling clients wait until the launch finishes (or the request times out)
+        if self.get_argument("wait", None) and launch["state"] == Launcher.LaunchState.LAUNCHING:
+            channel = Launcher.get_channel(launch_id)
+            status = status_hub.get(channel)
+            yield status_hub.wait(channel, status["version"] if status else 0, LONG_POLL_TIMEOUT)
+        self.write(launch)
 
 
 class OtherSourceHandler(BuildHandler):
@@ -130,22 +347,303 @@ class AppsHandler(BinderHandler):
 
 class CapacityHandler(BinderHandler):
 
-    POLL_PERIOD = 3600
-
-    cached_capacity = None
-    last_poll = None
-    
     def get(self):
         super(CapacityHandler, self).get()
+        # answered from the in-memory cluster inventory
         cm = ClusterManager.get_instance()
-        # don't count the default and kube-system namespaces
-        running = len(cm.get_running_apps()) - 3
-        if not self.last_poll or not self.cached_capacity or\
-                time.time() - self.last_poll > CapacityHandler.POLL_PERIOD:
-            capacity = cm.get_total_capacity()
-            CapacityHandler.cached_capacity = capacity
-            CapacityHandler.last_poll = time.time()
-        self.write({"capacity": self.cached_capacity, "running": running})
+        self.write({
+            "capacity": cm.get_total_capacity(),
+            "running": len(cm.get_running_apps()),
+            "allocated": cm.get_allocated_pods()
+        })
+
+class BuildStagesHandler(BinderHandler):
+
+    def get(self):
+        super(BuildStagesHandler, self).get()
+        hours = parse_hours(self.get_argument("hours", "24"))
+        if hours is None:
+            self.set_status(400)
+            self.write({"error": "hours must be a positive number"})
+            return
+        stages = BuildStateStore.get_instance().get_stage_stats(time.time() - hours * 3600)
+        self.write({"hours": hours, "stages": stages})
+
+def get_log_channel(build_id):
+    return "log:{}".format(build_id)
+
+def on_build_log(build_id, data, finished):
+    # called from the builder's thread. Readers of a finished log don't wait on its channel anymore
+    BuildLogStore.get_instance().append(build_id, data, finished)
+    status_hub.publish_threadsafe(get_log_channel(build_id), finished)
+    if finished:
+        status_hub.discard_threadsafe(get_log_channel(build_id))
+
+class BuildLogHandler(BinderHandler):
+
+    def get(self, build_id):
+        # the log from ?offset on, with the offset to continue from in X-Log-Offset
+        super(BuildLogHandler, self).get()
+        offset = parse_non_negative_int(self.get_argument("offset", "0"))
+        if offset is None:
+            self.set_status(400)
+            self.write({"error": "offset must be a non-negative integer"})
+            return
+        result = BuildLogStore.get_instance().read(build_id, offset)
+        if not result:
+            self.set_status(404)
+            self.write({"error": "build has no log"})
+            return
+        self.set_header("Content-Type", "text/plain; charset=utf-8")
+        self.set_header("X-Log-Offset", str(result["offset"]))
+        self.set_header("X-Log-Finished", "1" if result["finished"] else "0")
+        self.write(result["data"])
+
+class BuildLogStreamHandler(BinderHandler):
+
+    def on_connection_close(self):
+        self._closed = True
+
+    @gen.coroutine
+    def get(self, build_id):
+        super(BuildLogStreamHandler, self).get()
+        self._closed = False
+        offset = parse_non_negative_int(self.request.headers.get("Last-Event-ID", self.get_argument("offset", "0")))
+        if offset is None:
+            self.set_status(400)
+            self.write({"error": "offset must be a non-negative integer"})
+            return
+        logs = BuildLogStore.get_instance()
+        if not logs.read(build_id, 0, 0):
+            self.set_status(404)
+            self.write({"error": "build has no log"})
+            return
+
+        # server-sent events of whole lines, with the offset of the next line as their ID, so that a
+        # reconnecting client resumes where it left off
+        self.set_header("Content-Type", "text/event-stream")
+        self.set_header("Cache-Control", "no-cache")
+        channel = get_log_channel(build_id)
+        idle = 0
+        while not self._closed:
+            result = logs.read(build_id, offset)
+            data = result["data"]
+            if data and "\n" in data and not result["finished"]:
+                data = data[:data.rindex("\n") + 1]
+            if data:
+                offset += len(data)
+                text = json.dumps({"text": data.decode("utf-8", "replace")})
+                self.write("id: {0}\ndata: {1}\n\n".format(offset, text))
+                idle = 0
+            elif result["finished"]:
+                self.write("event: end\ndata: {}\n\n")
+                break
+            else:
+                # woken up by new output from the local builder, or polling for that of other processes
+                status = status_hub.get(channel)
+                yield status_hub.wait(channel, status["version"] if status else 0, LOG_POLL_PERIOD)
+                idle += LOG_POLL_PERIOD
+                if idle < STREAM_HEARTBEAT:
+                    continue
+                self.write(": keep-alive\n\n")
+                idle = 0
+            try:
+                yield self.flush()
+            except StreamClosedError:
+                break
+
+class BuildConcurrencyHandler(BinderHandler):
+
+    def get(self):
+        super(BuildConcurrencyHandler, self).get()
+        hours = parse_hours(self.get_argument("hours", "24"))
+        if hours is None:
+            self.set_status(400)
+            self.write({"error": "hours must be a positive number"})
+            return
+        levels = AdaptiveConcurrency.get_throughput(time.time() - hours * 3600, self.get_argument("worker", None))
+        self.write({"hours": hours, "levels": levels})
+
+class WorkerHandler(RequestHandler):
+    """
+    The broker endpoints that standalone build workers (`binder worker --broker URL`) lease jobs
+    from. They're only enabled if BROKER_TOKEN is set, and every request must carry it. JSON bodies
+    must name the worker and have all of the handler's FIELDS, other requests name the worker in
+    their arguments
+    """
+
+    FIELDS = []
+
+    def _fail(self, status, error):
+        self.set_status(status)
+        self.finish({"error": error})
+
+    def prepare(self):
+        if not BROKER_TOKEN:
+            return self._fail(404, "remote build workers are disabled")
+        expected = "token {}".format(BROKER_TOKEN)
+        if not hmac.compare_digest(str(self.request.headers.get("Authorization", "")), expected):
+            return self._fail(403, "invalid broker token")
+        if self.request.headers.get("Content-Type") == "application/json":
+            try:
+                self.body = json.loads(self.request.body)
+            except ValueError:
+                return self._fail(400, "malformed request body")
+            if not isinstance(self.body, dict):
+                return self._fail(400, "malformed request body")
+            missing = [field for field in ["worker"] + self.FIELDS if field not in self.body]
+            if missing:
+                return self._fail(400, "missing {}".format(", ".join(missing)))
+            self.worker = self.body["worker"]
+        else:
+            self.worker = self.get_argument("worker", None)
+        if not isinstance(self.worker, basestring) or not self.worker:
+            return self._fail(400, "missing worker")
+
+class WorkerClaimHandler(WorkerHandler):
+
+    def post(self):
+        max_running = self.body.get("max_running")
+        if max_running is not None and not isinstance(max_running, int):
+            return self._fail(400, "max_running must be an integer")
+        job = scheduler.queue.claim(self.worker, max_running=max_running)
+        self.write({"job": job})
+
+class WorkerConcurrencyHandler(WorkerHandler):
+
+    FIELDS = ["period"]
+    # the host's measures are None where the worker couldn't take them
+    PERIOD_FIELDS = ["time", "concurrency", "seconds", "peak", "completed"]
+    MEASURES = ["load", "iowait", "free_disk", "docker_latency"]
+
+    def post(self):
+        period = self.body["period"]
+        if not isinstance(period, dict):
+            return self._fail(400, "malformed period")
+        fields = WorkerConcurrencyHandler.PERIOD_FIELDS + WorkerConcurrencyHandler.MEASURES
+        for field in fields:
+            value = period.get(field)
+            if value is None and field in WorkerConcurrencyHandler.MEASURES:
+                continue
+            if not isinstance(value, (int, long, float)) or isinstance(value, bool):
+                return self._fail(400, "{} must be a number".format(field))
+        period = dict([(field, period.get(field)) for field in fields], worker=self.worker)
+        AdaptiveConcurrency.record_period(period)
+        self.write({"ok": True})
+
+class WorkerHeartbeatHandler(WorkerHandler):
+
+    def post(self, job_id):
+        self.write({"ok": scheduler.queue.heartbeat(job_id, self.worker)})
+
+class WorkerJobHandler(WorkerHandler):
+    """
+    The endpoints through which remote builds record their app, states, stages, images and output,
+    only for jobs leased to the requesting worker
+    """
+
+    def prepare(self):
+        super(WorkerJobHandler, self).prepare()
+        if self._finished:
+            return
+        self.job = scheduler.queue.get_leased_job(self.path_kwargs["job_id"], self.worker)
+        if not self.job:
+            return self._fail(409, "job isn't leased to this worker")
+
+class WorkerAppHandler(WorkerJobHandler):
+
+    FIELDS = ["spec"]
+
+    def post(self, job_id):
+        spec = self.body["spec"]
+        if not isinstance(spec, dict) or spec.get("name") != self.job["app"]:
+            return self._fail(400, "spec isn't the job's app")
+        App.create(spec)
+        self.write({"ok": True})
+
+class WorkerStateHandler(WorkerJobHandler):
+
+    FIELDS = ["state"]
+
+    def post(self, job_id):
+        state = self.body["state"]
+        if state not in [App.BuildState.BUILDING, App.BuildState.COMPLETED, App.BuildState.FAILED]:
+            return self._fail(400, "unknown build state")
+        app = App.get_app(self.job["app"])
+        if not app:
+            return self._fail(404, "app does not exist")
+        # the API gives out the IDs of all builds, wherever they run
+        build_id = App.index.update_build_state(app, state)
+        status_hub.publish(app.name, state)
+        self.write({"build_id": build_id})
+
+class WorkerStageHandler(WorkerJobHandler):
+
+    FIELDS = ["build_id", "stage", "started", "finished", "status"]
+
+    def post(self, job_id):
+        store = BuildStateStore.get_instance()
+        build = store.get_build(self.body["build_id"])
+        if not build or build["app"] != self.job["app"]:
+            return self._fail(400, "build isn't of the job's app")
+        store.record_stage(build["id"], self.body["stage"], self.body["started"], self.body["finished"],
+                           self.body["status"], self.body.get("bytes"), self.body.get("error"))
+        self.write({"ok": True})
+
+class WorkerImageHandler(WorkerJobHandler):
+
+    FIELDS = ["key", "image"]
+
+    def post(self, job_id):
+        cache = BuildCache.get_instance()
+        if self.body["image"]:
+            cache.store(self.job["app"], self.body["key"], self.body["image"])
+        else:
+            cache.forget(self.job["app"])
+        self.write({"ok": True})
+
+class WorkerLogHandler(WorkerJobHandler):
+
+    def post(self, job_id):
+        # the output of a job's build, as the raw body
+        try:
+            build_id = int(self.get_argument("build", ""))
+        except ValueError:
+            return self._fail(400, "build must be an integer")
+        # while its job is leased, the app's latest build is the job's
+        if build_id != BuildStateStore.get_instance().get_latest_id(self.job["app"]):
+            return self._fail(409, "build isn't the job's")
+        finished = self.get_argument("finished", "0") == "1"
+        BuildLogStore.get_instance().append(build_id, self.request.body, finished)
+        status_hub.publish(get_log_channel(build_id), finished)
+        if finished:
+            status_hub.discard(get_log_channel(build_id))
+        self.write({"ok": True})
+
+class WorkerFinishHandler(WorkerHandler):
+
+    def post(self, job_id):
+        job = scheduler.queue.get_leased_job(job_id, self.worker)
+        if not job:
+            return self.write({"ok": False})
+        ok = LocalBroker(scheduler.queue).finish(job, self.worker)
+        if ok:
+            status_hub.publish(job["app"], BuildStateStore.get_instance().get_state(job["app"]))
+        self.write({"ok": ok})
+
+class CullerHandler(BinderHandler):
+
+    def get(self):
+        super(CullerHandler, self).get()
+        if not CULL_IN_PROCESS:
+            self.set_status(404)
+            self.write({"error": "the culler is not running in this process"})
+        else:
+            self.write(Culler.get_instance().get_stats())
+
+def collect_log_garbage():
+    # removing logs can take a while, so it's done off the IOLoop
+    IOLoop.current().run_in_executor(None, BuildLogStore.get_instance().collect_garbage, BUILD_LOG_MAX_AGE)
 
 def sig_handler(sig, frame):
     IOLoop.instance().add_callback(shutdown)
@@ -154,24 +652,65 @@ def shutdown():
     print("Shutting down...")
     IOLoop.instance().stop()
     builder.stop()
+    WheelhouseServer.get_instance().stop()
+    launcher.stop()
+    WarmPool.get_instance().stop()
+    ClusterInventory.get_instance().stop()
+    if CULL_IN_PROCESS:
+        Culler.get_instance().stop()
 
 def main():
 
     application = Application([
+        (r"/apps/(?P<organization>.+)/(?P<repo>.+)/status/stream", GithubStatusStreamHandler),
         (r"/apps/(?P<organization>.+)/(?P<repo>.+)/status", GithubStatusHandler),
+        (r"/apps/(?P<organization>.+)/(?P<repo>.+)/timeline", GithubTimelineHandler),
+        (r"/apps/(?P<organization>.+)/(?P<repo>.+)/queue", GithubQueueHandler),
+        (r"/apps/(?P<organization>.+)/(?P<repo>.+)/log(?P<stream>/stream)?", GithubLogHandler),
         (r"/apps/(?P<organization>.+)/(?P<repo>.+)", GithubBuildHandler),
         (r"/apps/(?P<app_id>.+)", OtherSourceHandler),
+        (r"/launches/(?P<launch_id>.+)", LaunchHandler),
         (r"/services", ServicesHandler),
         (r"/apps", AppsHandler),
-        (r"/capacity", CapacityHandler)
+        (r"/capacity", CapacityHandler),
+        (r"/builds/stages", BuildStagesHandler),
+        (r"/builds/concurrency", BuildConcurrencyHandler),
+        (r"/builds/(?P<build_id>\d+)/log/stream", BuildLogStreamHandler),
+        (r"/builds/(?P<build_id>\d+)/log", BuildLogHandler),
+        (r"/workers/claim", WorkerClaimHandler),
+        (r"/workers/concurrency", WorkerConcurrencyHandler),
+        (r"/workers/jobs/(?P<job_id>\w+)/heartbeat", WorkerHeartbeatHandler),
+        (r"/workers/jobs/(?P<job_id>\w+)/app", WorkerAppHandler),
+        (r"/workers/jobs/(?P<job_id>\w+)/state", WorkerStateHandler),
+        (r"/workers/jobs/(?P<job_id>\w+)/stage", WorkerStageHandler),
+        (r"/workers/jobs/(?P<job_id>\w+)/image", WorkerImageHandler),
+        (r"/workers/jobs/(?P<job_id>\w+)/log", WorkerLogHandler),
+        (r"/workers/jobs/(?P<job_id>\w+)/finish", WorkerFinishHandler),
+        (r"/culler", CullerHandler)
     ], debug=True)
 
     signal.signal(signal.SIGTERM, sig_handler)
     signal.signal(signal.SIGINT, sig_handler)
 
+    status_hub.start()
+    # build states are only recorded in the build store by the SQLite app index
+    if APP_INDEX == "sqlite":
+        PeriodicCallback(BuildStatePoller(status_hub).poll, STATE_POLL_PERIOD * 1000).start()
+
+    PeriodicCallback(collect_log_garbage, LOG_GC_PERIOD * 1000).start()
+
+    # builds that were running when the server last stopped are started again
+    scheduler.recover()
+
     global builder
-    builder = Builder(build_queue, PRELOAD)
+    builder = Builder(scheduler, PRELOAD, on_state_change=status_hub.publish_threadsafe, on_log=on_build_log)
     builder.start()
+    WheelhouseServer.get_instance().start()
+
+    ClusterInventory.get_instance().start()
+    WarmPool.get_instance().start()
+    if CULL_IN_PROCESS:
+        Culler.get_instance().start()
 
     http_server = HTTPServer(application)
     http_server.listen(PORT)
@@ -1,79 +1,30 @@
+import socket
 from threading import Thread
-import sys
-import os
-import Queue
 
-from multiprocess import pool, Process
-import multiprocessing
-
-from binder.app import App
-from binder.utils import make_dir
+from binder.broker import LocalBroker
+from binder.worker import BuildWorker
 
+# max number of builds run at once by the web API's own worker (see BUILD_CONCURRENCY_ADAPTIVE)
 NUM_WORKERS = 16
-GET_TIMEOUT = 2
-LOG_DIR = "/home/andrew/logs/binder"
-
-# Copied+pasted from http://stackoverflow.com/questions/6974695/python-process-pool-non-daemonic
-# TODO use message queuing system instead of 2 process pools
-class NoDaemonProcess(Process):
-    # make 'daemon' attribute always return False
-    def _get_daemon(self):
-        return False
-    def _set_daemon(self, value):
-        pass
-    daemon = property(_get_daemon, _set_daemon)
+# the web API's own worker keeps its ID across restarts, so that its interrupted jobs can be
+# requeued right away
+LOCAL_WORKER_ID = "local@" + socket.gethostname()
 
-class NoDaemonPool(pool.Pool):
-    Process = NoDaemonProcess
-
-def build_app(spec, log_dir, preload=False):
-    name = spec["name"]
-    sys.stdout = open(os.path.join(log_dir, name + "-" + str(os.getpid()) + ".out"), "w", buffering=0)
-    sys.stderr = open(os.path.join(log_dir, name + "-" + str(os.getpid()) + ".err"), "w", buffering=0)
-    app = App.get_app(name)
-    print("In build_app")
-    if app and app.build_state == App.BuildState.BUILDING:
-        print("App {} already building. Wait for build to complete before resubmitting.".format(name))
-        return
-    new_app = App.create(spec)
-    try:
-        new_app.build(preload=preload)
-    except Exception as e:
-        # the "catch-all" clause
-        print("Could not build app {}: {}".format(new_app.name, e))
-        App.index.update_build_state(App.BuildState.FAILED)
 
 class Builder(Thread):
+    """
+    The web API's own build worker, leasing jobs straight from the scheduler's queue. Standalone
+    workers (`binder worker`) can build the same queue's jobs from other hosts
+    """
 
-    def __init__(self, queue, preload):
+    def __init__(self, scheduler, preload, on_state_change=None, on_log=None):
         super(Builder, self).__init__()
-        self._build_queue = queue
-
-        self._pool = NoDaemonPool(processes=NUM_WORKERS) 
-        multiprocessing.freeze_support()
-
-        self._stopped = False
-        self._preload = preload
-
-        make_dir(LOG_DIR)
+        self._worker = BuildWorker(LocalBroker(scheduler.queue), worker_id=scheduler.local_worker,
+                                   slots=scheduler.workers, preload=preload, on_state_change=on_state_change,
+                                   on_log=on_log)
 
     def stop(self):
-        self._stopped = True
-        self._pool.terminate()
-
-    def _build(self, spec):
-        try:
-            pool = self._pool
-            pool.apply_async(build_app, (spec, LOG_DIR, self._preload))
-        except Exception as e:
-            print("Exception in _build: {}".format(e))
+        self._worker.stop()
 
     def run(self):
-        while not self._stopped:
-            try:
-                next_job = self._build_queue.get(timeout=GET_TIMEOUT)
-                print("Got job: {}".format(next_job))
-                self._build(next_job)
-            except Queue.Empty:
-                pass
-
+        self._worker.run()
@@ -0,0 +1,76 @@
+import time
+import uuid
+from collections import OrderedDict
+from threading import Lock
+
+from concurrent.futures import ThreadPoolExecutor
+
+from binder.warmpool import WarmPool
+
+
+class Launcher(object):
+    """
+    Deploys apps in a bounded pool of threads, so that launches never block the IOLoop, and keeps
+    track of every launch until it has a redirect URL
+    """
+
+    class LaunchState(object):
+        LAUNCHING = "LAUNCHING"
+        LAUNCHED = "LAUNCHED"
+        FAILED = "FAILED"
+
+    def __init__(self, max_workers, history=1000, status_hub=None):
+        self._executor = ThreadPoolExecutor(max_workers)
+        self._status_hub = status_hub
+        self._history = history
+        self._lock = Lock()
+        # launch ID -> launch, oldest first
+        self._launches = OrderedDict()
+
+    def _launch(self, launch, app, mode):
+        try:
+            redirect_url = WarmPool.get_instance().launch(app, mode)
+        except Exception as e:
+            print("Could not launch app {0}: {1}".format(app.name, e))
+            redirect_url = None
+        launch["redirect_url"] = redirect_url
+        launch["state"] = Launcher.LaunchState.LAUNCHED if redirect_url else Launcher.LaunchState.FAILED
+        launch["finished"] = time.time()
+        self._publish(launch)
+        return launch
+
+    def _publish(self, launch):
+        if self._status_hub:
+            self._status_hub.publish_threadsafe(Launcher.get_channel(launch["id"]), launch["state"])
+
+    @staticmethod
+    def get_channel(launch_id):
+        return "launch/" + launch_id
+
+    def launch(self, app, mode):
+        """
+        Starts launching an app. Returns the launch and a future that resolves once it's finished
+        """
+        launch = {
+            "id": uuid.uuid4().hex,
+            "app": app.name,
+            "state": Launcher.LaunchState.LAUNCHING,
+            "redirect_url": None,
+            "submitted": time.time(),
+            "finished": None
+        }
+        with self._lock:
+            self._launches[launch["id"]] = launch
+            while len(self._launches) > self._history:
+                old_id, old_launch = self._launches.popitem(last=False)
+                if self._status_hub:
+                    self._status_hub.discard_threadsafe(Launcher.get_channel(old_id))
+        self._publish(launch)
+        return launch, self._executor.submit(self._launch, launch, app, mode)
+
+    def get_launch(self, launch_id):
+        with self._lock:
+            return self._launches.get(launch_id)
+
+    def stop(self):
+        self._executor.shutdown(wait=False)
@@ -0,0 +1,72 @@
+import time
+
+from binder.app import App
+from binder.buildqueue import BuildQueue
+from binder.buildstate import BuildStateStore
+
+# used for wait estimates until builds have completed in the last day (in seconds)
+DEFAULT_BUILD_TIME = 300
+
+
+class BuildScheduler(object):
+    """
+    Queues builds in the durable build queue, from which build workers lease them, and estimates
+    how long pending jobs will wait. The local worker runs `workers` builds at once, and standalone
+    workers are counted by the builds they're running. See BuildQueue for how the next job is chosen
+    """
+
+    def __init__(self, workers, local_worker, queue=None):
+        self.workers = workers
+        self.local_worker = local_worker
+        self.queue = queue or BuildQueue.get_instance()
+        self._build_time = (0, DEFAULT_BUILD_TIME)
+
+    def recover(self):
+        """
+        Requeues the jobs the local worker was running when the previous server stopped (the jobs
+        of standalone workers are requeued when their leases expire)
+        """
+        requeued = self.queue.requeue_running(self.local_worker)
+        print("Requeued {} interrupted builds".format(requeued))
+        return requeued
+
+    def submit(self, spec, owner, priority=0):
+        return self.queue.submit(spec, owner, priority)
+
+    def _get_capacity(self, stats):
+        remote = sum(n for worker, n in stats["running_by_worker"].items() if worker != self.local_worker)
+        return self.workers + remote
+
+    def _get_build_time(self):
+        # the median build time of the last day, recomputed at most once a minute
+        checked, build_time = self._build_time
+        if time.time() - checked > 60:
+            since = time.time() - 24 * 3600
+            build_time = BuildStateStore.get_instance().get_percentile(50, App.BuildState.COMPLETED, since)
+            build_time = build_time or DEFAULT_BUILD_TIME
+            self._build_time = (time.time(), build_time)
+        return build_time
+
+    def get_position(self, app_name):
+        """
+        Returns the app's pending job with its position in the queue (1 is next) and an estimate of
+        how long it'll wait before starting (in seconds), or None if the app has no pending job
+        """
+        stats = self.queue.get_stats()
+        capacity = self._get_capacity(stats)
+        for i, job in enumerate(self.queue.get_order()):
+            if job["app"] == app_name:
+                position = i + 1
+                free = max(capacity - stats["running"], 0)
+                if position <= free:
+                    wait = 0
+                else:
+                    wait = ((position - free - 1) // capacity + 1) * self._get_build_time()
+                job.update({"position": position, "estimated_wait": wait})
+                return job
+        return None
+
+    def get_stats(self):
+        stats = self.queue.get_stats()
+        stats["workers"] = self._get_capacity(stats)
+        return stats
@@ -0,0 +1,57 @@
+from datetime import timedelta
+
+from tornado import gen
+from tornado.ioloop import IOLoop
+from tornado.locks import Condition
+
+
+class StatusHub(object):
+    """
+    Keeps the latest state of every channel (an app's build, a launch...) in memory, and wakes up
+    the clients waiting on a channel when its state changes. Everything except the *_threadsafe
+    methods must be called from the IOLoop's thread.
+    """
+
+    def __init__(self):
+        self._io_loop = None
+        # channel -> {"version": ..., "state": ...}
+        self._states = {}
+        # channel -> Condition that clients waiting for a new version are blocked on
+        self._conditions = {}
+
+    def start(self):
+        self._io_loop = IOLoop.current()
+
+    def get(self, channel):
+        return self._states.get(channel)
+
+    def publish(self, channel, state):
+        current = self._states.get(channel)
+        version = current["version"] + 1 if current else 1
+        self._states[channel] = {"version": version, "state": state}
+        condition = self._conditions.pop(channel, None)
+        if condition:
+            condition.notify_all()
+
+    def discard(self, channel):
+        self._states.pop(channel, None)
+
+    def publish_threadsafe(self, channel, state):
+        if self._io_loop:
+            self._io_loop.add_callback(self.publish, channel, state)
+
+    def discard_threadsafe(self, channel):
+        if self._io_loop:
+            self._io_loop.add_callback(self.discard, channel)
+
+    @gen.coroutine
+    def wait(self, channel, version, timeout):
+        """
+        Waits (for at most `timeout` seconds) until the channel has a newer version than `version`.
+        Returns the channel's latest status either way
+        """
+        current = self._states.get(channel)
+        if not current or current["version"] <= version:
+            condition = self._conditions.setdefault(channel, Condition())
+            yield condition.wait(timeout=timedelta(seconds=timeout))
+        raise gen.Return(self._states.get(channel))